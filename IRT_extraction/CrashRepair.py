@@ -2,7 +2,6 @@ import numpy as np
 from scipy.interpolate import PchipInterpolator
 import pandas as pd
 from scipy.signal import savgol_filter
-import matplotlib.pyplot as plt
 import traceback
 
 def restructure_arr(arr):
@@ -10,6 +9,303 @@ def restructure_arr(arr):
         differences = [np.median(diff) if val == 0 else val for val in diff]
         return np.concatenate(([arr[0]], arr[0] + np.cumsum(differences)))
 
+class StreamingQuantile:
+    """
+    Quantile of a stream of values, updated chunk by chunk in bounded memory.
+
+    Each chunk is reduced to at most `resolution` order statistics, each
+    standing for an equal share of the chunk, and the merged summary is
+    compressed back to `resolution` points once it grows past four times that.
+    While fewer than `resolution` values have been seen the result is exact,
+    i.e. the same element as np.sort(values)[int(n * q)]; beyond that the rank
+    error is a small multiple of n / resolution.
+    """
+    def __init__(self, q=0.99, resolution=2000):
+        """
+        :param q: Quantile to estimate, in [0, 1).
+        :param resolution: Number of summary points kept per chunk.
+        """
+        self.q = q
+        self.resolution = resolution
+        self.count = 0
+        self.points = np.empty(0)
+        self.weights = np.empty(0)
+
+    def _summarize(self, values, weights):
+        order = np.argsort(values, kind='stable')
+        values, weights = values[order], weights[order]
+        if len(values) <= self.resolution:
+            return values, weights
+        # Evenly spaced ranks over the cumulative weight
+        total = weights.sum()
+        cumulative = np.cumsum(weights)
+        ranks = (np.arange(self.resolution) + 0.5) * total / self.resolution
+        picks = np.minimum(np.searchsorted(cumulative, ranks, side='right'), len(values) - 1)
+        return values[picks], np.full(self.resolution, total / self.resolution)
+
+    def update(self, values):
+        """
+        Add a chunk of values.
+
+        :param values: Array-like of values (e.g. np.abs of a stim_pos chunk).
+        :return: self
+        """
+        values = np.asarray(values, dtype=float).ravel()
+        if len(values) == 0:
+            return self
+        self.count += len(values)
+        chunk_points, chunk_weights = self._summarize(values, np.ones(len(values)))
+        self.points = np.concatenate([self.points, chunk_points])
+        self.weights = np.concatenate([self.weights, chunk_weights])
+        if len(self.points) > 4 * self.resolution:
+            self.points, self.weights = self._summarize(self.points, self.weights)
+        return self
+
+    def value(self):
+        """
+        :return: The current estimate of the q-th quantile.
+        :raises ValueError: If no values have been added.
+        """
+        if self.count == 0:
+            raise ValueError("No values have been added to the StreamingQuantile")
+        order = np.argsort(self.points, kind='stable')
+        cumulative = np.cumsum(self.weights[order])
+        tgt = int(self.count * self.q)
+        idx = min(np.searchsorted(cumulative, tgt, side='right'), len(cumulative) - 1)
+        return self.points[order][idx]
+
+def _pchip_edge_case(h0, h1, m0, m1):
+    # One-sided three-point estimate, as in PchipInterpolator._edge_case
+    d = ((2*h0 + h1)*m0 - h0*m1) / (h0 + h1)
+    mask = np.sign(d) != np.sign(m0)
+    mask2 = (np.sign(m0) != np.sign(m1)) & (np.abs(d) > 3.*np.abs(m0))
+    mmm = (~mask) & mask2
+    d[mask] = 0.
+    d[mmm] = 3.*m0[mmm]
+    return d
+
+def batch_pchip(x, y, xi):
+    """
+    Evaluate one PCHIP interpolant per row, for many rows at once.
+
+    Mirrors the arithmetic of scipy's PchipInterpolator (derivatives, Hermite
+    coefficients and the PPoly evaluation order) so each row is identical to
+    PchipInterpolator(x[i], y[i])(xi[i]).
+
+    :param x: (n_rows, n_points) sample times, one interpolant per row.
+    :param y: (n_rows, n_points, n_columns) sample values.
+    :param xi: (n_rows, n_eval) times to evaluate at.
+    :return: (n_rows, n_eval, n_columns) values, and a boolean mask of the rows
+             PchipInterpolator would accept (finite, strictly increasing x;
+             finite y and derivatives). Other rows hold meaningless values.
+    """
+    xv = x[:, :, np.newaxis]
+    hk = xv[:, 1:] - xv[:, :-1]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        mk = (y[:, 1:] - y[:, :-1]) / hk
+
+        if x.shape[1] == 2:
+            dk = np.concatenate([mk, mk], axis=1)
+        else:
+            smk = np.sign(mk)
+            condition = (smk[:, 1:] != smk[:, :-1]) | (mk[:, 1:] == 0) | (mk[:, :-1] == 0)
+            w1 = 2*hk[:, 1:] + hk[:, :-1]
+            w2 = hk[:, 1:] + 2*hk[:, :-1]
+            whmean = (w1/mk[:, :-1] + w2/mk[:, 1:]) / (w1 + w2)
+
+            dk = np.zeros_like(y)
+            dk[:, 1:-1] = np.where(condition, 0.0, 1.0 / whmean)
+            dk[:, 0] = _pchip_edge_case(hk[:, 0], hk[:, 1], mk[:, 0], mk[:, 1])
+            dk[:, -1] = _pchip_edge_case(hk[:, -1], hk[:, -2], mk[:, -1], mk[:, -2])
+
+        # Cubic Hermite coefficients, as in CubicHermiteSpline
+        slope = np.diff(y, axis=1) / hk
+        t = (dk[:, :-1] + dk[:, 1:] - 2 * slope) / hk
+        c0 = t / hk
+        c1 = (slope - dk[:, :-1]) / hk - t
+        c2 = dk[:, :-1]
+        c3 = y[:, :-1]
+
+    valid = (np.isfinite(x).all(axis=1)
+             & (np.diff(x, axis=1) > 0).all(axis=1)
+             & np.isfinite(y).all(axis=(1, 2))
+             & np.isfinite(dk).all(axis=(1, 2)))
+
+    # Interval i with x[i] <= xi < x[i+1], clamped to the first/last interval
+    interval = (x[:, np.newaxis, 1:-1] <= xi[:, :, np.newaxis]).sum(axis=2)
+    rows = np.arange(x.shape[0])[:, np.newaxis]
+    s = (xi - x[rows, interval])[:, :, np.newaxis]
+    z2 = s * s
+    values = 0.0 + c3[rows, interval]
+    values = values + c2[rows, interval] * s
+    values = values + c1[rows, interval] * z2
+    values = values + c0[rows, interval] * (z2 * s)
+    return values, valid
+
+class _SegmentRecord(dict):
+    """Segment dict whose 'pre_crash'/'post_crash' frames are sliced on first access."""
+    def __init__(self, segments, i, **fields):
+        super().__init__(**fields)
+        self._segments = segments
+        self._i = i
+
+    def __missing__(self, key):
+        if key == 'pre_crash':
+            self[key] = self._segments.pre_crash(self._i)
+        elif key == 'post_crash':
+            self[key] = self._segments.post_crash(self._i)
+        else:
+            raise KeyError(key)
+        return self[key]
+
+class CrashSegments:
+    """
+    Array-based index of the crash segments in a tracking DataFrame.
+
+    All fields are NumPy arrays with one entry per segment, computed in a single
+    vectorized pass over crash_count and flip_time. Pre/post crash DataFrame
+    slices are only taken when a consumer asks for them.
+    """
+    def __init__(self, data, window_frame_count, sampling_rate):
+        """
+        :param data: DataFrame containing the tracking data.
+        :param window_frame_count: Maximum number of frames on each side of a crash.
+        :param sampling_rate: Sampling rate of the data.
+        """
+        self.data = data
+        crash_count = data['crash_count'].to_numpy()
+        flip_time = data['flip_time'].to_numpy()
+        n = len(crash_count)
+
+        # Same transitions as crash_count.diff() != 0, including the first row
+        changed = np.ones(n, dtype=bool)
+        changed[1:] = crash_count[1:] != crash_count[:-1]
+        crash_idx = np.flatnonzero(changed)
+
+        # Adjust window sizes based on available data and only skip if we have
+        # no data before or after crash
+        pre_window = np.minimum(window_frame_count, crash_idx)
+        post_window = np.minimum(window_frame_count, n - crash_idx)
+        keep = (pre_window > 0) & (post_window > 0)
+
+        self.crash_idx = crash_idx[keep]
+        self.pre_start = self.crash_idx - pre_window[keep]
+        self.post_stop = self.crash_idx + post_window[keep]
+        self.gap_duration = flip_time[self.crash_idx] - flip_time[self.crash_idx - 1]
+        self.n_missing_frames = np.round(self.gap_duration * sampling_rate).astype(int)
+        self.is_partial = (pre_window[keep] < window_frame_count) | (post_window[keep] < window_frame_count)
+
+    def __len__(self):
+        return len(self.crash_idx)
+
+    def __getitem__(self, i):
+        return _SegmentRecord(self, i,
+                              crash_idx=int(self.crash_idx[i]),
+                              gap_duration=self.gap_duration[i],
+                              n_missing_frames=int(self.n_missing_frames[i]),
+                              is_partial=bool(self.is_partial[i]))
+
+    def __iter__(self):
+        return (self[i] for i in range(len(self)))
+
+    def select(self, mask):
+        """
+        :param mask: Boolean array with one entry per segment.
+        :return: A CrashSegments index with only the selected segments.
+        """
+        selected = object.__new__(CrashSegments)
+        selected.data = self.data
+        for field in ('crash_idx', 'pre_start', 'post_stop', 'gap_duration',
+                      'n_missing_frames', 'is_partial'):
+            setattr(selected, field, getattr(self, field)[mask])
+        return selected
+
+    def pre_crash(self, i):
+        return self.data.iloc[self.pre_start[i]:self.crash_idx[i]]
+
+    def post_crash(self, i):
+        return self.data.iloc[self.crash_idx[i]:self.post_stop[i]]
+
+class ResampleIndex:
+    """
+    Precomputed row index from one time base onto a target grid.
+
+    The rows take() picks for every target time (the previous one, or the
+    nearer of the two bracketing ones) are found once, so any number of
+    columns that can't be interpolated (counts, flags, labels) are resampled
+    with a single gather each. Files that share a time base can share an index.
+
+    There is no interpolation counterpart: resample_data interpolates float
+    columns with np.interp, which on a sorted grid is faster than gathering
+    from precomputed brackets, even with the index reused.
+    """
+    def __init__(self, times, new_times):
+        """
+        :param times: Source timestamps, one per row of the data to resample.
+        :param new_times: Target timestamps.
+        """
+        times = np.asarray(times, dtype=float)
+        if len(times) == 0:
+            raise ValueError("Cannot resample from an empty time base")
+        self.times = times
+        self.new_times = np.asarray(new_times, dtype=float)
+
+        # Same bracket as np.interp: times[j] <= t < times[j + 1]. Targets
+        # outside the source times use the end row on both sides.
+        j = np.searchsorted(times, self.new_times, side='right') - 1
+        inside = (j >= 0) & (j < len(times) - 1)
+        self.previous = np.clip(j, 0, len(times) - 1)
+        following = np.where(inside, j + 1, self.previous)
+        span = times[following] - times[self.previous]
+        offset = np.where(inside, self.new_times - times[self.previous], 0.0)
+        self.nearest = np.where(offset > span / 2, following, self.previous)
+
+    @classmethod
+    def at_rate(cls, times, target_frequency):
+        """
+        Index onto np.arange(times[0], times[-1], 1 / target_frequency).
+
+        :param times: Source timestamps.
+        :param target_frequency: Target rate in Hz, any positive number.
+        """
+        times = np.asarray(times, dtype=float)
+        return cls(times, cls.grid(times, target_frequency))
+
+    @staticmethod
+    def grid(times, target_frequency):
+        """np.arange(times[0], times[-1], 1 / target_frequency), checked."""
+        if not target_frequency > 0:
+            raise ValueError(f"target_frequency must be positive, got {target_frequency}")
+        if len(times) == 0:
+            raise ValueError("Cannot resample from an empty time base")
+        return np.arange(times[0], times[-1], 1.0 / target_frequency)
+
+    def __len__(self):
+        return len(self.new_times)
+
+    def matches(self, times):
+        """Whether `times` is the time base this index was built for."""
+        return np.array_equal(np.asarray(times, dtype=float), self.times)
+
+    def take(self, series, policy='previous'):
+        """
+        Resample a column without interpolating it.
+
+        :param series: Series of any dtype, one row per source time.
+        :param policy: 'previous' for the last row at or before each target
+                       time, 'nearest' for the closer of the two bracketing
+                       rows (ties go to the previous one). When downsampling,
+                       rows no target time picks (e.g. a did_crash flag) are dropped.
+        :return: Series of the same dtype with one row per target time.
+        """
+        if policy == 'previous':
+            rows = self.previous
+        elif policy == 'nearest':
+            rows = self.nearest
+        else:
+            raise ValueError(f"Unknown resampling policy {policy!r}")
+        return series.take(rows).reset_index(drop=True)
+
 class CrashRepair:
     def __init__(self, data_df, sampling_rate=30, target_max_position=0.4, window_size=3.0):
         """
@@ -25,17 +321,34 @@ class CrashRepair:
         self.frame_duration = 1 / sampling_rate
         self.target_max_position = target_max_position
         self.window_frame_count = int(window_size * sampling_rate)
+        self._segments = None
+        self.segments_repaired = 0
         
-    def set_target_max_position(self):
+    def set_target_max_position(self, estimator=None):
         """
         Set the target maximum position based on the 99th percentile of 
         the absolute stimulus positions. This overwrites the target_max_position
         set in the constructor.
+
+        :param estimator: Optional StreamingQuantile already fed with the
+                          absolute stimulus positions (e.g. while the file was
+                          read in chunks). Its estimate is used instead of
+                          scanning self.data.
+
+        Without any stimulus positions the target is NaN, as in
+        stream_cpCST.scan_tracking.
         """
-        abs_stim = np.abs(self.data['stim_pos'].values).copy()
-        s = np.sort(abs_stim)
-        tgt = int(len(s) * 0.99)
-        self.target_max_position = s[tgt]
+        if estimator is not None:
+            self.target_max_position = estimator.value() if estimator.count else np.nan
+            return
+        # Same element as np.sort(abs_stim)[tgt], selected in O(n) in place
+        abs_stim = np.abs(self.data['stim_pos'].values)
+        if len(abs_stim) == 0:
+            self.target_max_position = np.nan
+            return
+        tgt = int(len(abs_stim) * 0.99)
+        abs_stim.partition(tgt)
+        self.target_max_position = abs_stim[tgt]
 
     def smooth_dampen(self, values, target_max, scale_factor=1.5):
         """
@@ -68,36 +381,14 @@ class CrashRepair:
     def find_crash_segments(self):
         """
         Identify segments in the data where crashes occur.
-        
-        :return: List of dictionaries containing crash segment information.
+
+        The index is computed once and reused by repair_tracking and plot_repair.
+
+        :return: CrashSegments index; iterating it yields one dict per segment.
         """
-        crash_transitions = self.data[self.data['crash_count'].diff() != 0].index.tolist()
-        segments = []
-        
-        for crash_idx in crash_transitions:
-            # Adjust window sizes based on available data
-            pre_window = min(self.window_frame_count, crash_idx)
-            post_window = min(self.window_frame_count, len(self.data) - crash_idx)
-            
-            # Only skip if we have no data before or after crash
-            if pre_window == 0 or post_window == 0:
-                continue
-                
-            pre_crash = self.data.iloc[crash_idx - pre_window:crash_idx]
-            post_crash = self.data.iloc[crash_idx:crash_idx + post_window]
-            gap_duration = post_crash['flip_time'].iloc[0] - pre_crash['flip_time'].iloc[-1]
-            n_missing_frames = int(np.round(gap_duration * self.sampling_rate))
-            
-            segments.append({
-                'crash_idx': crash_idx,
-                'pre_crash': pre_crash,
-                'post_crash': post_crash,
-                'gap_duration': gap_duration,
-                'n_missing_frames': n_missing_frames,
-                'is_partial': pre_window < self.window_frame_count or post_window < self.window_frame_count
-            })
-        
-        return segments
+        if self._segments is None:
+            self._segments = CrashSegments(self.data, self.window_frame_count, self.sampling_rate)
+        return self._segments
 
     def compute_transition(self, pre_data, post_data):
         if len(pre_data) < 2 or len(post_data) < 2:
@@ -163,55 +454,187 @@ class CrashRepair:
             'flip_time': times
         })
 
-    def resample_data(self, data, target_frequency=30):
-        # Calculate the new time index based on the target frequency
-        start_time = data['flip_time'].iloc[0]
-        end_time = data['flip_time'].iloc[-1]
-        new_time_index = np.arange(start_time, end_time, 1.0 / target_frequency)
-
-        # Interpolate the data to the new time index
-        stim_interp = np.interp(new_time_index, data['flip_time'], data['stim_pos'])
-        user_interp = np.interp(new_time_index, data['flip_time'], data['user_pos'])
-        # Create a new DataFrame with the resampled data
-        resampled_data = pd.DataFrame({
-            'flip_time': new_time_index,
-            'stim_pos': stim_interp,
-            'user_pos': user_interp
-        })
+    def resample_data(self, data, target_frequency=30, columns=('stim_pos', 'user_pos'),
+                      policy='previous', index=None):
+        """
+        Resample the data onto a regular flip_time grid.
 
-        return resampled_data
+        Float columns are interpolated linearly with np.interp. Integer,
+        boolean and non-numeric columns (crash_count, did_crash, ...) take
+        the previous or nearest row through a ResampleIndex, so counts and
+        flags stay valid.
+
+        :param data: DataFrame with flip_time.
+        :param target_frequency: Target rate in Hz.
+        :param columns: Columns to resample besides flip_time, or None for all of them.
+        :param policy: 'previous' or 'nearest', for the columns that aren't interpolated.
+        :param index: ResampleIndex built for this flip_time, e.g. by an earlier
+                      call on a file with the same time base. Its grid is used
+                      instead of target_frequency's, and it saves the row
+                      search for the columns that aren't interpolated.
+        :return: DataFrame with flip_time and the resampled columns.
+        """
+        times = data['flip_time'].to_numpy(dtype=float)
+        if index is not None and not index.matches(times):
+            raise ValueError("The resample index was built for a different flip_time")
+        if columns is None:
+            columns = [col for col in data.columns if col != 'flip_time']
+        columns = list(columns)
+
+        interpolated = [col for col in columns if pd.api.types.is_float_dtype(data[col].dtype)]
+        if index is None and len(interpolated) < len(columns):
+            index = ResampleIndex.at_rate(times, target_frequency)
+        new_time_index = ResampleIndex.grid(times, target_frequency) if index is None else index.new_times
+
+        resampled = {'flip_time': new_time_index}
+        for col in columns:
+            if col in interpolated:
+                resampled[col] = np.interp(new_time_index, times, data[col].to_numpy(dtype=float))
+            else:
+                resampled[col] = index.take(data[col], policy)
+        return pd.DataFrame(resampled)
+
+    def compute_transitions(self, segments):
+        """
+        Batched compute_transition for every segment of a CrashSegments index.
+
+        Segment windows of equal length are gathered into stacked arrays and
+        interpolated and damped together. Segments PCHIP would reject
+        (e.g. repeated timestamps) go through compute_transition one by one so
+        its restructure_arr fallback still applies.
+
+        :param segments: CrashSegments index.
+        :return: List with one (stim_pos, user_pos, flip_time) tuple of arrays
+                 per segment, or None where no transition could be computed.
+        """
+        flip_time = self.data['flip_time'].to_numpy(dtype=float)
+        positions = np.column_stack([self.data['stim_pos'].to_numpy(dtype=float),
+                                     self.data['user_pos'].to_numpy(dtype=float)])
+        transitions = [None] * len(segments)
+
+        lengths = segments.post_stop - segments.pre_start
+        usable = ((segments.crash_idx - segments.pre_start >= 2)
+                  & (segments.post_stop - segments.crash_idx >= 2))
+        for length in np.unique(lengths[usable]):
+            group = np.flatnonzero(usable & (lengths == length))
+            rows = segments.pre_start[group, np.newaxis] + np.arange(length)
+            times = flip_time[rows]
+            interp_times = np.linspace(times[:, 0], times[:, -1], length, axis=1)
+
+            interp, valid = batch_pchip(times, positions[rows], interp_times)
+            interp = self.smooth_dampen(interp[valid], self.target_max_position)
+            window_length = min(15, length // 2 * 2 - 1)
+            if window_length > 3:
+                # savgol_filter fits the edges with one least-squares solve for
+                # all series, which is not bit-identical to filtering each
+                # series alone, so filter them one at a time
+                for k in range(interp.shape[0]):
+                    for col in range(interp.shape[2]):
+                        interp[k, :, col] = savgol_filter(interp[k, :, col], window_length, 3)
+
+            for k, seg in enumerate(group[valid]):
+                transitions[seg] = (interp[k, :, 0], interp[k, :, 1], interp_times[valid][k])
+            for seg in group[~valid]:
+                transition_df = self.compute_transition(segments.pre_crash(seg),
+                                                        segments.post_crash(seg))
+                if transition_df is not None:
+                    transitions[seg] = (transition_df['stim_pos'].values,
+                                        transition_df['user_pos'].values,
+                                        transition_df['flip_time'].values)
+        return transitions
+
+    def apply_transitions(self, repaired_data, segments, transitions):
+        """
+        Write computed transitions into a DataFrame in place.
+
+        :param repaired_data: DataFrame with the same rows as self.data.
+        :param segments: CrashSegments index the transitions were computed for.
+        :param transitions: Output of compute_transitions.
+        """
+        repaired = [seg for seg, transition in enumerate(transitions) if transition is not None]
+        if not repaired:
+            return
+        self.segments_repaired += len(repaired)
+
+        # Later segments overwrite earlier ones where windows overlap, so
+        # keep only the last write to each row and scatter everything at once
+        idx = np.concatenate([np.arange(segments.pre_start[seg], segments.post_stop[seg])
+                              for seg in repaired])
+        last = len(idx) - 1 - np.unique(idx[::-1], return_index=True)[1]
+        idx = idx[last]
+        for col, k in (('stim_pos', 0), ('user_pos', 1), ('flip_time', 2)):
+            values = repaired_data[col].to_numpy(dtype=float, copy=True)
+            values[idx] = np.concatenate([transitions[seg][k] for seg in repaired])[last]
+            repaired_data[col] = values
+
+        did_crash = repaired_data['did_crash'].to_numpy(copy=True)
+        did_crash[idx] = False
+        repaired_data['did_crash'] = did_crash
+
+        # Each segment takes the crash count just before it, after earlier
+        # segments have been written
+        crash_count = repaired_data['crash_count'].to_numpy(copy=True)
+        for seg in repaired:
+            start_idx = segments.pre_start[seg]
+            crash_count[start_idx:segments.post_stop[seg]] = crash_count[start_idx-1] if start_idx > 0 else 0
+        repaired_data['crash_count'] = crash_count
 
     def repair_tracking(self):
         segments = self.find_crash_segments()
         repaired_data = self.data.copy()
+        self.apply_transitions(repaired_data, segments, self.compute_transitions(segments))
 
-        for segment in segments:
-            transition_df = self.compute_transition(
-                segment['pre_crash'],
-                segment['post_crash']
-            )
+        repaired_data = self.resample_data(repaired_data, target_frequency=30)
+        return repaired_data
 
-            if transition_df is None:
+    def repair_plot_spec(self, repaired_data, segment_indices=(0,)):
+        """
+        Record what plot_repair draws for some crash segments, without drawing it.
+
+        The record holds the original and repaired series once, as plain NumPy
+        arrays, and one small window dict per segment, so a whole file's
+        figures can be pickled to another process and rendered later with
+        render_repair_plots.
+
+        :param repaired_data: DataFrame containing the repaired data.
+        :param segment_indices: Indices of the crash segments to plot.
+        :return: Dict, or None if none of the segments can be plotted.
+        """
+        segments = self.find_crash_segments()
+        window_size = int(2 * self.window_frame_count)
+        windows = []
+        for segment_index in segment_indices:
+            if segment_index >= len(segments):
+                print(f"Warning: Segment index {segment_index} is out of range")
                 continue
 
-            start_idx = segment['crash_idx'] - len(segment['pre_crash'])
-            end_idx = segment['crash_idx'] + len(segment['post_crash'])
-            # Ensure we have the correct number of points
-            if len(transition_df) != end_idx - start_idx:
-                print(f"Warning: Mismatch in transition length {len(transition_df)} vs window length {end_idx - start_idx}")
+            crash_idx = int(segments.crash_idx[segment_index])
+            start_idx = crash_idx - window_size
+            end_idx = crash_idx + window_size
+
+            # Check if the calculated indices are within bounds
+            if start_idx < 0:
+                print(f"Warning: Calculated start index {start_idx} is out of bounds.")
                 continue
-            # Create the index range and verify lengths match
-            idx_range = pd.RangeIndex(start=start_idx, stop=end_idx)
-            # Update the data
-            repaired_data.loc[idx_range, 'stim_pos'] = transition_df['stim_pos'].values
-            repaired_data.loc[idx_range, 'user_pos'] = transition_df['user_pos'].values
-            repaired_data.loc[idx_range, 'flip_time'] = transition_df['flip_time'].values
-            repaired_data.loc[idx_range, 'did_crash'] = False
-            last_crash_count = repaired_data.loc[start_idx-1, 'crash_count'] if start_idx > 0 else 0
-            repaired_data.loc[idx_range, 'crash_count'] = last_crash_count
+            if end_idx >= len(self.data):
+                print(f"Warning: Calculated end index {end_idx} is out of bounds.")
+                continue
+            windows.append({'segment_index': segment_index,
+                            'crash_idx': crash_idx,
+                            'gap_duration': float(segments.gap_duration[segment_index]),
+                            'start_idx': start_idx,
+                            'end_idx': end_idx})
+        if not windows:
+            return None
 
-        repaired_data = self.resample_data(repaired_data, target_frequency=30)
-        return repaired_data
+        columns = ['flip_time', 'stim_pos', 'user_pos']
+        return {
+            'window_size': window_size,
+            'target_max_position': float(self.target_max_position),
+            'original': {col: self.data[col].to_numpy(dtype=float) for col in columns},
+            'repaired': {col: repaired_data[col].to_numpy(dtype=float) for col in columns},
+            'windows': windows,
+        }
 
     def plot_repair(self, repaired_data, segment_index=0):
         """
@@ -221,76 +644,85 @@ class CrashRepair:
         :param segment_index: Index of the crash segment to plot.
         :return: Matplotlib figure object.
         """
-
-        segments = self.find_crash_segments()
-        if segment_index >= len(segments):
-            print(f"Warning: Segment index {segment_index} is out of range")
+        spec = self.repair_plot_spec(repaired_data, [segment_index])
+        if spec is None:
             return None
+        return draw_repair_plot(spec)
 
-        segment = segments[segment_index]
-        crash_idx = segment['crash_idx']
-        window_size = int(2 * self.window_frame_count)
-        start_idx = crash_idx - window_size
-        end_idx = crash_idx + window_size
 
-        # Check if the calculated indices are within bounds
-        if start_idx < 0:
-            print(f"Warning: Calculated start index {start_idx} is out of bounds.")
-            return
-        if end_idx >= len(self.data):
-            print(f"Warning: Calculated end index {end_idx} is out of bounds.")
-            return
+def draw_repair_plot(spec, window=0):
+    """
+    Draw the figure plot_repair returns for one window of a repair_plot_spec record.
 
-        fig, (ax1, ax2, ax3) = plt.subplots(3, 1, figsize=(12, 12))
-        ax1.plot(self.data.loc[start_idx:end_idx, 'flip_time'], 
-                self.data.loc[start_idx:end_idx, 'stim_pos'],
-                'r--', label='Original Stimulus')
-        ax1.plot(repaired_data.loc[start_idx:end_idx, 'flip_time'],
-                repaired_data.loc[start_idx:end_idx, 'stim_pos'],
-                'b-', label='Repaired Stimulus')
-        ax1.axvspan(
-            self.data.loc[crash_idx-(window_size/2), 'flip_time'],
-            self.data.loc[crash_idx, 'flip_time'] + segment['gap_duration'],
-            color='gray', alpha=0.2, label='Reset Period'
-        )
-        ax1.axhline(y=self.target_max_position, color='g', linestyle=':')
-        ax1.axhline(y=-self.target_max_position, color='g', linestyle=':')
-        ax1.set_ylabel('Stimulus Position')
-        ax1.legend()
-
-        ax2.plot(self.data.loc[start_idx:end_idx, 'flip_time'],
-                self.data.loc[start_idx:end_idx, 'user_pos'],
-                'r--', label='Original User')
-        ax2.plot(repaired_data.loc[start_idx:end_idx, 'flip_time'],
-                repaired_data.loc[start_idx:end_idx, 'user_pos'],
-                'b-', label='Repaired User')
-        ax2.axvspan(
-            self.data.loc[crash_idx-(window_size/2), 'flip_time'],
-            self.data.loc[crash_idx, 'flip_time'] + segment['gap_duration'],
-            color='gray', alpha=0.2
-        )
-        ax2.axhline(y=self.target_max_position, color='g', linestyle=':')
-        ax2.axhline(y=-self.target_max_position, color='g', linestyle=':')
-        ax2.set_ylabel('User Position')
-        ax2.legend()
-
-        stim_vel = repaired_data.loc[start_idx:end_idx, 'stim_pos'].diff() / \
-                  repaired_data.loc[start_idx:end_idx, 'flip_time'].diff()
-        user_vel = repaired_data.loc[start_idx:end_idx, 'user_pos'].diff() / \
-                  repaired_data.loc[start_idx:end_idx, 'flip_time'].diff()
-
-        ax3.plot(self.data['flip_time'], self.data['stim_pos'], 'r--', label='Original Stimulus')
-        ax3.plot(self.data['flip_time'], self.data['user_pos'], 'b--', label='Original User')
-        ax3.plot(repaired_data['flip_time'], repaired_data['stim_pos'], 'm-', label='Repaired Stimulus')
-        ax3.plot(repaired_data['flip_time'], repaired_data['user_pos'], 'g-', label='Repaired User')
-        ax3.axvspan(
-            self.data.loc[crash_idx-window_size, 'flip_time'],
-            self.data.loc[crash_idx, 'flip_time'] + segment['gap_duration'],
-            color='gray', alpha=0.2
-        )
-        ax3.set_ylabel('Position')
-        ax3.set_xlabel('Time (s)')
-        ax3.legend()
+    :param spec: Dict from CrashRepair.repair_plot_spec.
+    :param window: Position of the segment in spec['windows'].
+    :return: Matplotlib figure object.
+    """
+    import matplotlib.pyplot as plt
+
+    original, repaired = spec['original'], spec['repaired']
+    crash_idx = spec['windows'][window]['crash_idx']
+    window_size = spec['window_size']
+    target_max_position = spec['target_max_position']
+    # .loc[start_idx:end_idx] on the default RangeIndex includes end_idx
+    rows = slice(spec['windows'][window]['start_idx'], spec['windows'][window]['end_idx'] + 1)
+    span_end = original['flip_time'][crash_idx] + spec['windows'][window]['gap_duration']
+    span_start = original['flip_time'][crash_idx - window_size // 2]
+
+    fig, (ax1, ax2, ax3) = plt.subplots(3, 1, figsize=(12, 12))
+    ax1.plot(original['flip_time'][rows], original['stim_pos'][rows],
+            'r--', label='Original Stimulus')
+    ax1.plot(repaired['flip_time'][rows], repaired['stim_pos'][rows],
+            'b-', label='Repaired Stimulus')
+    ax1.axvspan(span_start, span_end, color='gray', alpha=0.2, label='Reset Period')
+    ax1.axhline(y=target_max_position, color='g', linestyle=':')
+    ax1.axhline(y=-target_max_position, color='g', linestyle=':')
+    ax1.set_ylabel('Stimulus Position')
+    ax1.legend()
+
+    ax2.plot(original['flip_time'][rows], original['user_pos'][rows],
+            'r--', label='Original User')
+    ax2.plot(repaired['flip_time'][rows], repaired['user_pos'][rows],
+            'b-', label='Repaired User')
+    ax2.axvspan(span_start, span_end, color='gray', alpha=0.2)
+    ax2.axhline(y=target_max_position, color='g', linestyle=':')
+    ax2.axhline(y=-target_max_position, color='g', linestyle=':')
+    ax2.set_ylabel('User Position')
+    ax2.legend()
+
+    ax3.plot(original['flip_time'], original['stim_pos'], 'r--', label='Original Stimulus')
+    ax3.plot(original['flip_time'], original['user_pos'], 'b--', label='Original User')
+    ax3.plot(repaired['flip_time'], repaired['stim_pos'], 'm-', label='Repaired Stimulus')
+    ax3.plot(repaired['flip_time'], repaired['user_pos'], 'g-', label='Repaired User')
+    ax3.axvspan(original['flip_time'][crash_idx - window_size], span_end, color='gray', alpha=0.2)
+    ax3.set_ylabel('Position')
+    ax3.set_xlabel('Time (s)')
+    ax3.legend()
+
+    plt.tight_layout()
+    return fig
+
+
+def init_plot_worker():
+    """Process pool initializer: render off-screen."""
+    import matplotlib.pyplot as plt
+    plt.switch_backend('Agg')
+
+
+def render_repair_plots(spec, out_fpaths):
+    """
+    Draw every window of a repair_plot_spec record and save each as an image.
+
+    Meant to run in a process pool started with init_plot_worker.
+
+    :param spec: Dict from CrashRepair.repair_plot_spec.
+    :param out_fpaths: Path of the image to write for each of spec['windows'].
+    :return: out_fpaths
+    """
+    import matplotlib.pyplot as plt
 
-        plt.tight_layout()
-        return fig
+    for window, out_fpath in enumerate(out_fpaths):
+        fig = draw_repair_plot(spec, window)
+        fig.savefig(out_fpath)
+        plt.close(fig)
+    return out_fpaths
@@ -0,0 +1,241 @@
+"""
+Benchmark the CrashRepair implementations on synthetic cpCST tracking data.
+
+Times find_crash_segments, compute_transition (over every segment),
+repair_tracking and resample_data for each implementation, at every frame
+count in --lengths, and writes the results to a JSON file:
+
+    {"meta":    versions, platform, the command line settings,
+     "results": one record per (variant, stage, n_frames) with every repeat's
+                wall time, the median, frames/s and the traced peak memory,
+     "scaling": per variant and stage, frames/s against n_frames and the
+                log-log slope of time against n_frames (1.0 is linear)}
+
+Stages an implementation doesn't have (NewCrashRepair has no resample_data)
+or that raise are recorded with an "error" instead of a time.
+
+Usage:
+    python bench_crash_repair.py --out bench.json [--lengths 3600 18000 72000]
+                                 [--crashes-per-hour 60] [--spacing 300] [--repeats 5]
+"""
+import argparse
+import importlib.util
+import json
+import platform
+import sys
+import time
+import tracemalloc
+import warnings
+from datetime import datetime
+from pathlib import Path
+
+import matplotlib
+matplotlib.use('Agg')
+import numpy as np
+import pandas as pd
+import scipy
+
+HERE = Path(__file__).resolve().parent
+VARIANTS = {
+    'CrashRepair': HERE / 'CrashRepair.py',
+    'NewCrashRepair': HERE / 'NewCrashRepair.py',
+    'CrashRepairRefactor': HERE / 'crash_repair_refactor' / 'CrashRepairRefactor.py',
+}
+STAGES = ['find_crash_segments', 'compute_transition', 'repair_tracking', 'resample_data']
+
+
+def load_variant(name):
+    """Import one of the VARIANTS by path and return its CrashRepair class."""
+    spec = importlib.util.spec_from_file_location(f'bench_{name}', VARIANTS[name])
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module.CrashRepair
+
+
+def make_tracking_frame(n_frames, n_crashes, spacing, sampling_rate=60, crash_gap=1.0, seed=0):
+    """
+    Synthetic tracking data with the columns CrashRepair reads.
+
+    stim_pos is a random walk that user_pos follows with a lag and noise.
+    At each crash the clock jumps by `crash_gap` seconds, both positions reset
+    to zero, crash_count increments and did_crash is set for that frame.
+
+    :param n_frames: Number of rows.
+    :param n_crashes: Number of crashes.
+    :param spacing: Minimum number of frames between crashes, and between a
+                    crash and either end of the frame.
+    :param sampling_rate: Frames per second before jitter.
+    :param crash_gap: Seconds of missing data at each crash.
+    :param seed: Seed for numpy's default_rng.
+    :return: DataFrame with flip_time, stim_pos, user_pos, crash_count, did_crash.
+    """
+    rng = np.random.default_rng(seed)
+    slack = n_frames - (n_crashes + 1) * spacing
+    if slack < 0:
+        raise ValueError(f"{n_crashes} crashes {spacing} frames apart don't fit in {n_frames} frames")
+    crash_idx = (np.sort(rng.integers(0, slack + 1, n_crashes))
+                 + spacing * np.arange(1, n_crashes + 1))
+
+    frame_duration = 1.0 / sampling_rate
+    flip_time = 100 + np.cumsum(frame_duration + rng.normal(0, frame_duration / 100, n_frames))
+    stim_pos = np.cumsum(rng.normal(0, 0.01, n_frames))
+    lag = int(0.3 * sampling_rate)
+    user_pos = np.concatenate([np.zeros(lag), stim_pos[:-lag]]) + rng.normal(0, 0.02, n_frames)
+    crash_count = np.zeros(n_frames, dtype=np.int64)
+    did_crash = np.zeros(n_frames, dtype=bool)
+    for idx in crash_idx:
+        flip_time[idx:] += crash_gap
+        stim_pos[idx:] -= stim_pos[idx]
+        user_pos[idx:] -= user_pos[idx]
+        crash_count[idx:] += 1
+        did_crash[idx] = True
+    return pd.DataFrame({'flip_time': flip_time, 'stim_pos': stim_pos, 'user_pos': user_pos,
+                         'crash_count': crash_count, 'did_crash': did_crash})
+
+
+def _stage(cls, stage, df):
+    """
+    :return: (setup, run) for one stage. setup() builds fresh state outside
+             the timed region; run(state) is what gets timed.
+    """
+    def repairer():
+        cr = cls(df)
+        if hasattr(cr, 'set_target_max_position'):
+            cr.set_target_max_position()
+        return cr
+
+    if stage == 'find_crash_segments':
+        return repairer, lambda cr: cr.find_crash_segments()
+    if stage == 'compute_transition':
+        def setup():
+            cr = repairer()
+            return cr, list(cr.find_crash_segments())
+        return setup, lambda state: [state[0].compute_transition(seg['pre_crash'], seg['post_crash'])
+                                     for seg in state[1]]
+    if stage == 'repair_tracking':
+        return repairer, lambda cr: cr.repair_tracking()
+    if stage == 'resample_data':
+        return repairer, lambda cr: cr.resample_data(cr.data, target_frequency=30)
+    raise ValueError(stage)
+
+
+def benchmark_stage(cls, stage, df, repeats=5):
+    """
+    Time one stage of one implementation on one frame.
+
+    Timing runs and the memory run are separate, because tracemalloc slows
+    allocation-heavy code down.
+
+    :return: Dict with the wall times, median, frames/s and peak traced memory,
+             or with an error message.
+    """
+    record = {'stage': stage, 'n_frames': len(df)}
+    if stage != 'find_crash_segments' and not hasattr(cls, stage):
+        record['error'] = f"{cls.__module__} has no {stage}"
+        return record
+    setup, run = _stage(cls, stage, df)
+    try:
+        times = []
+        for _ in range(repeats):
+            state = setup()
+            start = time.perf_counter()
+            run(state)
+            times.append(time.perf_counter() - start)
+
+        state = setup()
+        tracemalloc.start()
+        run(state)
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+    except Exception as e:
+        if tracemalloc.is_tracing():
+            tracemalloc.stop()
+        record['error'] = f"{type(e).__name__}: {e}"
+        return record
+
+    median = float(np.median(times))
+    record.update({'times_s': times, 'median_s': median, 'min_s': min(times),
+                   'frames_per_s': len(df) / median if median > 0 else None,
+                   'peak_memory_bytes': peak})
+    return record
+
+
+def scaling_summary(results):
+    """frames/s against n_frames, and the log-log slope of time, per variant and stage."""
+    summary = {}
+    for variant in dict.fromkeys(r['variant'] for r in results):
+        summary[variant] = {}
+        for stage in STAGES:
+            rows = sorted((r for r in results
+                           if r['variant'] == variant and r['stage'] == stage and 'error' not in r),
+                          key=lambda r: r['n_frames'])
+            if not rows:
+                continue
+            entry = {'n_frames': [r['n_frames'] for r in rows],
+                     'frames_per_s': [r['frames_per_s'] for r in rows],
+                     'peak_memory_bytes': [r['peak_memory_bytes'] for r in rows]}
+            if len(rows) > 1:
+                entry['time_exponent'] = float(np.polyfit(np.log(entry['n_frames']),
+                                                          np.log([r['median_s'] for r in rows]), 1)[0])
+            summary[variant][stage] = entry
+    return summary
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(description='Benchmark the CrashRepair implementations.')
+    parser.add_argument('--out', type=str, required=True, help='Path of the JSON results file.')
+    parser.add_argument('--variants', nargs='+', choices=list(VARIANTS), default=list(VARIANTS))
+    parser.add_argument('--stages', nargs='+', choices=STAGES, default=STAGES)
+    parser.add_argument('--lengths', nargs='+', type=int, default=[3600, 18000, 72000],
+                        help='Frame counts to benchmark (60 Hz: 1, 5 and 20 minutes).')
+    parser.add_argument('--crashes-per-hour', type=float, default=60,
+                        help='Crash rate; every length gets at least one crash.')
+    parser.add_argument('--spacing', type=int, default=300,
+                        help='Minimum number of frames between crashes.')
+    parser.add_argument('--sampling-rate', type=float, default=60)
+    parser.add_argument('--repeats', type=int, default=5)
+    parser.add_argument('--seed', type=int, default=0)
+    return parser.parse_args()
+
+
+def main():
+    args = parse_arguments()
+    classes = {name: load_variant(name) for name in args.variants}
+
+    results = []
+    for n_frames in args.lengths:
+        n_crashes = max(1, round(args.crashes_per_hour * n_frames / args.sampling_rate / 3600))
+        df = make_tracking_frame(n_frames, n_crashes, args.spacing, args.sampling_rate, seed=args.seed)
+        for name, cls in classes.items():
+            for stage in args.stages:
+                # The original implementations use chained assignment and
+                # other deprecated pandas patterns
+                with warnings.catch_warnings():
+                    warnings.simplefilter('ignore')
+                    record = benchmark_stage(cls, stage, df, args.repeats)
+                record.update({'variant': name, 'n_crashes': n_crashes, 'spacing': args.spacing})
+                results.append(record)
+                if 'error' in record:
+                    print(f"{name:20} {stage:20} {n_frames:8d}  {record['error']}")
+                else:
+                    print(f"{name:20} {stage:20} {n_frames:8d}  {record['median_s'] * 1000:9.2f} ms "
+                          f"{record['frames_per_s']:12.0f} frames/s "
+                          f"{record['peak_memory_bytes'] / 1e6:8.1f} MB")
+
+    output = {
+        'meta': {'timestamp': datetime.now().isoformat(timespec='seconds'),
+                 'python': sys.version.split()[0], 'numpy': np.__version__,
+                 'pandas': pd.__version__, 'scipy': scipy.__version__,
+                 'platform': platform.platform(), 'processor': platform.processor(),
+                 'settings': vars(args)},
+        'results': results,
+        'scaling': scaling_summary(results),
+    }
+    Path(args.out).parent.mkdir(parents=True, exist_ok=True)
+    with open(args.out, 'w') as f:
+        json.dump(output, f, indent=1)
+    print(f"Results: {args.out}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,492 @@
+"""
+Per-sample IRT from a banded DTW, a Python port of compute_irt_parallel.jl.
+
+For every sample i of stim_pos the IRT is the mean index of the user_pos
+samples the warping path matches to it, minus i, in seconds:
+
+    irt[i] = (mean(j for (i, j) in path) - i) / sampling_rate
+
+which is what the Julia script's get_row / get_point_rt loop computes (its
+path DataFrame labels the stim index `user`). Here the path is reduced with a
+single bincount instead of one scan of the path per sample.
+
+The DTW is exact within a band of `radius` samples around the diagonal
+(Sakoe-Chiba). fastdtw's band follows the path projected from a coarser
+resolution instead, so the two can differ where the path wanders further than
+`radius` from the diagonal. Ties prefer the diagonal step, then stim, then user.
+Costs are the squared differences, computed one cell at a time. The Julia
+script's SqEuclidean(thresh) tolerance only steers when Distances.jl
+recomputes a pairwise distance it obtained through its faster expansion, so
+it has no counterpart here.
+
+banded_dtw keeps one byte per band cell to trace the path back. For long
+sessions streaming_dtw_irt computes the same IRT keeping only the two most
+recent anti-diagonals plus a checkpoint of them every sqrt(#diagonals), and
+never stores the path (see its docstring).
+
+Instead of paying for radius 120 everywhere, adaptive_dtw starts from a
+narrow band and widens it only in the regions where the path runs along the
+band's edge (see its docstring). process_file writes the radius per region
+and the number of cells evaluated to <destination>/<name>_dtw.json.
+
+With --workers, files are handed to a process pool longest first (by a row
+count estimated from the file size), and each idle worker takes the next
+file, so one long session doesn't leave the other workers waiting at the
+end. With --report, the status and timing of every file go to a CSV at that
+path; keep it out of the destination folder, whose *.csv are participant files.
+
+Usage:
+    python compute_irt.py <source_folder> <destination_folder> [--radius 120]
+                          [--streaming | --adaptive [--initial-radius 8]] [--workers 4]
+                          [--report irt_report.csv]
+"""
+import argparse
+import csv
+import json
+import math
+import os
+import time
+import traceback
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+RADIUS = 120
+SAMPLING_RATE = 60
+INITIAL_RADIUS = 8
+REGION_LENGTH = 600
+
+
+def load_cpCST_csv(file_path):
+    """
+    Read a repaired tracking CSV the way compute_irt_parallel.jl does.
+
+    Missing positions are forward filled, user_pos is flipped back to the
+    tracking sign and time_secs is added.
+
+    :param file_path: Path to a CSV written by reproc_cpCST.
+    :return: DataFrame.
+    """
+    df = pd.read_csv(file_path)
+    df['user_pos'] = df['user_pos'].ffill()
+    df['stim_pos'] = df['stim_pos'].ffill()
+    df['user_pos'] = df['user_pos'] * -1
+    df['time_secs'] = df['flip_time'] - df['flip_time'].iloc[0]
+    return df
+
+
+def sakoe_chiba_band(n, m, radius):
+    """
+    Band of `radius` cells on either side of the diagonal of an n x m cost matrix.
+
+    :param radius: A single radius, or one per row of the matrix.
+    :return: (lo, hi) arrays; row i of the band spans columns lo[i]..hi[i].
+    """
+    center = np.arange(n) * ((m - 1) / (n - 1) if n > 1 else 0)
+    lo = np.clip(np.ceil(center - radius), 0, m - 1).astype(np.int64)
+    hi = np.clip(np.floor(center + radius), 0, m - 1).astype(np.int64)
+    # With a radius per row, widen rather than narrow to keep both edges
+    # non-decreasing
+    lo = np.minimum.accumulate(lo[::-1])[::-1]
+    hi = np.maximum.accumulate(hi)
+    hi[-1] = m - 1
+    # Keep consecutive rows touching when the diagonal is steeper than the band
+    hi[:-1] = np.maximum(hi[:-1], lo[1:] - 1)
+    return lo, hi
+
+
+def band_diagonals(lo, hi):
+    """
+    First and last row of the band on each anti-diagonal i + j = k.
+
+    lo and hi must be non-decreasing with lo[0] == 0 and hi[-1] == m - 1, and
+    consecutive rows must overlap or touch, so the band is connected.
+
+    :return: (i_first, i_last) arrays with one entry per anti-diagonal.
+    """
+    rows = np.arange(len(lo))
+    diagonals = np.arange(len(lo) + hi[-1])
+    i_first = np.searchsorted(rows + hi, diagonals, side='left')
+    i_last = np.searchsorted(rows + lo, diagonals, side='right') - 1
+    return i_first, i_last
+
+
+def _predecessor(values, first, rows):
+    """values[row - first] for each row, inf outside the stored range."""
+    padded = np.empty(len(values) + 2)
+    padded[0] = padded[-1] = np.inf
+    padded[1:-1] = values
+    return padded[np.clip(rows - first + 1, 0, len(values) + 1)]
+
+
+def _diagonal(a, b, k, i_first, i_last, previous):
+    """
+    Costs and steps of anti-diagonal k from the two before it.
+
+    :param previous: ((values, first row) of diagonal k-2, same for k-1).
+    :return: (accumulated costs, step codes) for rows i_first..i_last.
+    """
+    i = np.arange(i_first, i_last + 1)
+    cost = (a[i] - b[k - i]) ** 2
+    if k == 0:
+        return cost, np.zeros(1, dtype=np.int8)
+    (prev2, first2), (prev1, first1) = previous
+    # 0: diagonal from (i-1, j-1), 1: from (i-1, j), 2: from (i, j-1)
+    best = _predecessor(prev2, first2, i - 1)
+    step = np.zeros(len(i), dtype=np.int8)
+    for code, candidate in ((1, _predecessor(prev1, first1, i - 1)),
+                            (2, _predecessor(prev1, first1, i))):
+        better = candidate < best
+        best = np.where(better, candidate, best)
+        step[better] = code
+    return cost + best, step
+
+
+def _trace_back(steps, offsets, i_first, k, i, k_stop):
+    """
+    Follow the stored steps from cell (k, i) back to the first cell on a
+    diagonal below k_stop (or to (0, 0)).
+
+    :param steps: Step codes of diagonals k_stop..k, concatenated.
+    :param offsets: Start of each of those diagonals in steps.
+    :param i_first: First band row of each of those diagonals.
+    :return: (path_i, path_j) of the cells visited on diagonals >= k_stop, in
+             reverse order, and the (k, i) the walk stopped at.
+    """
+    path_i, path_j = [], []
+    while k >= k_stop:
+        path_i.append(i)
+        path_j.append(k - i)
+        if k == 0:
+            k = -1
+            break
+        step = steps[offsets[k - k_stop] + i - i_first[k - k_stop]]
+        if step == 0:
+            k, i = k - 2, i - 1
+        elif step == 1:
+            k, i = k - 1, i - 1
+        else:
+            k = k - 1
+    return path_i, path_j, k, i
+
+
+def banded_dtw(a, b, lo, hi):
+    """
+    DTW of a against b with squared-difference costs, restricted to a band.
+
+    Anti-diagonals are filled one at a time, each from the two before it, so
+    each step is a vectorized pass over at most the band width. The step taken
+    into every cell is kept (one byte per cell) to trace the path back.
+
+    :param a: 1D array, indexed by the path's first coordinate (stim).
+    :param b: 1D array, indexed by the path's second coordinate (user).
+    :param lo: First column of the band in each row (see sakoe_chiba_band).
+    :param hi: Last column of the band in each row.
+    :return: (total cost, path_i, path_j) with the path from (0, 0) to (n-1, m-1).
+    """
+    a = np.asarray(a, dtype=float)
+    b = np.asarray(b, dtype=float)
+    i_first, i_last = band_diagonals(lo, hi)
+    offsets = np.concatenate([[0], np.cumsum(i_last - i_first + 1)])
+    steps = np.empty(offsets[-1], dtype=np.int8)
+
+    previous = ((np.empty(0), 0), (np.empty(0), 0))
+    for k in range(len(i_first)):
+        cur, steps[offsets[k]:offsets[k + 1]] = _diagonal(a, b, k, i_first[k], i_last[k],
+                                                          previous)
+        previous = (previous[1], (cur, i_first[k]))
+
+    path_i, path_j, _, _ = _trace_back(steps, offsets.tolist(), i_first.tolist(),
+                                       len(i_first) - 1, len(a) - 1, 0)
+    return previous[1][0][-1], np.array(path_i[::-1]), np.array(path_j[::-1])
+
+
+def streaming_dtw_irt(a, b, lo, hi, sampling_rate=SAMPLING_RATE, checkpoint_every=None):
+    """
+    Same IRT as path_irt(banded_dtw(...)) without storing the band or the path.
+
+    The forward pass keeps only the last two anti-diagonals, saving them every
+    `checkpoint_every` diagonals. The path is then recovered one segment at a
+    time from the end: the segment's steps are recomputed from its checkpoint,
+    the walk through it is added to the per-row sums of j, and both are
+    dropped. Memory is O((K / checkpoint_every + checkpoint_every) * band)
+    for K = n + m - 1 diagonals instead of O(K * band), for about twice the
+    arithmetic.
+
+    :param a: 1D array, indexed by the path's first coordinate (stim).
+    :param b: 1D array, indexed by the path's second coordinate (user).
+    :param lo: First column of the band in each row (see sakoe_chiba_band).
+    :param hi: Last column of the band in each row.
+    :param sampling_rate: Samples per second used to convert indices to seconds.
+    :param checkpoint_every: Diagonals per segment. Defaults to sqrt(K).
+    :return: (total cost, 1D array of IRT per sample of a)
+    """
+    a = np.asarray(a, dtype=float)
+    b = np.asarray(b, dtype=float)
+    i_first, i_last = band_diagonals(lo, hi)
+    n_diagonals = len(i_first)
+    segment = checkpoint_every or max(1, math.isqrt(n_diagonals))
+
+    checkpoints = []
+    previous = ((np.empty(0), 0), (np.empty(0), 0))
+    for k in range(n_diagonals):
+        if k % segment == 0:
+            checkpoints.append(previous)
+        cur, _ = _diagonal(a, b, k, i_first[k], i_last[k], previous)
+        previous = (previous[1], (cur, i_first[k]))
+    total_cost = previous[1][0][-1]
+
+    sums = np.zeros(len(a))
+    counts = np.zeros(len(a))
+    k, i = n_diagonals - 1, len(a) - 1
+    for start in reversed(range(0, n_diagonals, segment)):
+        stop = min(start + segment, n_diagonals)
+        widths = i_last[start:stop] - i_first[start:stop] + 1
+        offsets = np.concatenate([[0], np.cumsum(widths)])
+        steps = np.empty(offsets[-1], dtype=np.int8)
+        previous = checkpoints[start // segment]
+        for d, kk in enumerate(range(start, stop)):
+            cur, steps[offsets[d]:offsets[d + 1]] = _diagonal(a, b, kk, i_first[kk], i_last[kk],
+                                                              previous)
+            previous = (previous[1], (cur, i_first[kk]))
+        path_i, path_j, k, i = _trace_back(steps, offsets.tolist(),
+                                           i_first[start:stop].tolist(), k, i, start)
+        sums += np.bincount(path_i, weights=path_j, minlength=len(a))
+        counts += np.bincount(path_i, minlength=len(a))
+    return total_cost, (sums / counts - np.arange(len(a))) / sampling_rate
+
+
+def adaptive_dtw(a, b, initial_radius=INITIAL_RADIUS, max_radius=RADIUS,
+                 region_length=REGION_LENGTH):
+    """
+    Banded DTW that widens the band only where it constrains the path.
+
+    The rows of the cost matrix are split into regions of `region_length`
+    samples, all starting at `initial_radius`. After each DTW, every region
+    in which the path touches the edge of the band (other than the edge of the
+    matrix) has its radius doubled, up to `max_radius`, and the DTW is run
+    again. This stops once the path stays strictly inside the band, or every
+    region it touches is at `max_radius`.
+
+    `cells` is what the band costs a cell-by-cell kernel. The NumPy kernel
+    here spends most of its time on per-diagonal overhead, so its run time
+    follows the number of passes more than the number of cells.
+
+    :param a: 1D array, indexed by the path's first coordinate (stim).
+    :param b: 1D array, indexed by the path's second coordinate (user).
+    :param initial_radius: Starting half-width of the band, in samples.
+    :param max_radius: Largest half-width any region may grow to.
+    :param region_length: Rows of the cost matrix per region.
+    :return: (total cost, path_i, path_j, info) where info holds the final
+             `region_radius` list, the `cells` evaluated over all passes, the
+             number of `passes` and whether the band `converged`.
+    """
+    n, m = len(a), len(b)
+    region_radius = np.full(max(1, math.ceil(n / region_length)),
+                            min(initial_radius, max_radius), dtype=np.int64)
+    cells = 0
+    passes = 0
+    while True:
+        lo, hi = sakoe_chiba_band(n, m, np.repeat(region_radius, region_length)[:n])
+        cost, path_i, path_j = banded_dtw(a, b, lo, hi)
+        cells += int((hi - lo + 1).sum())
+        passes += 1
+
+        on_edge = (((path_j == lo[path_i]) & (lo[path_i] > 0))
+                   | ((path_j == hi[path_i]) & (hi[path_i] < m - 1)))
+        constrained = np.zeros(len(region_radius), dtype=bool)
+        constrained[path_i[on_edge] // region_length] = True
+        grow = constrained & (region_radius < max_radius)
+        if not grow.any():
+            break
+        region_radius[grow] = np.minimum(region_radius[grow] * 2, max_radius)
+
+    info = {'region_length': region_length,
+            'region_radius': region_radius.tolist(),
+            'cells': cells,
+            'passes': passes,
+            'converged': not constrained.any()}
+    return cost, path_i, path_j, info
+
+
+def path_irt(path_i, path_j, n, sampling_rate=SAMPLING_RATE):
+    """
+    Mean matched j minus i, in seconds, for every i in 0..n-1.
+
+    :param path_i: First coordinate of the warping path.
+    :param path_j: Second coordinate of the warping path.
+    :param n: Number of samples along the first coordinate.
+    :param sampling_rate: Samples per second used to convert indices to seconds.
+    :return: 1D array of length n.
+    """
+    counts = np.bincount(path_i, minlength=n)
+    mean_j = np.bincount(path_i, weights=path_j, minlength=n) / counts
+    return (mean_j - np.arange(n)) / sampling_rate
+
+
+def compute_irt(df, radius=RADIUS, sampling_rate=SAMPLING_RATE,
+                streaming=False, adaptive=False, initial_radius=INITIAL_RADIUS):
+    """
+    Per-sample IRT of a DataFrame loaded with load_cpCST_csv.
+
+    :param df: DataFrame with stim_pos and user_pos.
+    :param radius: Half-width of the DTW band, in samples. The largest
+                   radius adaptive_dtw may grow to when adaptive is set.
+    :param sampling_rate: Samples per second used to convert indices to seconds.
+    :param streaming: Use streaming_dtw_irt, which does not store the band or path.
+    :param adaptive: Use adaptive_dtw, starting from initial_radius.
+    :param initial_radius: Starting radius for adaptive.
+    :return: (1D array with one IRT per row, dict describing the DTW band)
+    """
+    stim = df['stim_pos'].to_numpy(dtype=float)
+    user = df['user_pos'].to_numpy(dtype=float)
+    if adaptive:
+        _, path_i, path_j, info = adaptive_dtw(stim, user, initial_radius, radius)
+        return path_irt(path_i, path_j, len(stim), sampling_rate), info
+
+    lo, hi = sakoe_chiba_band(len(stim), len(user), radius)
+    info = {'radius': radius, 'cells': int((hi - lo + 1).sum())}
+    if streaming:
+        # The forward pass is repeated once segment by segment
+        info['cells'] *= 2
+        return streaming_dtw_irt(stim, user, lo, hi, sampling_rate)[1], info
+    _, path_i, path_j = banded_dtw(stim, user, lo, hi)
+    return path_irt(path_i, path_j, len(stim), sampling_rate), info
+
+
+def process_file(file_path, destination_folder, radius=RADIUS,
+                 streaming=False, adaptive=False, initial_radius=INITIAL_RADIUS):
+    start = time.perf_counter()
+    df = load_cpCST_csv(file_path)
+    df['irt'], info = compute_irt(df, radius, streaming=streaming,
+                                  adaptive=adaptive, initial_radius=initial_radius)
+    dest_file = Path(destination_folder) / Path(file_path).name
+    df.to_csv(dest_file, index=False)
+
+    info.update({'file_path': str(file_path), 'n_samples': len(df),
+                 'seconds': round(time.perf_counter() - start, 3)})
+    with open(dest_file.with_name(dest_file.stem + "_dtw.json"), 'w') as f:
+        json.dump(info, f, indent=1)
+    return dest_file, info
+
+
+def estimate_rows(file_path, sample_bytes=1 << 16):
+    """
+    Rows in a CSV, from its size and the mean line length of its first 64 KB.
+
+    :param file_path: Path to the CSV.
+    :param sample_bytes: Bytes read from the start of the file.
+    :return: Estimated number of data rows (exact for files smaller than sample_bytes).
+    """
+    size = os.path.getsize(file_path)
+    with open(file_path, 'rb') as f:
+        head = f.read(sample_bytes)
+    n_lines = head.count(b'\n')
+    if len(head) == size or n_lines == 0:
+        return max(0, n_lines - 1)
+    return int(size * n_lines / len(head)) - 1
+
+
+def longest_first(file_paths):
+    """:return: file_paths sorted by estimated row count, largest first."""
+    return sorted(file_paths, key=estimate_rows, reverse=True)
+
+
+def _run_job(file_path, destination_folder, kwargs):
+    result = {'file_path': str(file_path), 'status': 'ok', 'error': '',
+              'n_samples': None, 'cells': None}
+    start = time.perf_counter()
+    try:
+        _, info = process_file(file_path, destination_folder, **kwargs)
+        result.update({'n_samples': info['n_samples'], 'cells': info['cells']})
+    except Exception as e:
+        result['status'] = 'failed'
+        result['error'] = f"{type(e).__name__}: {e}"
+        traceback.print_exc()
+    result['seconds'] = round(time.perf_counter() - start, 3)
+    return result
+
+
+def run_files(file_paths, destination_folder, workers=1, **kwargs):
+    """
+    Yield _run_job results as files finish, longest files started first.
+
+    :param file_paths: CSVs to process.
+    :param destination_folder: Output folder.
+    :param workers: Number of worker processes. 1 processes files in this process.
+    :param kwargs: Passed to process_file.
+    """
+    file_paths = longest_first(file_paths)
+    if workers == 1:
+        for file_path in file_paths:
+            yield _run_job(file_path, destination_folder, kwargs)
+        return
+
+    # Workers pull the next queued job as soon as they are free, so with the
+    # longest jobs queued first the pool finishes close to together
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = [executor.submit(_run_job, file_path, destination_folder, kwargs)
+                   for file_path in file_paths]
+        for future in as_completed(futures):
+            yield future.result()
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("source_folder", type=str,
+                        help="Path to the source folder containing CSV files")
+    parser.add_argument("destination_folder", type=str,
+                        help="Path to the destination folder to save processed CSV files")
+    parser.add_argument("--radius", type=int, default=RADIUS, required=False,
+                        help="Half-width of the DTW band, in samples.")
+    mode = parser.add_mutually_exclusive_group()
+    mode.add_argument("--streaming", action="store_true", required=False,
+                      help="DTW that never stores the warping path, keeping a checkpoint every "
+                           "sqrt(#diagonals): O(sqrt(#diagonals) * band) memory for about twice the "
+                           "arithmetic.")
+    mode.add_argument("--adaptive", action="store_true", required=False,
+                      help="Start from --initial-radius and widen the band up to --radius "
+                           "only where the path reaches its edge.")
+    parser.add_argument("--initial-radius", type=int, default=INITIAL_RADIUS, required=False)
+    parser.add_argument("--workers", type=int, default=1, required=False,
+                        help="Number of worker processes. 1 processes files in this process.")
+    parser.add_argument("--report", type=str, default=None, required=False,
+                        help="Path of a CSV report with the status and timing of every file. "
+                             "Keep it outside destination_folder.")
+    return parser.parse_args()
+
+
+def main():
+    args = parse_arguments()
+    destination_folder = Path(args.destination_folder)
+    destination_folder.mkdir(parents=True, exist_ok=True)
+    file_paths = sorted(Path(args.source_folder).glob("*.csv"))
+    workers = max(1, min(args.workers, len(file_paths)))
+
+    start = time.perf_counter()
+    results = []
+    for result in run_files(file_paths, destination_folder, workers,
+                            radius=args.radius, streaming=args.streaming,
+                            adaptive=args.adaptive, initial_radius=args.initial_radius):
+        results.append(result)
+        print(f"[{len(results)}/{len(file_paths)}] {result['status']:6} {result['seconds']:8.1f}s "
+              f"{result['file_path']} {result['error']}")
+
+    if args.report:
+        results.sort(key=lambda r: r['file_path'])
+        with open(args.report, 'w', newline='') as f:
+            writer = csv.DictWriter(f, fieldnames=['file_path', 'status', 'n_samples', 'cells',
+                                                   'seconds', 'error'])
+            writer.writeheader()
+            writer.writerows(results)
+
+    n_failed = sum(r['status'] != 'ok' for r in results)
+    print(f"{len(results) - n_failed} succeeded, {n_failed} failed in "
+          f"{time.perf_counter() - start:.1f}s on {workers} workers.")
+    return n_failed == 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(0 if main() else 1)
@@ -1,15 +1,63 @@
 import pandas as pd
 import numpy as np
 from glob import glob
-from scipy.signal import detrend
+from scipy import linalg
 import argparse
+import json
+import sys
+import traceback
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
 from pathlib import Path
-from CrashRepair import CrashRepair
-import matplotlib.pyplot as plt
+from CrashRepair import CrashRepair, init_plot_worker, render_repair_plots
+from stream_cpCST import stream_features
+from tracking_features import FEATURE_COLUMNS, derive_features
+from stage_metrics import StageMetrics, summarize
+
+# processing_cache lives at the repository root, shared with the EEG scripts
+sys.path.append(str(Path(__file__).resolve().parent.parent))
+from processing_cache import ProcessingCache, code_version
 
 def zscale(series):
     return (series - series.mean()) / series.std()
 
+def normalize_columns(df, detrend_vectors, zscale_vectors, dtype=np.float64):
+    """Detrend and/or z-scale every numeric or bool column except flip_time, in place.
+
+    The columns are stacked once into a column-major 2D array, processed
+    along axis 0 and written back in one assignment. In float64 the result is
+    bit-identical to scipy.signal.detrend and zscale applied column by
+    column: the linear fit shares one design matrix but is solved per column
+    (a multi-column lstsq rounds differently), and the column-major layout
+    keeps NumPy's pairwise summation per column, as pandas uses.
+    dtype=np.float32 halves the working memory at single precision.
+    """
+    # bool columns too: scipy's detrend and zscale treat them as 0/1 floats
+    cols = [col for col in df.select_dtypes(["number", "bool"]).columns if col != "flip_time"]
+    if not cols or not (detrend_vectors or zscale_vectors):
+        return df
+    # Always a copy: to_numpy can return a read-only view of the frame
+    values = np.array(df[cols].to_numpy(dtype=dtype), order="F")
+    n = len(values)
+
+    if detrend_vectors:
+        # Same design matrix as scipy.signal.detrend(type='linear')
+        A = np.ones((n, 2), dtype=dtype)
+        A[:, 0] = np.arange(1, n + 1, dtype=dtype) / n
+        for k in range(values.shape[1]):
+            coef = linalg.lstsq(A, values[:, k:k + 1])[0]
+            values[:, k:k + 1] -= A @ coef
+
+    if zscale_vectors:
+        # pandas: mean = sum / n, std = sqrt(sum((mean - x) ** 2) / (n - 1))
+        mean = values.sum(axis=0) / n
+        std = np.sqrt(((mean - values) ** 2).sum(axis=0) / (n - 1))
+        values -= mean
+        values /= std
+
+    df[cols] = values
+    return df
+
 def get_ursi(filpath:str):
     fname = filpath.split('/')[-1]
     ursi = fname.split('_')[0].split('-')[-1]
@@ -21,7 +69,32 @@ def parse_arguments():
     parser.add_argument("--output_path", type=str, required=True)
     parser.add_argument("--zscale_vectors", action="store_true", required=False)
     parser.add_argument("--detrend_vectors", action="store_true", required=False)
-    return parser.parse_args()
+    parser.add_argument("--force", action="store_true", required=False,
+                        help="Reprocess every file, ignoring the processing cache.")
+    parser.add_argument("--workers", type=int, default=1, required=False,
+                        help="Number of worker processes. 1 processes files in this process.")
+    parser.add_argument("--float32", action="store_true", required=False,
+                        help="Detrend and z-scale in single precision. Not available with --chunksize.")
+    parser.add_argument("--chunksize", type=int, default=None, required=False,
+                        help="Stream each file in chunks of this many rows, in constant memory. "
+                             "No repair plot is saved in this mode.")
+    parser.add_argument("--plots", choices=["none", "first", "all"], default="first", required=False,
+                        help="Crash repair figures to save: none, the first crash segment of each "
+                             "file (the default) or every segment. Rendered in the background.")
+    parser.add_argument("--plot-workers", type=int, default=1, required=False,
+                        help="Number of background processes rendering figures.")
+    parser.add_argument("--metrics", type=str, default=None, required=False,
+                        help="JSON lines file the per-file stage metrics are appended to. "
+                             "Defaults to <output_path>/process_metrics.jsonl.")
+    parser.add_argument("--metrics-summary", type=str, default=None, required=False,
+                        help="Also write a cohort summary (percentiles per stage) of this run to this JSON file.")
+    parser.add_argument("--trace-allocations", action="store_true", required=False,
+                        help="Measure per-stage peaks with tracemalloc instead of the RSS high-water mark (slower).")
+    args = parser.parse_args()
+    if args.float32 and args.chunksize:
+        # The streamed features are spooled and normalized in float64
+        parser.error("--float32 can't be combined with --chunksize")
+    return args
 
 def compute_velocity(df, target_col):
     df[f"{target_col}_vel"] = df[target_col].diff().fillna(0) * df['flip_time'].diff().fillna(0) * 1000
@@ -35,61 +108,134 @@ def compute_velocity(df, target_col):
 #     })
 #     return resampled_data
 
-def process_file(file_path, output_path, detrend_vectors, zscale_vectors):
-    try:
-        df = pd.read_csv(file_path)
-        ursi = get_ursi(str(file_path))
-        crash_count = df.crash_count.max()
-        with open("crash_count.csv",'a') as f:
-            f.write(f"{ursi},{crash_count}\n")
-
-        df.user_pos = df.user_pos * -1
-        cr = CrashRepair(df)
-        cr.set_target_max_position() # Set the reset value for crash repair based 
-                                    # on the user's data distribution.
-        repaired_df = cr.repair_tracking()
-        if df.crash_count.max() > 0:
-            fig = cr.plot_repair(repaired_df, segment_index=0)
-            if fig is not None:
-                fig.savefig(output_path / file_path.name.replace(".csv", "_repaired.png"))
-                plt.close()
-            else:
-                print("No crash report generated")
-        df = repaired_df
-        df["tracking"] = df.user_pos - df.stim_pos
-        df["covary"] = np.abs(df.user_pos) - np.abs(df.stim_pos)
-        df["abs_tracking"] = np.abs(df.tracking)
-        df["abs_covary"] = np.abs(df.covary)
+def output_filename(file_path, detrend_vectors, zscale_vectors):
+    # Annotate filename with tags
+    filename = file_path.name.replace(".csv", "")
+    if detrend_vectors:
+        filename += "_detrend"
+    if zscale_vectors:
+        filename += "_zscale"
+    return filename + ".csv"
+
+def plot_fpath(output_path, file_path, segment_index):
+    suffix = "_repaired.png" if segment_index == 0 else f"_repaired_{segment_index}.png"
+    return output_path / file_path.name.replace(".csv", suffix)
+
+def process_file(file_path, output_path, detrend_vectors, zscale_vectors, chunksize=None,
+                 trace_allocations=False, plots="first", float32=False):
+    """Repair and featurize one tracking CSV.
 
-        for col in ["user_pos", "stim_pos", "tracking"]:
-            compute_velocity(df, col)
+    Nothing is appended to the shared log files here so that workers can run
+    concurrently; the returned record holds the participant's crash count,
+    the files written, the per-stage metrics and, on failure, the traceback,
+    and main merges them.
 
-        if detrend_vectors:
-            for col in df.columns:
-                if col != "flip_time":
-                    df[col] = detrend(df[col])
+    Figures are not drawn here: for plots="first" or "all" the record holds
+    one repair_plot_spec for the file and the image path of each of its
+    windows, which main hands to a plotting pool.
 
-        if zscale_vectors:
-            for col in df.columns:
-                if col != "flip_time":
-                    df[col] = zscale(df[col])
+    With chunksize set the file goes through stream_cpCST instead, which
+    never holds more than a chunk plus a repair window in memory, and no
+    figures are made.
+    """
+    result = {"file_path": file_path, "ursi": get_ursi(str(file_path)),
+              "crash_count": None, "outputs": [], "plot_spec": None, "plots": [], "error": None}
+    metrics = StageMetrics(trace_allocations)
+    if chunksize:
+        try:
+            with metrics.stage("stream_repair_features") as stage:
+                crash_count, n_repaired, spool = stream_features(file_path, chunksize=chunksize)
+                stage.rows = spool.n_rows
+            result["crash_count"] = crash_count
+            metrics.count("crash_segments_repaired", n_repaired)
+            try:
+                out_fpath = output_path / output_filename(file_path, detrend_vectors, zscale_vectors)
+                with metrics.stage("normalize_to_csv", rows=spool.n_rows):
+                    spool.write_features(out_fpath, detrend_vectors, zscale_vectors)
+            finally:
+                spool.close()
+            result["outputs"].append(out_fpath)
+        except Exception:
+            result["error"] = traceback.format_exc()
+        result["metrics"] = metrics.to_dict()
+        return result
+    try:
+        with metrics.stage("read_csv") as stage:
+            df = pd.read_csv(file_path)
+            stage.rows = len(df)
+        result["crash_count"] = df.crash_count.max()
+
+        with metrics.stage("repair_tracking") as stage:
+            df.user_pos = df.user_pos * -1
+            cr = CrashRepair(df)
+            cr.set_target_max_position() # Set the reset value for crash repair based 
+                                        # on the user's data distribution.
+            repaired_df = cr.repair_tracking()
+            stage.rows = len(repaired_df)
+        metrics.count("crash_segments", len(cr.find_crash_segments()))
+        metrics.count("crash_segments_repaired", cr.segments_repaired)
+        if df.crash_count.max() > 0 and plots != "none":
+            with metrics.stage("plot_specs"):
+                n_plots = 1 if plots == "first" else len(cr.find_crash_segments())
+                spec = cr.repair_plot_spec(repaired_df, range(n_plots))
+                if spec is not None:
+                    result["plot_spec"] = spec
+                    result["plots"] = [plot_fpath(output_path, file_path, window["segment_index"])
+                                       for window in spec["windows"]]
+                else:
+                    print("No crash report generated")
+        df = repaired_df
+        with metrics.stage("features", rows=len(df)):
+            # tracking, covary, their absolute values and the velocities,
+            # in one preallocated column-major block
+            features = derive_features(df.flip_time.to_numpy(dtype=float),
+                                       df.stim_pos.to_numpy(dtype=float),
+                                       df.user_pos.to_numpy(dtype=float))
+            extra = df.columns.difference(FEATURE_COLUMNS, sort=False)
+            df_features = pd.DataFrame(features, columns=FEATURE_COLUMNS, index=df.index)
+            df = df_features if extra.empty else pd.concat([df_features, df[extra]], axis=1)
+
+        if detrend_vectors or zscale_vectors:
+            with metrics.stage("normalize", rows=len(df)):
+                normalize_columns(df, detrend_vectors, zscale_vectors,
+                                  np.float32 if float32 else np.float64)
 
         # df = resample_data(df)
         
-        # Annotate filename with tags
-        filename = file_path.name.replace(".csv", "")
-        if detrend_vectors:
-            filename += "_detrend"
-        if zscale_vectors:
-            filename += "_zscale"
-        filename += ".csv"
+        filename = output_filename(file_path, detrend_vectors, zscale_vectors)
         
-        df.user_pos = df.user_pos * -1
-        df.to_csv(output_path / filename, index=False)
-    except:
-        print(f"err:{file_path}")
-        with open("errs.log", 'a') as f:
-            f.write(f"{file_path}\n")
+        with metrics.stage("to_csv", rows=len(df)):
+            df.user_pos = df.user_pos * -1
+            df.to_csv(output_path / filename, index=False)
+        result["outputs"].append(output_path / filename)
+    except Exception:
+        result["error"] = traceback.format_exc()
+    result["metrics"] = metrics.to_dict()
+    return result
+
+def run_files(file_paths, output_path, detrend_vectors, zscale_vectors, workers=1, chunksize=None,
+              trace_allocations=False, plots="first", float32=False):
+    """Yield process_file results in input order.
+
+    With several workers, at most 2 * workers files are in flight at once so
+    finished results don't pile up behind a slow file.
+    """
+    if workers == 1:
+        for file_path in file_paths:
+            yield process_file(file_path, output_path, detrend_vectors, zscale_vectors, chunksize,
+                               trace_allocations, plots, float32)
+        return
+
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        in_flight = deque()
+        for file_path in file_paths:
+            in_flight.append(executor.submit(process_file, file_path, output_path,
+                                             detrend_vectors, zscale_vectors, chunksize,
+                                             trace_allocations, plots, float32))
+            if len(in_flight) >= 2 * workers:
+                yield in_flight.popleft().result()
+        while in_flight:
+            yield in_flight.popleft().result()
 
 def main():
     args = parse_arguments()
@@ -97,9 +243,74 @@ def main():
     output_path = Path(args.output_path)
     output_path.mkdir(parents=True, exist_ok=True)
 
-    for file_path in base_path.glob("*.csv"):
-        print(file_path)
-        process_file(file_path, output_path, args.detrend_vectors, args.zscale_vectors)
+    # Everything that changes the output; the code version covers the repair
+    # and feature code itself.
+    params = {"detrend_vectors": args.detrend_vectors, "zscale_vectors": args.zscale_vectors,
+              "sampling_rate": 30, "window_size": 3.0, "target_max_position": "p99",
+              "resample_frequency": 30, "chunksize": args.chunksize, "plots": args.plots,
+              "float32": args.float32}
+    cache = ProcessingCache(output_path, params,
+                            code_version(__file__, Path(__file__).with_name("CrashRepair.py"),
+                                         Path(__file__).with_name("stream_cpCST.py")))
+
+    file_paths = []
+    for file_path in sorted(base_path.glob("*.csv")):
+        if not args.force and cache.is_fresh(file_path):
+            print(f"{file_path} (unchanged, skipped)")
+        else:
+            file_paths.append(file_path)
+
+    crash_counts = []
+    errors = []
+    metrics = []
+    metrics_file = open(args.metrics or output_path / "process_metrics.jsonl", 'a')
+    # Figures render in the background while the next files are processed
+    plot_pool = None
+    if args.plots != "none" and not args.chunksize:
+        plot_pool = ProcessPoolExecutor(max_workers=args.plot_workers, initializer=init_plot_worker)
+    plot_jobs = deque()
+    try:
+        for i, result in enumerate(run_files(file_paths, output_path, args.detrend_vectors,
+                                             args.zscale_vectors, args.workers, args.chunksize,
+                                             args.trace_allocations, args.plots, args.float32)):
+            print(f"[{i + 1}/{len(file_paths)}] {result['file_path']}")
+            metrics.append(result["metrics"])
+            metrics_file.write(json.dumps({"file_path": str(result["file_path"]), "ursi": result["ursi"],
+                                           "status": "ok" if result["error"] is None else "failed",
+                                           "crash_count": result["crash_count"],
+                                           **result["metrics"]}, default=int) + "\n")
+            metrics_file.flush()
+            if result["crash_count"] is not None:
+                crash_counts.append(f"{result['ursi']},{result['crash_count']}\n")
+            if result["plot_spec"] is not None:
+                plot_jobs.append((result["file_path"], plot_pool.submit(
+                    render_repair_plots, result["plot_spec"], result["plots"])))
+            if result["error"] is None:
+                cache.record(result["file_path"], result["outputs"] + result["plots"])
+            else:
+                print(f"err:{result['file_path']}: {result['error'].strip().splitlines()[-1]}")
+                errors.append(f"{result['file_path']}\n")
+    finally:
+        if plot_pool is not None:
+            print(f"Waiting for the figures of {len(plot_jobs)} files")
+            while plot_jobs:
+                file_path, job = plot_jobs.popleft()
+                try:
+                    job.result()
+                except Exception as e:
+                    print(f"err:{file_path} figures: {type(e).__name__}: {e}")
+            plot_pool.shutdown()
+        metrics_file.close()
+        if args.metrics_summary:
+            with open(args.metrics_summary, 'w') as f:
+                json.dump(summarize(metrics), f, indent=1)
+        cache.save()
+        # Merge the per-file results into the shared logs in one write each
+        with open("crash_count.csv", 'a') as f:
+            f.writelines(crash_counts)
+        if errors:
+            with open("errs.log", 'a') as f:
+                f.writelines(errors)
 
 if __name__ == "__main__":
     main()
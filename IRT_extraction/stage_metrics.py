@@ -0,0 +1,170 @@
+"""
+Per-stage timing and memory for the cpCST processing scripts.
+
+    metrics = StageMetrics()
+    with metrics.stage("read_csv") as s:
+        df = pd.read_csv(file_path)
+        s.rows = len(df)
+    ...
+    record = metrics.to_dict()
+
+Each stage records its wall time, an optional row count and the peak memory
+reached while it ran. By default the peak is the process's resident set
+high-water mark, reset at the start of every stage through
+/proc/self/clear_refs on Linux. That costs two small /proc reads per stage,
+so it can stay on for every file. Where the mark can't be reset it is the
+process's peak so far (ru_maxrss). With trace_allocations=True the peak is
+tracemalloc's instead: exact for Python/NumPy allocations, but several
+times slower.
+
+summarize() turns a list of per-file records into cohort percentiles.
+"""
+import os
+import resource
+import sys
+import time
+import tracemalloc
+from contextlib import contextmanager
+
+import numpy as np
+
+PERCENTILES = [50, 90, 99]
+
+
+def _read_hwm():
+    """VmHWM in bytes, or None where /proc isn't available."""
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return None
+
+
+def _reset_hwm():
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+        return True
+    except OSError:
+        return False
+
+
+def _max_rss():
+    # ru_maxrss is in kilobytes on Linux and bytes on macOS
+    scale = 1 if sys.platform == 'darwin' else 1024
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * scale
+
+
+class _Stage:
+    def __init__(self, name):
+        self.name = name
+        self.rows = None
+        self.seconds = None
+        self.peak_bytes = None
+
+
+class StageMetrics:
+    """Collects one file's stages. Not thread-safe; use one per file."""
+    def __init__(self, trace_allocations=False):
+        """
+        :param trace_allocations: Measure peaks with tracemalloc instead of the RSS high-water mark.
+        """
+        self.trace_allocations = trace_allocations
+        self.memory_source = 'tracemalloc' if trace_allocations else 'rss'
+        self.stages = []
+        self.counts = {}
+        self._start = time.perf_counter()
+
+    @contextmanager
+    def stage(self, name, rows=None):
+        """
+        Time the enclosed block as one stage. Set `.rows` on the yielded
+        object to record how many rows the stage produced.
+        """
+        stage = _Stage(name)
+        stage.rows = rows
+        if self.trace_allocations:
+            tracemalloc.start()
+        elif not _reset_hwm():
+            self.memory_source = 'max_rss'
+        start = time.perf_counter()
+        try:
+            yield stage
+        finally:
+            stage.seconds = time.perf_counter() - start
+            if self.trace_allocations:
+                stage.peak_bytes = tracemalloc.get_traced_memory()[1]
+                tracemalloc.stop()
+            else:
+                stage.peak_bytes = (_read_hwm() if self.memory_source == 'rss' else None) or _max_rss()
+            self.stages.append(stage)
+
+    def count(self, name, value):
+        """Record a per-file count such as the number of crash segments repaired."""
+        self.counts[name] = value
+
+    def to_dict(self):
+        """
+        :return: JSON-serializable record of the stages and counts so far.
+        """
+        return {
+            'total_seconds': round(time.perf_counter() - self._start, 6),
+            'memory_source': self.memory_source,
+            'stages': {s.name: {'seconds': round(s.seconds, 6), 'rows': s.rows,
+                                'peak_bytes': s.peak_bytes}
+                       for s in self.stages},
+            'counts': {k: (v.item() if isinstance(v, np.generic) else v)
+                       for k, v in self.counts.items()},
+            'pid': os.getpid(),
+        }
+
+
+def summarize(records, percentiles=PERCENTILES):
+    """
+    Cohort summary of per-file metric records.
+
+    :param records: Dicts from StageMetrics.to_dict (extra keys are ignored).
+    :param percentiles: Percentiles to report for every stage.
+    :return: Dict with, per stage, the number of files, total seconds and
+             percentiles of seconds and peak bytes, plus totals over files.
+    """
+    stages = {}
+    for record in records:
+        for name, stage in record.get('stages', {}).items():
+            entry = stages.setdefault(name, {'seconds': [], 'peak_bytes': [], 'rows': []})
+            entry['seconds'].append(stage['seconds'])
+            if stage['peak_bytes'] is not None:
+                entry['peak_bytes'].append(stage['peak_bytes'])
+            if stage['rows'] is not None:
+                entry['rows'].append(stage['rows'])
+
+    def pct(values):
+        if not values:
+            return None
+        return {f'p{p}': float(v) for p, v in zip(percentiles, np.percentile(values, percentiles))} | \
+               {'max': float(np.max(values))}
+
+    summary = {'n_files': len(records),
+               'total_seconds': float(sum(r.get('total_seconds', 0) for r in records)),
+               'stages': {}}
+    for name, entry in stages.items():
+        total = float(np.sum(entry['seconds']))
+        summary['stages'][name] = {
+            'n_files': len(entry['seconds']),
+            'total_seconds': total,
+            'share_of_total': total / summary['total_seconds'] if summary['total_seconds'] else None,
+            'seconds': pct(entry['seconds']),
+            'peak_bytes': pct(entry['peak_bytes']),
+            'rows_per_second': (float(np.sum(entry['rows']) / total)
+                                if entry['rows'] and total > 0 else None),
+        }
+    counts = {}
+    for record in records:
+        for name, value in record.get('counts', {}).items():
+            if isinstance(value, (int, float)):
+                counts[name] = counts.get(name, 0) + value
+    summary['counts'] = counts
+    return summary
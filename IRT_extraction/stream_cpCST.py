@@ -0,0 +1,384 @@
+"""
+Chunked, constant-memory version of the reproc_cpCST repair and feature pipeline.
+
+A tracking CSV is read in typed chunks and pushed through three stages that
+each carry only the rows the next chunk still needs:
+
+- StreamingCrashRepair keeps the last 2 * window_frame_count rows, because a
+  crash found in the next chunk can still rewrite (and read) that far back.
+- StreamingResampler keeps the rows bracketing the next output timestamp.
+- derive_features (tracking_features) keeps the previous featurized row for
+  the velocities.
+
+A first pass (scan_tracking) finds the crash count and the exact damping
+target set_target_max_position would use, with |stim_pos| spooled to a
+temporary file. The repaired and resampled values are then identical to
+CrashRepair.repair_tracking on the whole file, as long as flip_time is
+non-decreasing after repair. Detrending and z-scaling need whole-series
+statistics, so featurized rows are spooled to a temporary binary file while
+running sums are kept, and the CSV is written in a last pass. Those
+columns match the in-memory ones to floating point rounding (see
+write_features).
+"""
+import tempfile
+
+import numpy as np
+import pandas as pd
+
+from CrashRepair import CrashRepair
+from tracking_features import FEATURE_COLUMNS, derive_features
+
+TRACKING_DTYPES = {
+    'flip_time': 'float64',
+    'stim_pos': 'float64',
+    'user_pos': 'float64',
+    'crash_count': 'int32',
+    'did_crash': 'bool',
+}
+
+
+def read_tracking_chunks(file_path, chunksize=50_000, columns=None):
+    """
+    Read a cpCST tracking CSV in chunks with explicit dtypes.
+
+    Only the columns the repair uses are parsed; anything else in the file is
+    skipped by the parser.
+
+    :param file_path: Path to the tracking CSV.
+    :param chunksize: Number of rows per chunk.
+    :param columns: Subset of TRACKING_DTYPES to read. Defaults to all of them.
+    :return: Iterator of DataFrames.
+    """
+    columns = list(TRACKING_DTYPES) if columns is None else list(columns)
+    with pd.read_csv(file_path, usecols=columns, chunksize=chunksize,
+                     dtype={col: TRACKING_DTYPES[col] for col in columns}) as reader:
+        for chunk in reader:
+            yield chunk[columns]
+
+
+def scan_tracking(file_path, chunksize=50_000):
+    """
+    First pass over a tracking CSV: the crash count and the damping target.
+
+    |stim_pos| is spooled to a temporary file as the chunks are read, and the
+    99th percentile is selected in place on a memory map of it. The target is
+    the element CrashRepair.set_target_max_position picks from the whole file,
+    and the column never has to fit in memory.
+
+    :param file_path: Path to the tracking CSV.
+    :param chunksize: Number of rows per chunk.
+    :return: (max crash_count, 99th percentile of |stim_pos|, NaN if the file has no rows)
+    """
+    crash_count = 0
+    n_rows = 0
+    with tempfile.TemporaryFile() as spool:
+        for chunk in read_tracking_chunks(file_path, chunksize, ['stim_pos', 'crash_count']):
+            if len(chunk):
+                np.abs(chunk['stim_pos'].to_numpy(dtype=np.float64)).tofile(spool)
+                n_rows += len(chunk)
+                crash_count = max(crash_count, chunk['crash_count'].max())
+        if n_rows == 0:
+            return crash_count, np.nan
+        spool.flush()
+        abs_stim = np.memmap(spool, dtype=np.float64, mode='r+', shape=(n_rows,))
+        # Same element as np.sort(abs_stim)[tgt]
+        tgt = int(n_rows * 0.99)
+        abs_stim.partition(tgt)
+        target_max_position = float(abs_stim[tgt])
+        del abs_stim
+    return crash_count, target_max_position
+
+
+class StreamingCrashRepair:
+    """
+    CrashRepair over a stream of chunks.
+
+    A crash is repaired once its post-crash window is complete. Rows more than
+    2 * window_frame_count before the end of the data seen so far can no
+    longer be touched by a later crash and are released; the rest is carried,
+    both as read (transitions are interpolated from the raw data) and as
+    repaired so far (overlapping windows are overwritten in crash order).
+    """
+    def __init__(self, target_max_position, sampling_rate=30, window_size=3.0):
+        """
+        :param target_max_position: Damping target, normally the 99th
+                                    percentile of |stim_pos| over the file.
+        :param sampling_rate: Sampling rate of the data.
+        :param window_size: Size of the window for crash detection.
+        """
+        self.repair_kwargs = dict(sampling_rate=sampling_rate,
+                                  target_max_position=target_max_position,
+                                  window_size=window_size)
+        self.window_frame_count = int(window_size * sampling_rate)
+        self.crashes_repaired = 0
+        self._original = None
+        self._repaired = None
+        self._offset = 0
+        self._last_crash = -1
+
+    def push(self, chunk, final=False):
+        """
+        Add the next chunk of tracking data.
+
+        :param chunk: DataFrame with the TRACKING_DTYPES columns.
+        :param final: Whether this is the last chunk of the file.
+        :return: DataFrame of repaired rows no later chunk can change.
+        """
+        if self._original is None:
+            original = chunk.reset_index(drop=True)
+            repaired = original.copy()
+        else:
+            original = pd.concat([self._original, chunk], ignore_index=True)
+            repaired = pd.concat([self._repaired, chunk], ignore_index=True)
+        n = len(original)
+
+        cr = CrashRepair(original, **self.repair_kwargs)
+        segments = cr.find_crash_segments()
+        # Crashes at or before _last_crash were repaired with an earlier
+        # chunk; crashes whose post window is still incomplete wait for the next
+        pending = segments.crash_idx + self._offset > self._last_crash
+        if not final:
+            pending &= segments.crash_idx + self.window_frame_count <= n
+        segments = segments.select(pending)
+        if len(segments):
+            cr.apply_transitions(repaired, segments, cr.compute_transitions(segments))
+            self._last_crash = self._offset + segments.crash_idx[-1]
+            self.crashes_repaired += cr.segments_repaired
+
+        n_done = n if final else max(0, n - 2 * self.window_frame_count)
+        self._original = original.iloc[n_done:].reset_index(drop=True)
+        self._repaired = repaired.iloc[n_done:].reset_index(drop=True)
+        self._offset += n_done
+        return repaired.iloc[:n_done]
+
+    def finish(self):
+        """
+        :return: The carried rows, with every remaining crash repaired.
+        """
+        if self._original is None:
+            return pd.DataFrame(columns=list(TRACKING_DTYPES))
+        return self.push(self._original.iloc[:0], final=True)
+
+
+class StreamingResampler:
+    """
+    CrashRepair.resample_data over a stream of repaired chunks.
+
+    The output timestamps are the ones np.arange(first, last, 1 / frequency)
+    produces for the whole file, and each is interpolated from the same pair
+    of input rows np.interp would pick.
+    """
+    def __init__(self, target_frequency=30):
+        self.step = 1.0 / target_frequency
+        self._start = None
+        self._delta = None
+        self._next = 0
+        self._carry = None
+
+    def _grid(self, first, stop):
+        # np.arange fills start, start + step, then start + i * delta
+        i = np.arange(first, stop)
+        grid = self._start + i * self._delta
+        grid[i == 1] = self._start + self.step
+        return grid
+
+    def push(self, data, final=False):
+        """
+        :param data: DataFrame with flip_time, stim_pos and user_pos.
+        :param final: Whether this is the last chunk of the file.
+        :return: DataFrame with resampled flip_time, stim_pos and user_pos.
+        """
+        data = data[['flip_time', 'stim_pos', 'user_pos']]
+        if self._carry is not None:
+            data = pd.concat([self._carry, data], ignore_index=True)
+        times = data['flip_time'].to_numpy(dtype=float)
+        if len(times) == 0:
+            return pd.DataFrame(columns=['flip_time', 'stim_pos', 'user_pos'], dtype=float)
+        if self._start is None:
+            self._start = times[0]
+            self._delta = (self._start + self.step) - self._start
+
+        if final:
+            stop = max(self._next, int(np.ceil((times[-1] - self._start) / self.step)))
+        else:
+            # Leave a step of margin so no timestamp past the final end is emitted
+            stop = max(self._next, int(np.floor((times[-1] - self.step - self._start) / self._delta)))
+        new_time_index = self._grid(self._next, stop)
+        resampled = pd.DataFrame({
+            'flip_time': new_time_index,
+            'stim_pos': np.interp(new_time_index, times, data['stim_pos'].to_numpy(dtype=float)),
+            'user_pos': np.interp(new_time_index, times, data['user_pos'].to_numpy(dtype=float))
+        })
+        self._next = stop
+
+        # Keep from the row at or before the next output timestamp. Overlapping
+        # crash windows can step flip_time backwards, and np.interp over the
+        # whole file still brackets with the first rows that reach a timestamp,
+        # so search the running maximum rather than the raw times
+        next_time = self._grid(self._next, self._next + 1)[0]
+        reached = np.maximum.accumulate(times)
+        keep_from = max(0, np.searchsorted(reached, next_time, side='right') - 1)
+        self._carry = data.iloc[keep_from:].reset_index(drop=True)
+        return resampled
+
+
+def compute_features(resampled, previous=None, out=None):
+    """
+    reproc_cpCST's derived columns for one chunk of resampled data.
+
+    :param resampled: DataFrame with flip_time, stim_pos and user_pos.
+    :param previous: The last row of the previous chunk's output, so the
+                     velocities continue across chunks. None for the first chunk.
+    :param out: Optional preallocated output array (see derive_features).
+    :return: 2D float64 array with the FEATURE_COLUMNS.
+    """
+    if out is None:
+        # Row-major, so FeatureSpool.append writes it without a copy
+        out = np.empty((len(resampled), len(FEATURE_COLUMNS)))
+    return derive_features(resampled['flip_time'].to_numpy(dtype=float),
+                           resampled['stim_pos'].to_numpy(dtype=float),
+                           resampled['user_pos'].to_numpy(dtype=float),
+                           previous, out)
+
+
+class _Moments:
+    """
+    Running count, means and centered sums of squares/products of (index, Y),
+    merged chunk by chunk (Chan et al.), for a least-squares line and a std
+    without a second pass over the data.
+    """
+    def __init__(self, n_cols):
+        self.n = 0
+        self.mean_i = 0.0
+        self.mean_y = np.zeros(n_cols)
+        self.ss_i = 0.0
+        self.ss_y = np.zeros(n_cols)
+        self.sp_iy = np.zeros(n_cols)
+
+    def update(self, index, values):
+        n_b = len(index)
+        if n_b == 0:
+            return
+        mean_i = index.mean()
+        mean_y = values.mean(axis=0)
+        di = index - mean_i
+        dy = values - mean_y
+        ss_i, ss_y, sp_iy = di @ di, (dy * dy).sum(axis=0), di @ dy
+
+        n = self.n + n_b
+        delta_i = mean_i - self.mean_i
+        delta_y = mean_y - self.mean_y
+        weight = self.n * n_b / n
+        self.ss_i += ss_i + delta_i * delta_i * weight
+        self.ss_y += ss_y + delta_y * delta_y * weight
+        self.sp_iy += sp_iy + delta_i * delta_y * weight
+        self.mean_i += delta_i * n_b / n
+        self.mean_y += delta_y * n_b / n
+        self.n = n
+
+    def trend(self):
+        """:return: (intercept, slope) of the least-squares line against the row index."""
+        slope = self.sp_iy / self.ss_i if self.ss_i > 0 else np.zeros_like(self.sp_iy)
+        return self.mean_y - slope * self.mean_i, slope
+
+    def std(self):
+        """:return: Sample standard deviation (ddof=1), as pandas computes it."""
+        return np.sqrt(self.ss_y / (self.n - 1))
+
+
+class FeatureSpool:
+    """
+    Temporary binary store for featurized rows, so detrending and z-scaling
+    can use whole-series statistics without holding the series in memory.
+    """
+    def __init__(self, chunksize=50_000):
+        self.chunksize = chunksize
+        self.n_rows = 0
+        self.moments = _Moments(len(FEATURE_COLUMNS))
+        self._file = tempfile.TemporaryFile()
+
+    def append(self, rows):
+        self.moments.update(np.arange(self.n_rows, self.n_rows + len(rows), dtype=float), rows)
+        self._file.write(np.ascontiguousarray(rows, dtype=np.float64).tobytes())
+        self.n_rows += len(rows)
+
+    def chunks(self):
+        """:return: Iterator of (first row index, 2D array) over the spooled rows."""
+        row_bytes = len(FEATURE_COLUMNS) * 8
+        self._file.seek(0)
+        for first in range(0, self.n_rows, self.chunksize):
+            count = min(self.chunksize, self.n_rows - first)
+            rows = np.frombuffer(self._file.read(count * row_bytes), dtype=np.float64)
+            yield first, rows.reshape(count, len(FEATURE_COLUMNS)).copy()
+
+    def close(self):
+        self._file.close()
+
+    def write_features(self, out_fpath, detrend_vectors=False, zscale_vectors=False):
+        """
+        Write the spooled rows to a CSV, chunk by chunk.
+
+        Matches scipy.signal.detrend (linear, over the row index) and the
+        (x - mean) / std z-scaling of reproc_cpCST applied to every column but
+        flip_time, to floating point rounding. user_pos is flipped back last.
+        """
+        cols = np.array([name != 'flip_time' for name in FEATURE_COLUMNS])
+        user_col = FEATURE_COLUMNS.index('user_pos')
+        intercept, slope = self.moments.trend()
+        mean, std = self.moments.mean_y, self.moments.std()
+
+        if detrend_vectors and zscale_vectors:
+            # z-scaling needs the moments of the detrended series
+            residuals = _Moments(len(FEATURE_COLUMNS))
+            for first, rows in self.chunks():
+                index = np.arange(first, first + len(rows), dtype=float)
+                residuals.update(index, rows - (intercept + np.outer(index, slope)))
+            mean, std = residuals.mean_y, residuals.std()
+
+        for first, rows in self.chunks():
+            if detrend_vectors:
+                index = np.arange(first, first + len(rows), dtype=float)
+                rows[:, cols] -= (intercept + np.outer(index, slope))[:, cols]
+            if zscale_vectors:
+                rows[:, cols] = (rows[:, cols] - mean[cols]) / std[cols]
+            rows[:, user_col] *= -1
+            pd.DataFrame(rows, columns=FEATURE_COLUMNS).to_csv(
+                out_fpath, mode='w' if first == 0 else 'a', header=first == 0, index=False)
+        if self.n_rows == 0:
+            pd.DataFrame(columns=FEATURE_COLUMNS).to_csv(out_fpath, index=False)
+
+
+def stream_features(file_path, chunksize=50_000, sampling_rate=30, window_size=3.0,
+                    resample_frequency=30):
+    """
+    Repair, resample and featurize a tracking CSV in bounded memory.
+
+    user_pos is flipped on read, as reproc_cpCST does before the repair.
+
+    :param file_path: Path to the tracking CSV.
+    :param chunksize: Number of rows per chunk.
+    :return: (max crash_count, number of crashes repaired, FeatureSpool)
+    """
+    crash_count, target_max_position = scan_tracking(file_path, chunksize)
+    repair = StreamingCrashRepair(target_max_position, sampling_rate=sampling_rate,
+                                  window_size=window_size)
+    resampler = StreamingResampler(resample_frequency)
+    spool = FeatureSpool(chunksize)
+    previous = None
+
+    def featurize(repaired, final=False):
+        nonlocal previous
+        rows = compute_features(resampler.push(repaired, final=final), previous)
+        if len(rows):
+            spool.append(rows)
+            previous = rows[-1].copy()
+
+    try:
+        for chunk in read_tracking_chunks(file_path, chunksize):
+            chunk['user_pos'] = chunk['user_pos'] * -1
+            featurize(repair.push(chunk))
+        featurize(repair.finish(), final=True)
+    except Exception:
+        spool.close()
+        raise
+    return crash_count, repair.crashes_repaired, spool
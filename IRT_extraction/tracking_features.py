@@ -0,0 +1,62 @@
+"""
+The derived tracking columns shared by reproc_cpCST and stream_cpCST.
+
+NumPy only: the feature arithmetic needs neither pandas nor the crash
+repair, so importing it does not pull in the streaming pipeline.
+"""
+import numpy as np
+
+FEATURE_COLUMNS = ['flip_time', 'stim_pos', 'user_pos', 'tracking', 'covary',
+                   'abs_tracking', 'abs_covary', 'user_pos_vel', 'stim_pos_vel',
+                   'tracking_vel']
+
+
+def derive_features(flip_time, stim_pos, user_pos, previous=None, out=None):
+    """
+    The derived tracking columns, computed straight into one 2D array.
+
+    The time delta is taken once and every column is written in place into
+    `out`, so the only temporaries are the time delta and the NaN masks of
+    the differences.
+    Values are identical to computing them with pandas:
+    tracking = user - stim, covary = |user| - |stim|, their absolute values,
+    and <col>_vel = col.diff().fillna(0) * flip_time.diff().fillna(0) * 1000.
+
+    :param flip_time, stim_pos, user_pos: 1D arrays of equal length.
+    :param previous: The last row of the previous chunk's output, so the
+                     velocities continue across chunks. None for the first chunk.
+    :param out: Optional preallocated (n, len(FEATURE_COLUMNS)) float64 array
+                to fill; column-major keeps every column contiguous.
+    :return: `out`, with the FEATURE_COLUMNS.
+    """
+    n = len(flip_time)
+    if out is None:
+        out = np.empty((n, len(FEATURE_COLUMNS)), order='F')
+    elif out.shape != (n, len(FEATURE_COLUMNS)):
+        raise ValueError(f"out has shape {out.shape}, expected {(n, len(FEATURE_COLUMNS))}")
+    (time, stim, user, tracking, covary, abs_tracking, abs_covary,
+     user_vel, stim_vel, tracking_vel) = out.T
+    np.copyto(time, flip_time)
+    np.copyto(stim, stim_pos)
+    np.copyto(user, user_pos)
+    np.subtract(user, stim, out=tracking)
+    np.abs(user, out=covary)
+    np.subtract(covary, np.abs(stim, out=abs_covary), out=covary)
+    np.abs(tracking, out=abs_tracking)
+    np.abs(covary, out=abs_covary)
+    if n == 0:
+        return out
+
+    def diff(values, k, dest):
+        # Series.diff().fillna(0), continued from the previous chunk
+        np.subtract(values[1:], values[:-1], out=dest[1:])
+        dest[0] = values[0] - previous[k] if previous is not None else 0.0
+        dest[np.isnan(dest)] = 0
+        return dest
+
+    dt = diff(time, 0, np.empty(n))
+    for values, k, dest in [(user, 2, user_vel), (stim, 1, stim_vel), (tracking, 3, tracking_vel)]:
+        diff(values, k, dest)
+        dest *= dt
+        dest *= 1000
+    return out
@@ -0,0 +1,188 @@
+"""Run eeg_file_to_pkl over a whole cohort on a process pool.
+
+Jobs come either from a manifest CSV with ``eeg_fpath`` and ``events_fpath``
+columns (and optionally ``dict_outpath``) or from a directory that is searched
+for ``*_eeg*.fif`` files and their matching ``*_events*.csv``. Each worker
+imports mne and loads the template pickle once, then converts its share of
+participants with ``workers x threads`` capped at the core count.
+
+A per-file report (status, seconds, error) is written to
+``<output_dir>/batch_report.csv``. Participants whose FIF, events CSV,
+template, settings and code are unchanged since the last run are skipped
+(see ``processing_cache``) and listed in the report with status
+``skipped``. Blink detection is cached separately in
+``<output_dir>/.eog_cache``, so participants that are rerun because
+something else changed don't redo it.
+"""
+import argparse
+import csv
+import multiprocessing
+import os
+import time
+import traceback
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from pathlib import Path
+
+from processing_cache import ProcessingCache, code_version
+
+# Blink detection cache inside the output directory (see BlinkRemover). It is
+# keyed on the recording itself, so it survives changes to anything else.
+EOG_CACHE_DIRNAME = '.eog_cache'
+
+# Filled in by _init_worker, once per worker process
+_worker_template = None
+_process_participant = None
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(description='Process EEG and events data for a whole cohort.')
+    source = parser.add_mutually_exclusive_group(required=True)
+    source.add_argument('--manifest', type=str,
+                        help='CSV with eeg_fpath, events_fpath and optionally dict_outpath columns.')
+    source.add_argument('--input_dir', type=str,
+                        help='Directory searched recursively for *_eeg*.fif and *_events*.csv pairs.')
+    parser.add_argument('--template', type=str, required=True, help='Path to the template pickle file.')
+    parser.add_argument('--output_dir', type=str, required=True)
+    parser.add_argument('--workers', type=int, default=None,
+                        help='Number of worker processes. Defaults to the number of cores.')
+    parser.add_argument('--max-memory', type=float, default=None,
+                        help='Per-worker memory budget in MB for the envelope extraction.')
+    parser.add_argument('--format', choices=['pkl', 'npy'], default='pkl')
+    parser.add_argument('--force', action='store_true',
+                        help='Reprocess every participant, ignoring the processing cache.')
+    return parser.parse_args()
+
+
+def output_fpath(eeg_fpath, output_dir, output_format):
+    """``sub-X_eeg_cpt.fif`` -> ``<output_dir>/sub-X_cpt.pkl`` (or a directory for npy)."""
+    stem = Path(eeg_fpath).stem.replace('_eeg', '')
+    return str(Path(output_dir) / (stem + '.pkl' if output_format == 'pkl' else stem))
+
+
+def find_pairs(input_dir):
+    """Match every FIF under ``input_dir`` with its events CSV.
+
+    The events file is ``sub-X_events_cpt.csv`` for ``sub-X_eeg_cpt.fif``;
+    failing that, the only events CSV starting with the same subject prefix.
+    FIFs without a match are returned with ``events_fpath=None`` so they show
+    up as failures in the report.
+    """
+    events_files = {p.name: p for p in Path(input_dir).rglob('*.csv') if 'events' in p.name}
+    pairs = []
+    for eeg_fpath in sorted(Path(input_dir).rglob('*.fif')):
+        events_name = eeg_fpath.stem.replace('_eeg', '_events') + '.csv'
+        if events_name in events_files:
+            events_fpath = events_files[events_name]
+        else:
+            subject = eeg_fpath.name.split('_')[0]
+            candidates = [p for name, p in events_files.items() if name.split('_')[0] == subject]
+            events_fpath = candidates[0] if len(candidates) == 1 else None
+        pairs.append((str(eeg_fpath), str(events_fpath) if events_fpath else None))
+    return pairs
+
+
+def read_manifest(manifest_fpath):
+    with open(manifest_fpath, newline='') as f:
+        return [(row['eeg_fpath'], row['events_fpath'], row.get('dict_outpath') or None)
+                for row in csv.DictReader(f)]
+
+
+def _init_worker(template_fpath):
+    global _worker_template, _process_participant
+    import pickle
+    # Pay the mne/pandas import once per worker, not per job
+    from eeg_file_to_pkl import process_participant as _process_participant
+    with open(template_fpath, 'rb') as file:
+        _worker_template = pickle.load(file)
+
+
+def _run_job(eeg_fpath, events_fpath, dict_outpath, max_memory, output_format, eog_cache_dir):
+    start = time.perf_counter()
+    result = {'eeg_fpath': eeg_fpath, 'events_fpath': events_fpath,
+              'dict_outpath': dict_outpath, 'status': 'ok', 'error': ''}
+    try:
+        if events_fpath is None:
+            raise FileNotFoundError(f"No events CSV found for {eeg_fpath}")
+        _process_participant(eeg_fpath, events_fpath, _worker_template, dict_outpath,
+                             max_memory=max_memory, output_format=output_format,
+                             eog_cache_dir=eog_cache_dir)
+    except Exception as e:
+        result['status'] = 'failed'
+        result['error'] = f"{type(e).__name__}: {e}"
+        traceback.print_exc()
+    result['seconds'] = round(time.perf_counter() - start, 3)
+    return result
+
+
+def main():
+    args = parse_arguments()
+    output_dir = Path(args.output_dir)
+    output_dir.mkdir(parents=True, exist_ok=True)
+
+    if args.manifest:
+        jobs = read_manifest(args.manifest)
+    else:
+        jobs = [(eeg, events, None) for eeg, events in find_pairs(args.input_dir)]
+    jobs = [(eeg, events, outpath or output_fpath(eeg, output_dir, args.format))
+            for eeg, events, outpath in jobs]
+
+    # Band definitions and filter settings live in eeg_file_to_pkl, so its
+    # source hash stands in for them
+    cache = ProcessingCache(output_dir, {'format': args.format, 'max_memory': args.max_memory},
+                            code_version(Path(__file__).with_name('eeg_file_to_pkl.py'),
+                                         Path(__file__).with_name('eeg_features_io.py')))
+    skipped = []
+    if not args.force:
+        fresh = [job[1] is not None and cache.is_fresh(job[0], [job[1], args.template])
+                 for job in jobs]
+        skipped = [job for job, is_fresh in zip(jobs, fresh) if is_fresh]
+        jobs = [job for job, is_fresh in zip(jobs, fresh) if not is_fresh]
+        print(f"{len(skipped)} participants unchanged since the last run, skipped")
+
+    n_cores = os.cpu_count()
+    workers = max(1, min(args.workers or n_cores, len(jobs)))
+    # Read by eeg_file_to_pkl when a worker imports it, before numpy loads
+    os.environ['CPCST_NTHREADS'] = str(max(1, n_cores // workers))
+    print(f"{len(jobs)} participants on {workers} workers x {os.environ['CPCST_NTHREADS']} threads")
+
+    # Skipped participants stay in the report, so a run with nothing to do
+    # doesn't leave an empty one behind
+    results = [{'eeg_fpath': eeg, 'events_fpath': events, 'dict_outpath': outpath,
+                'status': 'skipped', 'seconds': 0.0, 'error': ''}
+               for eeg, events, outpath in skipped]
+    # spawn so that every worker starts without numpy/mne imported and
+    # picks up the thread budget above
+    with ProcessPoolExecutor(max_workers=workers,
+                             mp_context=multiprocessing.get_context('spawn'),
+                             initializer=_init_worker,
+                             initargs=(args.template,)) as executor:
+        futures = [executor.submit(_run_job, eeg, events, outpath, args.max_memory, args.format,
+                                   str(output_dir / EOG_CACHE_DIRNAME))
+                   for eeg, events, outpath in jobs]
+        for future in as_completed(futures):
+            result = future.result()
+            results.append(result)
+            if result['status'] == 'ok':
+                cache.record(result['eeg_fpath'], [result['dict_outpath']],
+                             [result['events_fpath'], args.template])
+            print(f"[{len(results) - len(skipped)}/{len(jobs)}] {result['status']:6} "
+                  f"{result['seconds']:8.1f}s {result['eeg_fpath']} {result['error']}")
+
+    cache.save()
+
+    results.sort(key=lambda r: r['eeg_fpath'])
+    report_fpath = output_dir / 'batch_report.csv'
+    with open(report_fpath, 'w', newline='') as f:
+        writer = csv.DictWriter(f, fieldnames=['eeg_fpath', 'events_fpath', 'dict_outpath',
+                                               'status', 'seconds', 'error'])
+        writer.writeheader()
+        writer.writerows(results)
+
+    n_failed = sum(r['status'] == 'failed' for r in results)
+    print(f"{len(results) - len(skipped) - n_failed} succeeded, {n_failed} failed, "
+          f"{len(skipped)} skipped. Report: {report_fpath}")
+    return n_failed == 0
+
+
+if __name__ == '__main__':
+    raise SystemExit(0 if main() else 1)
@@ -0,0 +1,184 @@
+"""Memory-mappable storage for the EEG envelope features.
+
+``eeg_file_to_pkl.main`` can write its output as a directory instead of a
+pickle::
+
+    <outdir>/features.npy    float64 (n_bands, n_channels, n_times)
+    <outdir>/time.npy        float64 (n_times,)
+    <outdir>/metadata.json   time_info, channels_info, frequency_bands, events_data
+
+The features are stored band-major so every ``(band, channel)`` time series
+is one contiguous run of the file, and a reader memory-maps only the pages
+it actually touches. This module only depends on numpy so downstream jobs can
+read features without importing mne.
+"""
+import json
+import os
+import pickle
+from datetime import datetime
+
+import numpy as np
+
+FORMAT_VERSION = 1
+FEATURES_FNAME = 'features.npy'
+TIME_FNAME = 'time.npy'
+METADATA_FNAME = 'metadata.json'
+
+
+def create_features_array(out_dir: str | os.PathLike,
+                          n_channels: int,
+                          n_times: int,
+                          n_bands: int) -> np.ndarray:
+    """Create the on-disk features array and return it in the legacy layout.
+
+    The returned array is a ``(n_channels, n_times, n_bands)`` view onto the
+    band-major ``features.npy``, so the envelope extraction can write into it
+    directly without a dense in-memory copy.
+
+    Args:
+        out_dir (str | os.PathLike): The output directory. Created if needed.
+        n_channels (int): The number of channels.
+        n_times (int): The number of samples.
+        n_bands (int): The number of frequency bands.
+
+    Returns:
+        np.ndarray: A writable ``(n_channels, n_times, n_bands)`` memmap view.
+    """
+    os.makedirs(out_dir, exist_ok=True)
+    features = np.lib.format.open_memmap(os.path.join(out_dir, FEATURES_FNAME),
+                                         mode='w+', dtype=np.float64,
+                                         shape=(int(n_bands), int(n_channels), int(n_times)))
+    return features.transpose(1, 2, 0)
+
+
+def save_eeg_features(data_dict: dict, out_dir: str | os.PathLike) -> None:
+    """Write a ``data_dict`` as built by ``eeg_file_to_pkl.main`` to a directory.
+
+    If the features already live in ``out_dir`` (see
+    ``create_features_array``) they are flushed rather than rewritten.
+
+    Args:
+        data_dict (dict): The nested dict with ``eeg_data`` and ``events_data``.
+        out_dir (str | os.PathLike): The output directory. Created if needed.
+    """
+    os.makedirs(out_dir, exist_ok=True)
+    eeg_data = data_dict['eeg_data']
+    events_data = data_dict['events_data']
+    features = eeg_data['features']
+    features_fpath = os.path.abspath(os.path.join(out_dir, FEATURES_FNAME))
+
+    if getattr(features, 'filename', None) == features_fpath:
+        features.flush()
+    else:
+        on_disk = create_features_array(out_dir, *features.shape)
+        for b in range(features.shape[2]):
+            on_disk[:, :, b] = features[:, :, b]
+        on_disk.base.flush()
+
+    np.save(os.path.join(out_dir, TIME_FNAME), np.asarray(eeg_data['time_info']['time']))
+
+    meas_date = eeg_data['time_info']['meas_date']
+    channels_info = eeg_data['labels']['channels_info']
+    metadata = {
+        'format_version': FORMAT_VERSION,
+        'features_layout': ['band', 'channel', 'time'],
+        'time_info': {'meas_date': meas_date.isoformat() if meas_date is not None else None},
+        'channels_info': {key: [v.item() if isinstance(v, np.generic) else v for v in values]
+                          for key, values in channels_info.items()},
+        'frequency_bands': list(eeg_data['labels']['frequency_bands']),
+        'features_info': eeg_data['features_info'],
+        'events_data': {
+            'time': [float(t) for t in events_data['time']],
+            'labels': {'index': [int(i) for i in events_data['labels']['index']],
+                       'event_labels': [str(label) for label in events_data['labels']['event_labels']]},
+            'features': [int(f) for f in events_data['features']],
+            'features_info': events_data['features_info'],
+        },
+    }
+    with open(os.path.join(out_dir, METADATA_FNAME), 'w') as file:
+        json.dump(metadata, file, indent=1)
+
+
+class EEGFeatures:
+    """Lazy reader for a features directory written by ``save_eeg_features``.
+
+    ``features`` is a read-only memmap of shape ``(n_bands, n_channels,
+    n_times)``; indexing it only reads the requested slices from disk.
+    """
+    def __init__(self,
+                 path: str | os.PathLike,
+                 mmap_mode: str | None = 'r'):
+        self.path = path
+        with open(os.path.join(path, METADATA_FNAME)) as file:
+            self.metadata = json.load(file)
+        self.features = np.load(os.path.join(path, FEATURES_FNAME), mmap_mode=mmap_mode)
+        self.time = np.load(os.path.join(path, TIME_FNAME), mmap_mode=mmap_mode)
+        self.bands = self.metadata['frequency_bands']
+        self.channels = self.metadata['channels_info']['channels_name']
+
+    def band(self: 'EEGFeatures', band: str) -> np.ndarray:
+        """Envelopes of one band for all channels, ``(n_channels, n_times)``."""
+        return self.features[self.bands.index(band)]
+
+    def channel(self: 'EEGFeatures',
+                channel: str,
+                band: str | None = None) -> np.ndarray:
+        """Envelopes of one channel.
+
+        Args:
+            channel (str): The channel name.
+            band (str | None, optional): A single band. Defaults to None.
+
+        Returns:
+            np.ndarray: ``(n_times,)`` if ``band`` is given, otherwise
+                ``(n_bands, n_times)``.
+        """
+        ch = self.channels.index(channel)
+        if band is None:
+            return self.features[:, ch]
+        return self.features[self.bands.index(band), ch]
+
+    def to_legacy_dict(self: 'EEGFeatures') -> dict:
+        """Return the nested dict that ``eeg_file_to_pkl`` used to pickle.
+
+        ``features`` is a ``(n_channels, n_times, n_bands)`` view of the
+        memmap, so nothing is read until it is indexed.
+        """
+        meas_date = self.metadata['time_info']['meas_date']
+        events_data = self.metadata['events_data']
+        return {
+            'eeg_data': {'time_info': {'time': self.time,
+                                       'meas_date': datetime.fromisoformat(meas_date) if meas_date else None},
+                         'labels': {'channels_info': self.metadata['channels_info'],
+                                    'frequency_bands': self.bands},
+                         'features': self.features.transpose(1, 2, 0),
+                         'features_info': self.metadata['features_info']},
+            'events_data': {'time': events_data['time'],
+                            'labels': {'index': events_data['labels']['index'],
+                                       'event_labels': np.array(events_data['labels']['event_labels'], dtype=object)},
+                            'features': events_data['features'],
+                            'features_info': events_data['features_info']},
+        }
+
+
+def load_eeg_features(path: str | os.PathLike,
+                      legacy: bool = False,
+                      mmap_mode: str | None = 'r') -> 'EEGFeatures | dict':
+    """Open a features directory or a legacy pickle.
+
+    Args:
+        path (str | os.PathLike): A directory written by ``save_eeg_features``
+            or a pickle written by ``eeg_file_to_pkl``.
+        legacy (bool, optional): Return the legacy nested dict instead of an
+            ``EEGFeatures`` reader. Pickles always come back as a dict.
+            Defaults to False.
+        mmap_mode (str | None, optional): Passed to ``np.load``. Defaults to 'r'.
+
+    Returns:
+        EEGFeatures | dict: The reader, or the legacy dict.
+    """
+    if not os.path.isdir(path):
+        with open(path, 'rb') as file:
+            return pickle.load(file)
+    features = EEGFeatures(path, mmap_mode=mmap_mode)
+    return features.to_legacy_dict() if legacy else features
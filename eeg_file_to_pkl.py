@@ -1,22 +1,25 @@
 import os
-nthreads = "8"
-
-# Set the number of threads for various libraries
-os.environ["OMP_NUM_THREADS"] = nthreads
-os.environ["OPENBLAS_NUM_THREADS"] = nthreads
-os.environ["MKL_NUM_THREADS"] = nthreads
-os.environ["VECLIB_MAXIMUM_THREADS"] = nthreads
-os.environ["NUMEXPR_NUM_THREADS"] = nthreads
-os.environ["NUMBA_NUM_THREADS"] = nthreads
-os.environ["NUMBA_DEFAULT_NUM_THREADS"] = nthreads
-os.environ["OMP_DYNAMIC"] = "FALSE"
-os.environ["OMP_MAX_ACTIVE_LEVELS"] = "1"
-os.environ["GOTO_NUM_THREADS"] = nthreads
-os.environ["OMP_THREAD_LIMIT"] = nthreads
-os.environ["BLIS_NUM_THREADS"] = nthreads
-os.environ["PTHREAD_POOL_SIZE"] = nthreads
+
+def set_thread_budget(nthreads: int | str) -> None:
+    """Cap the threads used by the numerical libraries.
+
+    Has to run before numpy/scipy/mne are imported. ``eeg_batch_to_pkl`` sets
+    ``CPCST_NTHREADS`` so that workers x threads matches the core count.
+    """
+    nthreads = str(nthreads)
+    for var in ["OMP_NUM_THREADS", "OPENBLAS_NUM_THREADS", "MKL_NUM_THREADS",
+                "VECLIB_MAXIMUM_THREADS", "NUMEXPR_NUM_THREADS", "NUMBA_NUM_THREADS",
+                "NUMBA_DEFAULT_NUM_THREADS", "GOTO_NUM_THREADS", "OMP_THREAD_LIMIT",
+                "BLIS_NUM_THREADS", "PTHREAD_POOL_SIZE"]:
+        os.environ[var] = nthreads
+    os.environ["OMP_DYNAMIC"] = "FALSE"
+    os.environ["OMP_MAX_ACTIVE_LEVELS"] = "1"
+
+set_thread_budget(os.environ.get("CPCST_NTHREADS", os.cpu_count()))
 
 import argparse
+import hashlib
+import json
 import pickle
 import pandas as pd
 import mne
@@ -24,6 +27,9 @@ import numpy as np
 import re
 from datetime import datetime, timezone
 import matplotlib.pyplot as plt
+import scipy.fft
+from eeg_features_io import create_features_array, save_eeg_features
+from processing_cache import file_digest
 
 # Utility functions
 def is_even(s):
@@ -69,34 +75,295 @@ def anatomy_and_laterality(channel_names, dict_template):
 
     return anatomy, laterality
 
+bands_dict = {
+    'delta': [1,4],
+    'theta': [4,8],
+    'alpha': [8,13],
+    'beta': [13,30],
+    'gamma': [30, 40]
+}
+
 def extract_envelopes(eeg_data: mne.io.Raw, band: str):
-    bands_dict = {
-        'delta': [1,4],
-        'theta': [4,8],
-        'alpha': [8,13],
-        'beta': [13,30],
-        'gamma': [30, 40]
-    }
     return eeg_data.copy().filter(bands_dict[band][0],
                                   bands_dict[band][1]
                                   ).apply_hilbert(envelope = True)
 
+class BandEnvelopeExtractor:
+    """Compute the Hilbert envelopes of several frequency bands in one pass.
+
+    Each channel goes through a single forward FFT. The zero-phase response
+    of the FIR band-pass that ``mne.io.Raw.filter`` would design for each band
+    is multiplied with the analytic-signal step in the frequency domain, so
+    one inverse FFT per band yields the envelope directly. Results are written
+    into a ``(n_channels, n_times, n_bands)`` array, the layout used for
+    ``eeg_features``.
+
+    The band-passed signal (the real part of the analytic signal) matches
+    ``extract_envelopes`` to floating point precision. The envelopes differ
+    near the ends of the recording: the legacy path runs the Hilbert transform
+    on the trimmed signal, so the last samples wrap around onto the first
+    ones, whereas here it sees the reflection padding. At the first and last
+    samples the two can be apart by most of the peak envelope. The difference
+    then decays as 1/t with the time t to the nearer end, and stays below
+    0.2 s / t of the peak envelope for every band. The delta band comes
+    closest: typically 10 to 15% at 0.5 s, 2% at 5 s and 1% at 10 s. Theta
+    is about 5 times lower and the faster bands 20 times or more.
+    """
+    def __init__(self,
+                 sfreq: float,
+                 bands: list[str] = ['theta', 'delta', 'alpha', 'beta', 'gamma']):
+        self.sfreq = sfreq
+        self.bands = bands
+        self.kernels = [mne.filter.create_filter(None, sfreq,
+                                                 bands_dict[band][0],
+                                                 bands_dict[band][1],
+                                                 verbose=False)
+                        for band in bands]
+        # Same edge padding as the overlap-add filter in MNE
+        self.n_pad = max(len(h) for h in self.kernels) - 1
+        self._weights = {}
+
+    def _fft_weights(self: 'BandEnvelopeExtractor', n_fft: int) -> np.ndarray:
+        if n_fft not in self._weights:
+            analytic = np.zeros(n_fft)
+            analytic[0] = 1
+            analytic[1:(n_fft + 1) // 2] = 2
+            if n_fft % 2 == 0:
+                analytic[n_fft // 2] = 1
+
+            weights = np.empty((len(self.kernels), n_fft))
+            for b, h in enumerate(self.kernels):
+                # Centre the linear-phase kernel on sample 0 so its spectrum is real
+                kernel = np.zeros(n_fft)
+                kernel[:len(h)] = h
+                kernel = np.roll(kernel, -(len(h) // 2))
+                weights[b] = scipy.fft.fft(kernel).real * analytic
+            self._weights[n_fft] = weights
+        return self._weights[n_fft]
+
+    def transform(self: 'BandEnvelopeExtractor',
+                  data: np.ndarray,
+                  out: np.ndarray | None = None) -> np.ndarray:
+        """Compute the band envelopes of a ``(n_channels, n_times)`` array.
+
+        Args:
+            data (np.ndarray): The signals, one row per channel.
+            out (np.ndarray | None, optional): Preallocated
+                ``(n_channels, n_times, n_bands)`` output. Defaults to None.
+
+        Returns:
+            np.ndarray: The envelopes, one slice per band along the last axis.
+        """
+        n_channels, n_times = data.shape
+        if out is None:
+            out = np.empty((n_channels, n_times, len(self.bands)))
+
+        n_pad = min(self.n_pad, n_times - 1)
+        n_fft = scipy.fft.next_fast_len(n_times + 2 * n_pad)
+        weights = self._fft_weights(n_fft)
+        for ch in range(n_channels):
+            padded = np.pad(data[ch], n_pad, mode='reflect', reflect_type='odd')
+            spectrum = scipy.fft.fft(padded, n_fft)
+            for b in range(len(self.bands)):
+                analytic = scipy.fft.ifft(spectrum * weights[b])
+                out[ch, :, b] = np.abs(analytic[n_pad:n_pad + n_times])
+        return out
+
+    def transform_raw(self: 'BandEnvelopeExtractor',
+                      eeg_data: mne.io.Raw,
+                      out: np.ndarray | None = None) -> np.ndarray:
+        """Compute the band envelopes of every channel of a raw recording.
+
+        As with ``extract_envelopes``, only data channels are filtered; other
+        channels (stim, EOG, ...) are copied unchanged into every band.
+
+        Args:
+            eeg_data (mne.io.Raw): The raw data.
+            out (np.ndarray | None, optional): Preallocated
+                ``(n_channels, n_times, n_bands)`` output. Defaults to None.
+
+        Returns:
+            np.ndarray: The envelopes, matching the ``eeg_features`` layout.
+        """
+        if out is None:
+            out = np.empty((len(eeg_data.ch_names), eeg_data.n_times, len(self.bands)))
+
+        data_picks = set(mne.pick_types(eeg_data.info, meg=True, eeg=True,
+                                        seeg=True, ecog=True, dbs=True,
+                                        exclude=[]))
+        # One channel at a time keeps the working set to a single row
+        for ch in range(len(eeg_data.ch_names)):
+            signal = eeg_data.get_data(picks=[ch])
+            if ch in data_picks:
+                self.transform(signal, out=out[ch:ch + 1])
+            else:
+                out[ch] = signal[0][:, np.newaxis]
+        return out
+
+    def block_length(self: 'BandEnvelopeExtractor',
+                     n_channels: int,
+                     max_memory: float) -> int:
+        """Largest block length whose working set fits in a memory budget.
+
+        Each block is read with one filter length of overlap on either side;
+        the input, the envelopes of the extended block and the per-channel FFT
+        buffers all count towards the budget.
+
+        Args:
+            n_channels (int): The number of channels read per block.
+            max_memory (float): The memory budget in megabytes.
+
+        Returns:
+            int: The number of output samples per block.
+        """
+        bytes_per_sample = n_channels * 8 * (2 + len(self.bands)) + 3 * 16
+        block_length = int(max_memory * 1e6 // bytes_per_sample) - 2 * self.n_pad
+        if block_length < self.n_pad:
+            raise ValueError(f"A memory budget of {max_memory} MB is too small "
+                             f"for {n_channels} channels and a filter length of "
+                             f"{self.n_pad + 1} samples.")
+        return block_length
+
+    def transform_raw_blocks(self: 'BandEnvelopeExtractor',
+                             eeg_data: mne.io.Raw,
+                             out: np.ndarray,
+                             block_length: int) -> np.ndarray:
+        """Compute the band envelopes of a raw recording block by block.
+
+        The recording does not need to be preloaded: each block is read from
+        disk with one filter length of overlap on both sides so the filter
+        sees real data at the block boundaries, and only the central part is
+        written to ``out`` (typically a disk-backed ``np.memmap``).
+
+        Filtering is exact. The Hilbert transform is not local, so the
+        envelopes differ from ``transform_raw`` by up to about 0.2% of the
+        peak envelope for the delta band and below 0.01% for the others.
+
+        Args:
+            eeg_data (mne.io.Raw): The raw data, preloaded or not.
+            out (np.ndarray): Preallocated ``(n_channels, n_times, n_bands)``
+                output.
+            block_length (int): The number of output samples per block.
+
+        Returns:
+            np.ndarray: ``out``, filled with the envelopes.
+        """
+        n_times = eeg_data.n_times
+        data_picks = mne.pick_types(eeg_data.info, meg=True, eeg=True,
+                                    seeg=True, ecog=True, dbs=True, exclude=[])
+        other_picks = np.setdiff1d(np.arange(len(eeg_data.ch_names)), data_picks)
+
+        for start in range(0, n_times, block_length):
+            stop = min(n_times, start + block_length)
+            read_start = max(0, start - self.n_pad)
+            read_stop = min(n_times, stop + self.n_pad)
+            block = eeg_data.get_data(start=read_start, stop=read_stop)
+
+            envelopes = self.transform(block[data_picks])
+            for i, ch in enumerate(data_picks):
+                out[ch, start:stop] = envelopes[i, start - read_start:stop - read_start]
+            for ch in other_picks:
+                out[ch, start:stop] = block[ch, start - read_start:stop - read_start, np.newaxis]
+        return out
+
 class BlinkRemover:
     """This class is a helper to remove blinks from EEG using SSP projectors.
 
     You should initiate the object by giving as inputs the raw data (mne.Raw
     object) and the channel names on which the blinks are the most present
     (By default Fp1 and Fp2)
+
+    Blink detection runs once per object: the EOG events and projectors are
+    kept on it, and the blink evoked used by the QC plots is averaged from
+    the same events. With a ``cache_dir`` they are also saved to disk, keyed
+    by the SHA-256 of the FIF file, the channels, the projector settings
+    and the mne version, so a rerun on the same recording skips detection.
+    The disk cache assumes ``raw`` is the recording as read from its file.
     """
+    # compute_proj_eog settings; part of the disk cache key
+    PROJ_PARAMS = {'n_eeg': 1, 'reject': None, 'no_proj': True}
+    # create_eog_epochs defaults, used to average the blinks for the QC plots
+    EPOCH_PARAMS = {'event_id': 998, 'tmin': -0.5, 'tmax': 0.5}
+
     def __init__(self, 
                  raw: mne.io.Raw, 
-                 channels: list[str] = ['Fp1', 'Fp2']):
+                 channels: list[str] = ['Fp1', 'Fp2'],
+                 cache_dir: str | os.PathLike | None = None):
         self.raw = raw
         self.channels = channels
-    
+        self.cache_dir = cache_dir
+        self.eog_projs = None
+        self.eog_events = None
+        self.eog_evoked = None
+        self._cache_fpath = None
+        self._projected_inplace = False
+
+    def _cache_path(self: 'BlinkRemover') -> str | None:
+        """The disk cache file, or None without a cache_dir or a file behind raw."""
+        if self._cache_fpath is None and self.cache_dir is not None and self.raw.filenames \
+                and self.raw.filenames[0] is not None:
+            fif_fpath = str(self.raw.filenames[0])
+            key = json.dumps({'sha256': file_digest(fif_fpath), 'channels': list(self.channels),
+                              'proj_params': self.PROJ_PARAMS, 'epoch_params': self.EPOCH_PARAMS,
+                              'mne': mne.__version__}, sort_keys=True)
+            stem = os.path.basename(fif_fpath).split('.')[0]
+            self._cache_fpath = os.path.join(
+                self.cache_dir, f"{stem}_eog_{hashlib.sha256(key.encode()).hexdigest()[:16]}.pkl")
+        return self._cache_fpath
+
+    def _load_cache(self: 'BlinkRemover') -> bool:
+        cache_fpath = self._cache_path()
+        if cache_fpath is None or not os.path.exists(cache_fpath):
+            return False
+        with open(cache_fpath, 'rb') as file:
+            cached = pickle.load(file)
+        self.eog_projs, self.eog_events = cached['projs'], cached['events']
+        if self.eog_evoked is None:
+            self.eog_evoked = cached['evoked']
+        return True
+
+    def _save_cache(self: 'BlinkRemover') -> None:
+        # Pickled rather than written as FIF, which stores projectors in float32
+        cache_fpath = self._cache_path()
+        if cache_fpath is None:
+            return
+        os.makedirs(self.cache_dir, exist_ok=True)
+        tmp_fpath = cache_fpath + '.tmp'
+        with open(tmp_fpath, 'wb') as file:
+            pickle.dump({'projs': self.eog_projs, 'events': self.eog_events,
+                         'evoked': self.eog_evoked}, file)
+        os.replace(tmp_fpath, cache_fpath)
+
+    def _detect(self: 'BlinkRemover') -> 'BlinkRemover':
+        """Find the blinks and compute the projectors, unless already done or cached."""
+        if self.eog_projs is not None or self._load_cache():
+            return self
+        self.eog_projs, self.eog_events = mne.preprocessing.compute_proj_eog(
+            self.raw, 
+            ch_name = self.channels,
+            **self.PROJ_PARAMS
+        )
+        self._save_cache()
+        return self
+
     def _find_blinks(self: 'BlinkRemover') -> 'BlinkRemover':
-        self.eog_evoked = mne.preprocessing.create_eog_epochs(self.raw, ch_name = self.channels).average()
-        self.eog_evoked.apply_baseline((None, None))
+        """Average the raw data around the detected blinks.
+
+        Same epochs as ``create_eog_epochs``, from the events found by
+        ``compute_proj_eog`` instead of a second detection pass. They only
+        differ when BAD annotations change what the detection finds;
+        epochs overlapping BAD segments are dropped either way.
+        """
+        self._detect()
+        if self.eog_evoked is None:
+            if self._projected_inplace:
+                raise RuntimeError("The blinks can't be averaged from data they were projected out of; "
+                                   "use remove_blinks(inplace=True, keep_evoked=True) to plot them")
+            eog_epochs = mne.Epochs(self.raw, self.eog_events, proj=False, baseline=None,
+                                    preload=True, reject_by_annotation=True, **self.EPOCH_PARAMS)
+            self.eog_evoked = eog_epochs.average()
+            self.eog_evoked.apply_baseline((None, None))
+            self._save_cache()
         return self
     
     def plot_removal_results(self: 'BlinkRemover', 
@@ -110,6 +377,7 @@ class BlinkRemover:
         Args:
             saving_filename (, optional): _description_. Defaults to None.
         """
+        self._find_blinks()
         figure = mne.viz.plot_projs_joint(self.eog_projs, self.eog_evoked)
         figure.suptitle("EOG projectors")
         if saving_filename:
@@ -134,89 +402,132 @@ class BlinkRemover:
             figure.savefig(saving_filename)
         return figure
     
-    def remove_blinks(self: 'BlinkRemover') -> mne.io.Raw:
+    def remove_blinks(self: 'BlinkRemover', inplace: bool = False,
+                      keep_evoked: bool = False) -> 'BlinkRemover':
         """Remove the EOG artifacts from the raw data.
 
         Args:
-            raw (mne.io.Raw): The raw data from which the EOG artifacts will be removed.
+            inplace (bool, optional): Add and apply the projectors to ``raw``
+                itself instead of a copy, so no second copy of the recording
+                is made. Defaults to False.
+            keep_evoked (bool, optional): With ``inplace``, average the
+                blinks before they are projected out, so the QC plots still
+                work afterwards. This epochs every blink on every channel,
+                so leave it off when nothing is plotted. Defaults to False.
 
         Returns:
-            mne.io.Raw: The raw data without the EOG artifacts.
+            BlinkRemover: self, with the cleaned data in ``blink_removed_raw``.
         """
-        self.eog_projs, _ = mne.preprocessing.compute_proj_eog(
-            self.raw, 
-            n_eeg=1,
-            reject=None,
-            no_proj=True,
-            ch_name = self.channels
-        )
-        self.blink_removed_raw = self.raw.copy()
+        if inplace and keep_evoked:
+            self._find_blinks()
+        else:
+            self._detect()
+        if inplace:
+            self.blink_removed_raw = self.raw
+            self._projected_inplace = True
+        else:
+            self.blink_removed_raw = self.raw.copy()
         self.blink_removed_raw.add_proj(self.eog_projs).apply_proj()
-        return self          
+        return self
 
 
-def main(eeg_fpath, events_fpath, dict_fpath_template, dict_outpath):
-    try:
-        # Import the participant's data
-        eeg_obj = mne.io.read_raw_fif(eeg_fpath, preload=True)
-        blink_remover = BlinkRemover(eeg_obj)
-        blink_remover.remove_blinks()
-        eeg_obj = blink_remover.blink_removed_raw
+def process_participant(eeg_fpath, events_fpath, dict_template, dict_outpath, max_memory=None, output_format='pkl',
+                        eog_cache_dir=None):
+    """Convert one participant's FIF and events CSV. Raises on failure.
 
-        events_obj = pd.read_csv(events_fpath)
+    ``dict_template`` is the already loaded template dict, so batch workers
+    only unpickle it once. With ``eog_cache_dir`` the blink detection is
+    cached there (see ``BlinkRemover``).
+    """
+    # Import the participant's data. With a memory budget the recording
+    # stays on disk and is streamed through the envelope extraction.
+    eeg_obj = mne.io.read_raw_fif(eeg_fpath, preload=max_memory is None)
+    blink_remover = BlinkRemover(eeg_obj, cache_dir=eog_cache_dir)
+    blink_remover.remove_blinks(inplace=True)
+    eeg_obj = blink_remover.blink_removed_raw
+
+    events_obj = pd.read_csv(events_fpath)
+
+    data_dict = {}
+
+    # Adding the eeg data to a dictionary
+    bands = ['theta', 'delta', 'alpha', 'beta', 'gamma']
+    eeg_time = eeg_obj.times
+    envelope_extractor = BandEnvelopeExtractor(eeg_obj.info['sfreq'], bands)
+    features_shape = (len(eeg_obj.ch_names), int(eeg_obj.n_times), len(bands))
+    if output_format == 'npy':
+        # Write the envelopes straight into the memory-mappable output
+        eeg_features = create_features_array(dict_outpath, *features_shape)
+    elif max_memory is not None:
+        # Scratch space for the envelopes, removed once they are pickled
+        features_fpath = os.path.splitext(dict_outpath)[0] + '_features.npy'
+        eeg_features = np.lib.format.open_memmap(
+            features_fpath, mode='w+', dtype=np.float64, shape=features_shape)
+    else:
+        eeg_features = None
+
+    if max_memory is None:
+        eeg_features = envelope_extractor.transform_raw(eeg_obj, out=eeg_features)
+    else:
+        block_length = envelope_extractor.block_length(len(eeg_obj.ch_names), max_memory)
+        envelope_extractor.transform_raw_blocks(eeg_obj, eeg_features, block_length)
+        if output_format == 'pkl':
+            eeg_features.flush()
+            eeg_features = np.asarray(eeg_features)  # plain ndarray view, unpickles as one
+
+    channel_names = (eeg_obj.info['ch_names'])
+    anatomy, laterality = anatomy_and_laterality(channel_names, dict_template)
+    eeg_indices = list(range(len(channel_names)))
+
+    meas_date = eeg_obj.info['meas_date']
+    ptp_num = eeg_fpath.split('/')[-1].split('_')[0].split('-')[-1]
+    data_dict['eeg_data'] = {'time_info': {'time': eeg_time, 'meas_date': meas_date}, 
+                             'labels': {'channels_info': {'index': eeg_indices, 
+                                                          'channels_name': channel_names, 
+                                                          'anatomy': anatomy, 
+                                                          'laterality': laterality},
+                                        'frequency_bands': bands
+                                                          }, 
+                             'features': eeg_features,
+                             'features_info': f'EEG data for participant {ptp_num}'
+                             }
+
+    # Adding the events data to a dictionary
+    events_time = [round((datetime.fromtimestamp(ts, timezone.utc) - meas_date).total_seconds(), 3) for ts in events_obj.timestamps]
+    events_indices = list(events_obj.index)
+    events_labels = events_obj.StimMarkers_alpha.values
+    events_features = [1 if 'crash' in event.lower() else 0 for event in events_labels]
+    data_dict['events_data'] = {'time': events_time, 
+                                'labels': {'index': events_indices, 
+                                           'event_labels': events_labels}, 
+                                'features': events_features, 
+                                'features_info': f'Events data for participant {ptp_num}. Binary classification: 1 = Crash, 0 = Other event marker'}
+
+    if output_format == 'npy':
+        save_eeg_features(data_dict, dict_outpath)
+    else:
+        with open(dict_outpath, 'wb') as file:
+            # Protocol 5 writes the (possibly disk-backed) features buffer
+            # without an intermediate in-memory copy
+            pickle.dump(data_dict, file, protocol=5)
+        if max_memory is not None:
+            # The mapping stays readable for the returned dict after the unlink
+            os.remove(features_fpath)
 
+    return data_dict
+
+
+def main(eeg_fpath, events_fpath, dict_fpath_template, dict_outpath, max_memory=None, output_format='pkl',
+         eog_cache_dir=None):
+    try:
         # Grab a template pkl file to match up the eeg electrode information
         with open(dict_fpath_template, 'rb') as file:
             dict_template = pickle.load(file)
 
-        data_dict = {}
-
-        # Adding the eeg data to a dictionary
-        bands = ['theta', 'delta', 'alpha', 'beta', 'gamma']
-        eeg_features = list()
-        eeg_time = eeg_obj.times
-
-        for band in bands:
-            envelope = extract_envelopes(eeg_obj, band)
-            # Get the data and add a new axis to make it 3D
-            eeg_band_data = envelope.get_data()
-            eeg_band_data = np.expand_dims(eeg_band_data, axis=2)  # Add a new axis for the band
-            eeg_features.append(eeg_band_data)
-
-        # Now concatenate along axis 2 (which represents different bands)
-        eeg_features = np.concatenate(eeg_features, axis=2)
-        channel_names = (eeg_obj.info['ch_names'])
-        anatomy, laterality = anatomy_and_laterality(channel_names, dict_template)
-        eeg_indices = list(range(len(channel_names)))
-
-        meas_date = eeg_obj.info['meas_date']
-        ptp_num = eeg_fpath.split('/')[-1].split('_')[0].split('-')[-1]
-        data_dict['eeg_data'] = {'time_info': {'time': eeg_time, 'meas_date': meas_date}, 
-                                 'labels': {'channels_info': {'index': eeg_indices, 
-                                                              'channels_name': channel_names, 
-                                                              'anatomy': anatomy, 
-                                                              'laterality': laterality},
-                                            'frequency_bands': bands
-                                                              }, 
-                                 'features': eeg_features,
-                                 'features_info': f'EEG data for participant {ptp_num}'
-                                 }
-
-        # Adding the events data to a dictionary
-        events_time = [round((datetime.fromtimestamp(ts, timezone.utc) - meas_date).total_seconds(), 3) for ts in events_obj.timestamps]
-        events_indices = list(events_obj.index)
-        events_labels = events_obj.StimMarkers_alpha.values
-        events_features = [1 if 'crash' in event.lower() else 0 for event in events_labels]
-        data_dict['events_data'] = {'time': events_time, 
-                                    'labels': {'index': events_indices, 
-                                               'event_labels': events_labels}, 
-                                    'features': events_features, 
-                                    'features_info': f'Events data for participant {ptp_num}. Binary classification: 1 = Crash, 0 = Other event marker'}
-
-        with open(dict_outpath, 'wb') as file:
-            pickle.dump(data_dict, file)  
-
-        return True     
+        process_participant(eeg_fpath, events_fpath, dict_template, dict_outpath,
+                            max_memory=max_memory, output_format=output_format,
+                            eog_cache_dir=eog_cache_dir)
+        return True
 
     except Exception as e:
         print(f"Error: {e}")
@@ -227,8 +538,20 @@ if __name__ == '__main__':
     parser.add_argument('eeg_fpath', type=str, help='Path to the EEG data file (FIF format).')
     parser.add_argument('events_fpath', type=str, help='Path to the events data file (CSV format).')
     parser.add_argument('dict_fpath_template', type=str, help='Path to the template pickle file.')
-    parser.add_argument('dict_outpath', type=str, help='Path to the output pickle file.')
+    parser.add_argument('dict_outpath', type=str, help='Path to the output pickle file, or output directory with --format npy.')
+    parser.add_argument('--max-memory', type=float, default=None,
+                        help='Stream the recording in blocks using at most this many MB for the '
+                             'envelope extraction. With --format pkl the features pass through a '
+                             'temporary .npy next to the output, removed once the pickle is written.')
+    parser.add_argument('--format', choices=['pkl', 'npy'], default='pkl',
+                        help='pkl: pickle the nested dict (default). npy: write a directory with a '
+                             'memory-mappable features.npy and a JSON metadata sidecar, readable '
+                             'with eeg_features_io.load_eeg_features.')
+    parser.add_argument('--eog-cache-dir', type=str, default=None,
+                        help='Directory in which the blink detection is cached, so reruns on the '
+                             'same recording skip it.')
 
     args = parser.parse_args()
 
-    main(args.eeg_fpath, args.events_fpath, args.dict_fpath_template, args.dict_outpath)
\ No newline at end of file
+    main(args.eeg_fpath, args.events_fpath, args.dict_fpath_template, args.dict_outpath,
+         max_memory=args.max_memory, output_format=args.format, eog_cache_dir=args.eog_cache_dir)
\ No newline at end of file
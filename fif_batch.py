@@ -0,0 +1,178 @@
+"""Convert or render many FIF files on a process pool, without a display.
+
+    python fif_batch.py convert 'data/**/*_eeg*.fif' --dest csv/ --format npy
+    python fif_batch.py render data/ --dest qc/ --workers 8
+    python fif_batch.py overview data/ --dest qc/ --strip-seconds 600
+
+Inputs are FIF paths, directories (searched recursively for ``*.fif``) or
+glob patterns. ``convert`` runs ``fif_to_csv.convert_file``, ``render``
+runs ``plot_fif_file.render_file`` and ``overview`` runs
+``plot_fif_file.render_overview`` (decimated PNG strips of the whole
+recording, with the overview cached next to the FIF) on every file. Outputs go to ``--dest``,
+or next to each FIF without it. Files converted or rendered before with the
+same settings and code are skipped (see ``processing_cache``). Each command
+keeps its own manifest in each output directory, so ``convert`` and
+``overview`` into the same directory don't clean up each other's outputs.
+Tk is never imported.
+"""
+import argparse
+import csv
+import multiprocessing
+import os
+import time
+import traceback
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from glob import glob
+from pathlib import Path
+
+from processing_cache import ProcessingCache, code_version
+
+HERE = Path(__file__).resolve().parent
+
+# Filled in by _init_worker, once per worker process
+_worker_function = None
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(description='Convert or render many FIF files without a display.')
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    def add_common(command):
+        command.add_argument('inputs', nargs='+',
+                             help='FIF files, directories searched recursively, or glob patterns.')
+        command.add_argument('--dest', type=str, default=None,
+                             help='Output directory. Defaults to each FIF\'s own directory.')
+        command.add_argument('--workers', type=int, default=None,
+                             help='Number of worker processes. Defaults to the number of cores.')
+        command.add_argument('--force', action='store_true',
+                             help='Process every file, ignoring the processing cache.')
+        command.add_argument('--report', type=str, default=None,
+                             help='Path of a CSV report with the status of every file.')
+
+    convert = commands.add_parser('convert', help='Convert FIF files with fif_to_csv.')
+    add_common(convert)
+    convert.add_argument('--format', choices=['csv', 'parquet', 'feather', 'npy'], default='csv')
+    convert.add_argument('--float32', action='store_true', help='Store the samples in single precision.')
+    convert.add_argument('--block-size', type=int, default=100_000,
+                         help='Number of samples read from the FIF and written at a time.')
+
+    render = commands.add_parser('render', help='Render FIF files to PNG with plot_fif_file.')
+    add_common(render)
+    render.add_argument('--start', type=float, default=0.0, help='Start of the window in seconds.')
+    render.add_argument('--duration', type=float, default=20.0, help='Length of the window in seconds.')
+    render.add_argument('--n-channels', type=int, default=20, help='Number of channels shown.')
+
+    overview = commands.add_parser('overview', help='Render decimated overview strips with plot_fif_file.')
+    add_common(overview)
+    overview.add_argument('--strip-seconds', type=float, default=600.0, help='Length of each PNG strip.')
+    overview.add_argument('--n-channels', type=int, default=20, help='Number of channels shown.')
+    overview.add_argument('--channels', nargs='+', default=None,
+                          help='Channels to show. Defaults to the first --n-channels.')
+    return parser.parse_args()
+
+
+def find_fif_files(inputs):
+    """Expand files, directories and glob patterns into a sorted list of FIF paths."""
+    found = set()
+    for pattern in inputs:
+        if os.path.isdir(pattern):
+            found.update(str(p) for p in Path(pattern).rglob('*.fif'))
+        elif os.path.isfile(pattern):
+            found.add(pattern)
+        else:
+            found.update(p for p in glob(pattern, recursive=True) if p.endswith('.fif'))
+    return sorted(found)
+
+
+def job_settings(args):
+    """(keyword arguments of the worker function, the module that implements it)."""
+    if args.command == 'convert':
+        return ({'file_format': args.format, 'block_size': args.block_size, 'float32': args.float32},
+                HERE / 'fif_to_csv.py')
+    if args.command == 'render':
+        return ({'start': args.start, 'duration': args.duration, 'n_channels': args.n_channels},
+                HERE / 'plot_fif_file.py')
+    return ({'strip_seconds': args.strip_seconds, 'n_channels': args.n_channels, 'channels': args.channels},
+            HERE / 'plot_fif_file.py')
+
+
+def _init_worker(command):
+    global _worker_function
+    # Pay the mne import once per worker, not per job
+    if command == 'convert':
+        from fif_to_csv import convert_file as _worker_function
+    elif command == 'render':
+        from plot_fif_file import init_render_worker, render_file as _worker_function
+        init_render_worker()
+    else:
+        from plot_fif_file import init_render_worker, render_overview as _worker_function
+        init_render_worker()
+
+
+def _run_job(fif_fpath, dest, kwargs):
+    start = time.perf_counter()
+    result = {'fif_fpath': fif_fpath, 'outputs': [], 'status': 'ok', 'error': ''}
+    try:
+        result['outputs'] = _worker_function(fif_fpath, dest, **kwargs)
+    except Exception as e:
+        result['status'] = 'failed'
+        result['error'] = f"{type(e).__name__}: {e}"
+        traceback.print_exc()
+    result['seconds'] = round(time.perf_counter() - start, 3)
+    return result
+
+
+def main():
+    args = parse_arguments()
+    fif_fpaths = find_fif_files(args.inputs)
+    kwargs, module_fpath = job_settings(args)
+
+    # One manifest per command and output directory. block_size doesn't change the output.
+    params = {k: v for k, v in kwargs.items() if k != 'block_size'}
+    manifest_fname = f'.processing_cache.{args.command}.json'
+    version = code_version(module_fpath)
+    caches = {}
+    def cache_for(fif_fpath):
+        out_dir = args.dest or os.path.dirname(os.path.abspath(fif_fpath))
+        if out_dir not in caches:
+            caches[out_dir] = ProcessingCache(out_dir, params, version, manifest_fname=manifest_fname)
+        return caches[out_dir]
+
+    jobs = fif_fpaths if args.force else [f for f in fif_fpaths if not cache_for(f).is_fresh(f)]
+    print(f"{len(fif_fpaths)} FIF files, {len(fif_fpaths) - len(jobs)} unchanged since the last run, skipped")
+    if not jobs:
+        return True
+
+    workers = max(1, min(args.workers or os.cpu_count(), len(jobs)))
+    results = []
+    # spawn so that workers don't inherit a display-bound matplotlib backend
+    with ProcessPoolExecutor(max_workers=workers,
+                             mp_context=multiprocessing.get_context('spawn'),
+                             initializer=_init_worker,
+                             initargs=(args.command,)) as executor:
+        futures = [executor.submit(_run_job, fif_fpath, args.dest, kwargs) for fif_fpath in jobs]
+        for future in as_completed(futures):
+            result = future.result()
+            results.append(result)
+            if result['status'] == 'ok':
+                cache_for(result['fif_fpath']).record(result['fif_fpath'], result['outputs'])
+            print(f"[{len(results)}/{len(jobs)}] {result['status']:6} {result['seconds']:8.1f}s "
+                  f"{result['fif_fpath']} {result['error']}")
+
+    for cache in caches.values():
+        cache.save()
+
+    if args.report:
+        results.sort(key=lambda r: r['fif_fpath'])
+        with open(args.report, 'w', newline='') as f:
+            writer = csv.DictWriter(f, fieldnames=['fif_fpath', 'status', 'seconds', 'error', 'outputs'])
+            writer.writeheader()
+            writer.writerows({**r, 'outputs': ';'.join(r['outputs'])} for r in results)
+
+    n_failed = sum(r['status'] != 'ok' for r in results)
+    print(f"{len(results) - n_failed} succeeded, {n_failed} failed.")
+    return n_failed == 0
+
+
+if __name__ == '__main__':
+    raise SystemExit(0 if main() else 1)
@@ -1,51 +1,191 @@
 import mne
 import pandas as pd
 import argparse
+import json
 import os
 import numpy as np
-from tkinter import Tk, filedialog
+
+# Output extension per --format. npy also writes a .json header next to the array.
+FORMATS = {'csv': '.csv', 'parquet': '.parquet', 'feather': '.feather', 'npy': '.npy'}
 
 def get_fif_path():
+    # Imported here so the module can be used on machines without a display
+    from tkinter import Tk, filedialog
     Tk().withdraw()
     return filedialog.askopenfilename(title="Select FIF file", filetypes=[("FIF files", "*.fif")])
 
 def get_csv_dest_path():
+    from tkinter import Tk, filedialog
     Tk().withdraw()
     return filedialog.askdirectory(title="Select destination folder")
 
-parser = argparse.ArgumentParser(description='Open and plot an MNE FIF file.')
-parser.add_argument('fif_fpath', nargs='?', type=str, help='Path to the FIF file')
-parser.add_argument('--csv_dest', type=str, help='Path to the destination folder for the CSV file')
-args = parser.parse_args()
+def annotation_samples(raw):
+    """
+    Sample index and category code of every annotation except the Sync ones.
+
+    Onsets are converted to sample indices in one step (int(onset * sfreq)),
+    and Sync annotations and onsets outside the recording are masked out.
+    When several annotations land on the same sample the last one wins.
+
+    :return: (indices sorted by sample, int16 codes into categories, categories)
+    """
+    onsets = np.asarray(raw.annotations.onset, dtype=float)
+    descriptions = np.array(list(raw.annotations.description), dtype=str)
+    # converting onset times to indices
+    indices = (onsets * raw.info['sfreq']).astype(np.int64)
+    keep = (np.char.find(descriptions, 'Sync') < 0) & (indices >= 0) & (indices < raw.n_times)
+    indices, descriptions = indices[keep], descriptions[keep]
+
+    # np.unique keeps the first occurrence, so search from the end
+    last = len(indices) - 1 - np.unique(indices[::-1], return_index=True)[1]
+    categories, codes = np.unique(descriptions[last], return_inverse=True)
+    return indices[last], codes.astype(np.int16), list(categories)
+
+def iter_blocks(raw, block_size, dtype=np.float64):
+    """
+    Read the recording block by block, without preloading it.
+
+    :return: Iterator of (first sample, (n_channels, n_samples) array).
+    """
+    for start in range(0, int(raw.n_times), block_size):
+        stop = min(start + block_size, raw.n_times)
+        yield start, raw.get_data(start=start, stop=stop).astype(dtype, copy=False)
+
+def _annot_codes(annotations, start, stop):
+    """Annotation codes for samples [start, stop): -1 except at annotations."""
+    indices, codes, _ = annotations
+    block = np.full(stop - start, -1, dtype=np.int16)
+    lo, hi = np.searchsorted(indices, [start, stop])
+    block[indices[lo:hi] - start] = codes[lo:hi]
+    return block
+
+def write_csv(raw, out_fpath, annotations, block_size, dtype=np.float64):
+    """One row per sample, channels then 'annot', written block by block."""
+    with open(out_fpath, 'w', newline='') as f:
+        for start, block in iter_blocks(raw, block_size, dtype):
+            df = pd.DataFrame(block.T, columns=raw.info['ch_names'])
+            df['annot'] = pd.Categorical.from_codes(_annot_codes(annotations, start, start + block.shape[1]),
+                                                    annotations[2])
+            df.to_csv(f, header=start == 0, index=False)
+
+def _import_pyarrow():
+    try:
+        import pyarrow
+        import pyarrow.parquet
+    except ImportError:
+        raise ImportError("The parquet and feather formats need pyarrow (pip install pyarrow)") from None
+    return pyarrow
+
+def write_arrow(raw, out_fpath, annotations, block_size, dtype=np.float64, file_format='parquet'):
+    """
+    Same columns as write_csv in a Parquet file (one row group per block) or
+    a Feather (Arrow IPC) file (one record batch per block). 'annot' is
+    dictionary encoded: int16 codes into the annotation descriptions.
+    """
+    pa = _import_pyarrow()
+    annot_type = pa.dictionary(pa.int16(), pa.string())
+    categories = pa.array(annotations[2], type=pa.string())
+    schema = pa.schema([(name, pa.from_numpy_dtype(np.dtype(dtype))) for name in raw.info['ch_names']]
+                       + [('annot', annot_type)])
+    if file_format == 'parquet':
+        writer = pa.parquet.ParquetWriter(out_fpath, schema)
+    else:
+        writer = pa.ipc.new_file(out_fpath, schema)
+    with writer:
+        for start, block in iter_blocks(raw, block_size, dtype):
+            codes = _annot_codes(annotations, start, start + block.shape[1])
+            columns = [pa.array(channel) for channel in block]
+            columns.append(pa.DictionaryArray.from_arrays(pa.array(codes, mask=codes < 0), categories))
+            writer.write_table(pa.Table.from_arrays(columns, schema=schema))
+
+def write_npy(raw, out_fpath, annotations, block_size, dtype=np.float64):
+    """
+    Samples as a (n_channels, n_samples) .npy, so each channel is one
+    contiguous run, plus a .json header with the channel names, sampling
+    rate and the annotations as a sparse (sample, code) table with the
+    descriptions the codes refer to.
+    """
+    data = np.lib.format.open_memmap(out_fpath, mode='w+', dtype=dtype,
+                                     shape=(len(raw.info['ch_names']), int(raw.n_times)))
+    for start, block in iter_blocks(raw, block_size, dtype):
+        data[:, start:start + block.shape[1]] = block
+    data.flush()
+    del data
 
-fif_fpath = args.fif_fpath if args.fif_fpath else get_fif_path()
-csv_dest = args.csv_dest if args.csv_dest else get_csv_dest_path()
+    indices, codes, categories = annotations
+    header = {'layout': ['channel', 'sample'],
+              'dtype': np.dtype(dtype).name,
+              'ch_names': list(raw.info['ch_names']),
+              'sfreq': raw.info['sfreq'],
+              'n_samples': int(raw.n_times),
+              'annotations': {'categories': categories, 'sample': indices.tolist(),
+                              'code': codes.tolist()}}
+    with open(os.path.splitext(out_fpath)[0] + '.json', 'w') as f:
+        json.dump(header, f, indent=1)
 
-if csv_dest:
-    if not csv_dest.endswith(os.path.sep):
-        csv_dest += os.path.sep
-    csv_fpath = os.path.join(csv_dest, os.path.basename(fif_fpath).replace('.fif', '.csv'))
-else:
-    csv_fpath = os.path.join(os.path.dirname(fif_fpath), os.path.basename(fif_fpath).replace('.fif', '.csv'))
+def convert(raw, out_fpath, file_format='csv', block_size=100_000, float32=False):
+    """Write `raw` to `out_fpath` in one of the FORMATS, reading at most block_size samples at a time."""
+    dtype = np.float32 if float32 else np.float64
+    annotations = annotation_samples(raw)
+    if file_format == 'csv':
+        write_csv(raw, out_fpath, annotations, block_size, dtype)
+    elif file_format in ('parquet', 'feather'):
+        write_arrow(raw, out_fpath, annotations, block_size, dtype, file_format)
+    elif file_format == 'npy':
+        write_npy(raw, out_fpath, annotations, block_size, dtype)
+    else:
+        raise ValueError(f"Unknown format {file_format!r}, expected one of {list(FORMATS)}")
 
-fif_obj = mne.io.read_raw_fif(fif_fpath, preload=True)
+def output_fpaths(fif_fpath, dest=None, file_format='csv'):
+    """
+    Files convert_file writes for `fif_fpath`: <dest>/<name>.<ext>, next to
+    the FIF when dest is empty. The first one is the data file.
+    """
+    out_fname = os.path.basename(fif_fpath).replace('.fif', FORMATS[file_format])
+    out_fpath = os.path.join(dest or os.path.dirname(fif_fpath), out_fname)
+    if file_format == 'npy':
+        return [out_fpath, os.path.splitext(out_fpath)[0] + '.json']
+    return [out_fpath]
 
-data, times = fif_obj[:]
-channel_names = fif_obj.info['ch_names']
+def convert_file(fif_fpath, dest=None, file_format='csv', block_size=100_000, float32=False):
+    """
+    Convert one FIF file without preloading it.
 
+    :return: The files written, as output_fpaths.
+    """
+    out_fpaths = output_fpaths(fif_fpath, dest, file_format)
+    if file_format in ('parquet', 'feather'):
+        # Fail before anything is read or written
+        _import_pyarrow()
+    if dest:
+        os.makedirs(dest, exist_ok=True)
+    fif_obj = mne.io.read_raw_fif(fif_fpath, preload=False)
+    convert(fif_obj, out_fpaths[0], file_format, block_size, float32)
+    return out_fpaths
 
-df = pd.DataFrame(data.T, columns=channel_names)
-df['annot'] = np.nan
+def parse_arguments():
+    parser = argparse.ArgumentParser(description='Convert an MNE FIF file to CSV or a columnar format.')
+    parser.add_argument('fif_fpath', nargs='?', type=str,
+                        help='Path to the FIF file. Without it, file dialogs ask for the FIF and '
+                             'the destination folder. See fif_batch.py for many files.')
+    parser.add_argument('--csv_dest', type=str,
+                        help='Destination folder for the output. Defaults to the FIF\'s folder.')
+    parser.add_argument('--format', choices=list(FORMATS), default='csv',
+                        help='Output format. parquet and feather need pyarrow; npy writes a .json header alongside.')
+    parser.add_argument('--float32', action='store_true', help='Store the samples in single precision.')
+    parser.add_argument('--block-size', type=int, default=100_000,
+                        help='Number of samples read from the FIF and written at a time.')
+    return parser.parse_args()
 
-annotations = fif_obj.annotations
-for ann in annotations:
-    onset = ann['onset']
-    description = ann['description']
-    if 'Sync' not in description:
-        # converting onset time to index
-        idx = int(onset * fif_obj.info['sfreq'])
-        if idx < len(df):
-            df.at[idx, 'annot'] = description
+def main():
+    args = parse_arguments()
+    if args.fif_fpath:
+        fif_fpath, csv_dest = args.fif_fpath, args.csv_dest
+    else:
+        fif_fpath = get_fif_path()
+        csv_dest = args.csv_dest if args.csv_dest else get_csv_dest_path()
+    out_fpath = convert_file(fif_fpath, csv_dest, args.format, args.block_size, args.float32)[0]
+    print(f"{args.format.upper()} file saved to: {out_fpath}")
 
-df.to_csv(csv_fpath, index=False)
-print(f"CSV file saved to: {csv_fpath}")
\ No newline at end of file
+if __name__ == '__main__':
+    main()
@@ -1,20 +1,369 @@
 import mne
 import argparse
+import json
+import os
+import numpy as np
 import matplotlib.pyplot as plt
-from tkinter import Tk, filedialog
 # plt.switch_backend('TkAgg') # Uncomment if MNE crashes while trying to plot.
 # May need to change the visualization backend tools
 
 def get_fif_path():
+    # Imported here so the module can be used on machines without a display
+    from tkinter import Tk, filedialog
     Tk().withdraw()
     return filedialog.askopenfilename(title="Select FIF file", filetypes=[("FIF files", "*.fif")])
 
-parser = argparse.ArgumentParser(description='Open and plot an MNE FIF file.')
-parser.add_argument('fif_fpath', nargs='?', type=str, help='Path to the FIF file')
-args = parser.parse_args()
+def plot_fif(fif_fpath):
+    """Open the interactive MNE browser on a FIF file and block until it is closed."""
+    fif_obj = mne.io.read_raw_fif(fif_fpath, preload=True)
+    print('Plotting FIF file')
+    fif_obj.plot(block=True)
 
-fif_fpath = args.fif_fpath if args.fif_fpath else get_fif_path()
+def render_fpaths(fif_fpath, dest=None):
+    """Files render_file writes for `fif_fpath`: <dest>/<name>.png, next to the FIF when dest is empty."""
+    out_fname = os.path.basename(fif_fpath).replace('.fif', '.png')
+    return [os.path.join(dest or os.path.dirname(fif_fpath), out_fname)]
 
-fif_obj = mne.io.read_raw_fif(fif_fpath, preload=True)
-print('Plotting FIF file')
-fif_obj.plot(block=True)
\ No newline at end of file
+def init_render_worker():
+    """Draw without a display: the Agg backend and MNE's matplotlib browser."""
+    plt.switch_backend('Agg')
+    mne.viz.set_browser_backend('matplotlib')
+
+def render_file(fif_fpath, dest=None, start=0.0, duration=20.0, n_channels=20):
+    """
+    Save the MNE browser's view of one window of a FIF file as a PNG.
+
+    Only the samples in the window are read. Call init_render_worker first
+    when there is no display.
+
+    :return: The files written, as render_fpaths.
+    """
+    out_fpaths = render_fpaths(fif_fpath, dest)
+    if dest:
+        os.makedirs(dest, exist_ok=True)
+    fif_obj = mne.io.read_raw_fif(fif_fpath, preload=False)
+    fig = fif_obj.plot(start=start, duration=duration, n_channels=n_channels, show=False)
+    fig.savefig(out_fpaths[0])
+    plt.close(fig)
+    return out_fpaths
+
+class DecimationPyramid:
+    """
+    Per-channel min/max envelopes of a recording at several resolutions.
+
+    Level 0 holds the min and max of every bin of `bin_size` samples, and
+    each level above merges `factor` bins of the one below, up to the first
+    level with at most `max_bins` bins. Drawing a min/max band per bin shows
+    every spike a full-resolution plot would, so an overview never needs
+    more samples than the screen has pixels.
+    """
+    def __init__(self, mins, maxs, bin_size, factor, sfreq, n_times, ch_names):
+        """
+        :param mins, maxs: Lists of (n_channels, n_bins) arrays, finest level first.
+        """
+        self.mins = mins
+        self.maxs = maxs
+        self.bin_size = bin_size
+        self.factor = factor
+        self.sfreq = sfreq
+        self.n_times = n_times
+        self.ch_names = list(ch_names)
+
+    @classmethod
+    def build(cls, raw, bin_size=64, factor=4, max_bins=1024, block_size=100_000):
+        """Build the pyramid from `raw` without preloading it, block_size samples at a time."""
+        n_times = int(raw.n_times)
+        n_bins = -(-n_times // bin_size)
+        mins = np.empty((len(raw.ch_names), n_bins), dtype=np.float32)
+        maxs = np.empty_like(mins)
+        # Whole bins per block, so no bin straddles two reads
+        block_size = max(bin_size, block_size // bin_size * bin_size)
+        for start in range(0, n_times, block_size):
+            block = raw.get_data(start=start, stop=min(start + block_size, n_times))
+            edges = np.arange(0, block.shape[1], bin_size)
+            first = start // bin_size
+            mins[:, first:first + len(edges)] = np.minimum.reduceat(block, edges, axis=1)
+            maxs[:, first:first + len(edges)] = np.maximum.reduceat(block, edges, axis=1)
+
+        levels_min, levels_max = [mins], [maxs]
+        while levels_min[-1].shape[1] > max_bins:
+            edges = np.arange(0, levels_min[-1].shape[1], factor)
+            levels_min.append(np.minimum.reduceat(levels_min[-1], edges, axis=1))
+            levels_max.append(np.maximum.reduceat(levels_max[-1], edges, axis=1))
+        return cls(levels_min, levels_max, bin_size, factor, raw.info['sfreq'], n_times, raw.ch_names)
+
+    def save(self, fpath, source_key=None):
+        meta = {'bin_size': self.bin_size, 'factor': self.factor, 'sfreq': self.sfreq,
+                'n_times': self.n_times, 'ch_names': self.ch_names, 'source': source_key}
+        arrays = {f'min_{k}': m for k, m in enumerate(self.mins)}
+        arrays.update({f'max_{k}': m for k, m in enumerate(self.maxs)})
+        # Written under a temporary name first so an interrupted build leaves no cache
+        tmp_fpath = fpath + '.tmp.npz'
+        np.savez(tmp_fpath, meta=json.dumps(meta), **arrays)
+        os.replace(tmp_fpath, fpath)
+
+    @classmethod
+    def load(cls, fpath):
+        """:return: (pyramid, the source_key it was saved with)."""
+        with np.load(fpath) as npz:
+            meta = json.loads(str(npz['meta']))
+            n_levels = sum(key.startswith('min_') for key in npz.files)
+            mins = [npz[f'min_{k}'] for k in range(n_levels)]
+            maxs = [npz[f'max_{k}'] for k in range(n_levels)]
+        pyramid = cls(mins, maxs, meta['bin_size'], meta['factor'], meta['sfreq'],
+                      meta['n_times'], meta['ch_names'])
+        return pyramid, meta['source']
+
+    def samples_per_bin(self, level):
+        return self.bin_size * self.factor ** level
+
+    def level_for(self, n_samples, max_bins):
+        """The finest level with at most max_bins bins across n_samples."""
+        for level in range(len(self.mins)):
+            if n_samples / self.samples_per_bin(level) <= max_bins:
+                return level
+        return len(self.mins) - 1
+
+    def envelope(self, level, picks, start, stop):
+        """
+        :return: (bin start times in seconds, mins, maxs) of the picked channels
+                 for the bins overlapping samples [start, stop).
+        """
+        step = self.samples_per_bin(level)
+        first, last = max(0, start // step), min(self.mins[level].shape[1], -(-stop // step))
+        times = np.arange(first, last) * step / self.sfreq
+        return times, self.mins[level][picks, first:last], self.maxs[level][picks, first:last]
+
+def pyramid_fpath(fif_fpath):
+    """The overview cache next to the FIF file."""
+    return os.path.splitext(fif_fpath)[0] + '_overview.npz'
+
+def load_pyramid(fif_fpath, raw=None, bin_size=64, factor=4, max_bins=1024):
+    """
+    The FIF's decimation pyramid, from the cache next to it when the FIF's
+    size, modification time and the pyramid settings are unchanged, else
+    built and cached.
+    """
+    stat = os.stat(fif_fpath)
+    source_key = {'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns,
+                  'bin_size': bin_size, 'factor': factor, 'max_bins': max_bins}
+    cache_fpath = pyramid_fpath(fif_fpath)
+    if os.path.exists(cache_fpath):
+        try:
+            pyramid, cached_key = DecimationPyramid.load(cache_fpath)
+            if cached_key == source_key:
+                return pyramid
+        except (OSError, ValueError, KeyError):
+            pass
+    if raw is None:
+        raw = mne.io.read_raw_fif(fif_fpath, preload=False)
+    pyramid = DecimationPyramid.build(raw, bin_size, factor, max_bins)
+    try:
+        pyramid.save(cache_fpath, source_key)
+    except OSError as e:
+        print(f"Overview cache not saved: {e}")
+    return pyramid
+
+def _channel_scales(pyramid, picks):
+    """Offset and scale that give every channel a unit-height lane."""
+    coarse_min, coarse_max = pyramid.mins[-1][picks], pyramid.maxs[-1][picks]
+    center = np.median((coarse_min + coarse_max) / 2, axis=1)
+    scale = np.median(coarse_max - coarse_min, axis=1)
+    scale[~(scale > 0)] = 1.0
+    return center, scale
+
+def _draw_envelopes(ax, pyramid, picks, start, stop, max_bins, center, scale):
+    level = pyramid.level_for(stop - start, max_bins)
+    times, mins, maxs = pyramid.envelope(level, picks, start, stop)
+    for lane in range(len(picks)):
+        offset = len(picks) - 1 - lane
+        ax.fill_between(times, (mins[lane] - center[lane]) / scale[lane] / 2 + offset,
+                        (maxs[lane] - center[lane]) / scale[lane] / 2 + offset,
+                        step='post', linewidth=0.5, color='k')
+    ax.set_yticks(np.arange(len(picks))[::-1], [pyramid.ch_names[p] for p in picks])
+    ax.set_ylim(-1, len(picks))
+
+class OverviewViewer:
+    """
+    Interactive viewer that never loads the whole recording.
+
+    The top axes show the min/max overview of the picked channels from the
+    pyramid level that fits the axes' width (zooming in with the toolbar
+    switches to finer levels). The bottom axes show the window around the
+    last click at full resolution, read from the FIF on demand. Left/right
+    arrows move the window, +/- change its length.
+    """
+    def __init__(self, raw, pyramid, picks=None, duration=10.0, max_bins=2000):
+        self.raw = raw
+        self.pyramid = pyramid
+        self.picks = _picks(pyramid.ch_names) if picks is None else np.asarray(picks)
+        self.duration = duration
+        self.max_bins = max_bins
+        self.start = 0.0
+        self.center, self.scale = _channel_scales(pyramid, self.picks)
+
+        self.fig, (self.ax_overview, self.ax_detail) = plt.subplots(
+            2, 1, figsize=(14, 9), gridspec_kw={'height_ratios': [1, 2]})
+        self._span = None
+        self._redrawing = False
+        self._xlim_cid = None
+        self.draw_overview(0, pyramid.n_times)
+        self.draw_detail()
+        self.fig.canvas.mpl_connect('button_press_event', self._on_click)
+        self.fig.canvas.mpl_connect('key_press_event', self._on_key)
+
+    def draw_overview(self, start, stop):
+        self._redrawing = True
+        ax = self.ax_overview
+        xlim = (start / self.pyramid.sfreq, stop / self.pyramid.sfreq)
+        if self._xlim_cid is not None:
+            ax.callbacks.disconnect(self._xlim_cid)
+        ax.clear()
+        _draw_envelopes(ax, self.pyramid, self.picks, start, stop, self.max_bins, self.center, self.scale)
+        ax.set_xlim(*xlim)
+        ax.set_title('Overview (click to show a window below)')
+        self._span = ax.axvspan(self.start, self.start + self.duration, color='tab:blue', alpha=0.2)
+        # Newer matplotlib resets the axes' callbacks on clear()
+        self._xlim_cid = ax.callbacks.connect('xlim_changed', self._on_xlim)
+        self._redrawing = False
+
+    def draw_detail(self):
+        sfreq = self.pyramid.sfreq
+        start = int(round(self.start * sfreq))
+        stop = min(self.pyramid.n_times, start + int(round(self.duration * sfreq)))
+        data, times = self.raw[self.picks, start:stop]
+        ax = self.ax_detail
+        ax.clear()
+        for lane, trace in enumerate(data):
+            offset = len(self.picks) - 1 - lane
+            ax.plot(times, (trace - self.center[lane]) / self.scale[lane] / 2 + offset, linewidth=0.5, color='k')
+        ax.set_yticks(np.arange(len(self.picks))[::-1], [self.pyramid.ch_names[p] for p in self.picks])
+        ax.set_ylim(-1, len(self.picks))
+        ax.set_xlim(times[0] if len(times) else self.start, self.start + self.duration)
+        ax.set_xlabel('Time (s)')
+        if self._span is not None:
+            self._span.remove()
+            self._span = self.ax_overview.axvspan(self.start, self.start + self.duration,
+                                                  color='tab:blue', alpha=0.2)
+        self.fig.canvas.draw_idle()
+
+    def _on_xlim(self, ax):
+        if self._redrawing:
+            return
+        lo, hi = ax.get_xlim()
+        sfreq = self.pyramid.sfreq
+        self.draw_overview(max(0, int(lo * sfreq)), min(self.pyramid.n_times, int(np.ceil(hi * sfreq))))
+
+    def _move_to(self, start):
+        total = self.pyramid.n_times / self.pyramid.sfreq
+        self.start = float(np.clip(start, 0, max(0.0, total - self.duration)))
+        self.draw_detail()
+
+    def _on_click(self, event):
+        toolbar = self.fig.canvas.toolbar
+        if toolbar is not None and toolbar.mode:
+            return  # zooming or panning
+        if event.inaxes is self.ax_overview and event.xdata is not None:
+            self._move_to(event.xdata - self.duration / 2)
+
+    def _on_key(self, event):
+        if event.key == 'right':
+            self._move_to(self.start + self.duration)
+        elif event.key == 'left':
+            self._move_to(self.start - self.duration)
+        elif event.key in ('+', '='):
+            self.duration = max(1.0 / self.pyramid.sfreq, self.duration / 2)
+            self._move_to(self.start)
+        elif event.key == '-':
+            self.duration *= 2
+            self._move_to(self.start)
+
+def view_overview(fif_fpath, channels=None, n_channels=20, duration=10.0):
+    """Open the OverviewViewer on a FIF file and block until it is closed."""
+    fif_obj = mne.io.read_raw_fif(fif_fpath, preload=False)
+    pyramid = load_pyramid(fif_fpath, fif_obj)
+    viewer = OverviewViewer(fif_obj, pyramid, _picks(pyramid.ch_names, channels, n_channels), duration)
+    plt.show(block=True)
+    return viewer
+
+def overview_fpaths(fif_fpath, dest=None, n_strips=1):
+    stem = os.path.splitext(os.path.basename(fif_fpath))[0]
+    out_dir = dest or os.path.dirname(fif_fpath)
+    return [os.path.join(out_dir, f'{stem}_overview_{i:03d}.png') for i in range(n_strips)]
+
+def _picks(ch_names, channels=None, n_channels=20):
+    """Indices of `channels` (names), or of the first n_channels."""
+    if channels:
+        missing = [name for name in channels if name not in ch_names]
+        if missing:
+            raise ValueError(f"Channels not in the recording: {missing}")
+        return np.array([ch_names.index(name) for name in channels])
+    return np.arange(min(n_channels, len(ch_names)))
+
+def render_overview(fif_fpath, dest=None, strip_seconds=600.0, n_channels=20, channels=None,
+                    width_px=2000):
+    """
+    Save the min/max overview of a FIF file as PNG strips of strip_seconds
+    each, from its decimation pyramid. Needs no display; the FIF is read
+    only to build the pyramid when it isn't cached yet.
+
+    :return: The files written, <name>_overview_000.png, ...
+    """
+    pyramid = load_pyramid(fif_fpath)
+    picks = _picks(pyramid.ch_names, channels, n_channels)
+    center, scale = _channel_scales(pyramid, picks)
+    strip_samples = max(1, int(strip_seconds * pyramid.sfreq))
+    n_strips = -(-pyramid.n_times // strip_samples)
+    out_fpaths = overview_fpaths(fif_fpath, dest, n_strips)
+    if dest:
+        os.makedirs(dest, exist_ok=True)
+    dpi = 100
+    for i, out_fpath in enumerate(out_fpaths):
+        start = i * strip_samples
+        fig, ax = plt.subplots(figsize=(width_px / dpi, 0.25 * len(picks) + 1), dpi=dpi)
+        _draw_envelopes(ax, pyramid, picks, start, min(start + strip_samples, pyramid.n_times),
+                        width_px, center, scale)
+        ax.set_xlim(start / pyramid.sfreq, (start + strip_samples) / pyramid.sfreq)
+        ax.set_xlabel('Time (s)')
+        ax.set_title(f'{os.path.basename(fif_fpath)}  strip {i + 1}/{n_strips}')
+        fig.tight_layout()
+        fig.savefig(out_fpath)
+        plt.close(fig)
+    return out_fpaths
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(description='Open and plot an MNE FIF file.')
+    parser.add_argument('fif_fpath', nargs='?', type=str,
+                        help='Path to the FIF file. Without it, a file dialog asks for one. '
+                             'See fif_batch.py to render many files without a display.')
+    mode = parser.add_mutually_exclusive_group()
+    mode.add_argument('--overview', action='store_true',
+                      help='Open the decimated overview viewer instead of the MNE browser. '
+                           'The recording is not preloaded; the overview is cached next to the FIF.')
+    mode.add_argument('--strips', action='store_true',
+                      help='Save the overview as PNG strips without opening a window.')
+    parser.add_argument('--dest', type=str, default=None,
+                        help='Destination folder for --strips. Defaults to the FIF\'s folder.')
+    parser.add_argument('--strip-seconds', type=float, default=600.0, help='Length of each PNG strip.')
+    parser.add_argument('--channels', nargs='+', default=None,
+                        help='Channels to show in the overview. Defaults to the first --n-channels.')
+    parser.add_argument('--n-channels', type=int, default=20)
+    parser.add_argument('--duration', type=float, default=10.0,
+                        help='Length in seconds of the full-resolution window of --overview.')
+    return parser.parse_args()
+
+def main():
+    args = parse_arguments()
+    fif_fpath = args.fif_fpath if args.fif_fpath else get_fif_path()
+    if args.strips:
+        plt.switch_backend('Agg')
+        for out_fpath in render_overview(fif_fpath, args.dest, args.strip_seconds,
+                                         args.n_channels, args.channels):
+            print(f"Overview saved to: {out_fpath}")
+    elif args.overview:
+        view_overview(fif_fpath, args.channels, args.n_channels, args.duration)
+    else:
+        plot_fif(fif_fpath)
+
+if __name__ == '__main__':
+    main()
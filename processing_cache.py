@@ -0,0 +1,159 @@
+"""Incremental processing cache for cohort reruns.
+
+Each output directory gets a ``.processing_cache.json`` manifest (or one per
+step, with ``manifest_fname``, when several steps write there). An entry is
+keyed on the input file path and the processing parameters, and records a
+fingerprint of the input contents, the parameters and the code version
+together with the outputs it produced. On a rerun, a file whose fingerprint
+is unchanged and whose outputs still exist is skipped. Runs with different
+parameters keep separate entries, so their outputs can sit side by side.
+
+When an input or the code changes, the new entry supersedes the old one and
+any output of the old entry that was not rewritten is deleted. An entry of
+other parameters whose outputs were overwritten is dropped, so the next run
+with those parameters redoes the file. Entries whose input file no longer
+exists are dropped when the manifest is saved.
+"""
+import hashlib
+import json
+import os
+from pathlib import Path
+
+MANIFEST_FNAME = '.processing_cache.json'
+
+
+def file_digest(fpath: str | os.PathLike, chunk_size: int = 1 << 20) -> str:
+    """SHA-256 of a file's contents, read in chunks."""
+    digest = hashlib.sha256()
+    with open(fpath, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def code_version(*source_fpaths: str | os.PathLike) -> str:
+    """Short hash of the source files that implement a processing step."""
+    digest = hashlib.sha256()
+    for fpath in source_fpaths:
+        digest.update(Path(fpath).read_bytes())
+    return digest.hexdigest()[:16]
+
+
+class ProcessingCache:
+    """Skip inputs whose contents, parameters and code are unchanged.
+
+    Usage::
+
+        cache = ProcessingCache(output_dir, params, code_version(__file__))
+        for fpath in inputs:
+            if cache.is_fresh(fpath):
+                continue
+            outputs = process(fpath)
+            cache.record(fpath, outputs)
+        cache.save()
+    """
+    def __init__(self,
+                 output_dir: str | os.PathLike,
+                 params: dict,
+                 version: str,
+                 manifest_fname: str = MANIFEST_FNAME):
+        self.manifest_fpath = Path(output_dir) / manifest_fname
+        self.params = params
+        self.version = version
+        self._params_key = hashlib.sha256(
+            json.dumps(params, sort_keys=True, default=str).encode()).hexdigest()[:16]
+        self.entries = {}
+        if self.manifest_fpath.exists():
+            with open(self.manifest_fpath) as f:
+                self.entries = json.load(f)['entries']
+
+    def _entry_key(self, input_fpath):
+        return f"{os.path.abspath(input_fpath)}|{self._params_key}"
+
+    def _content_hash(self, input_fpaths):
+        """Combined digest of the inputs; unchanged files (same size and mtime)
+        reuse the digest stored in the manifest instead of being re-read."""
+        known = {}
+        for entry in self.entries.values():
+            known.update({f['path']: f for f in entry['inputs']})
+
+        inputs = []
+        for fpath in input_fpaths:
+            fpath = os.path.abspath(fpath)
+            stat = os.stat(fpath)
+            previous = known.get(fpath)
+            if previous and previous['size'] == stat.st_size and previous['mtime_ns'] == stat.st_mtime_ns:
+                sha256 = previous['sha256']
+            else:
+                sha256 = file_digest(fpath)
+            inputs.append({'path': fpath, 'size': stat.st_size,
+                           'mtime_ns': stat.st_mtime_ns, 'sha256': sha256})
+        return inputs
+
+    def _fingerprint(self, inputs):
+        digest = hashlib.sha256(self.version.encode())
+        digest.update(self._params_key.encode())
+        for f in inputs:
+            digest.update(f['sha256'].encode())
+        return digest.hexdigest()
+
+    def is_fresh(self: 'ProcessingCache',
+                 input_fpath: str | os.PathLike,
+                 extra_inputs: list[str | os.PathLike] = []) -> bool:
+        """Whether ``input_fpath`` was already processed with these settings.
+
+        Args:
+            input_fpath (str | os.PathLike): The main input file.
+            extra_inputs (list, optional): Other files the result depends on
+                (an events CSV, a template pickle, ...). Defaults to [].
+
+        Returns:
+            bool: True if the stored fingerprint matches and every recorded
+                output still exists.
+        """
+        entry = self.entries.get(self._entry_key(input_fpath))
+        if entry is None:
+            return False
+        inputs = self._content_hash([input_fpath, *extra_inputs])
+        return (entry['fingerprint'] == self._fingerprint(inputs)
+                and all(os.path.exists(out) for out in entry['outputs']))
+
+    def record(self: 'ProcessingCache',
+               input_fpath: str | os.PathLike,
+               outputs: list[str | os.PathLike],
+               extra_inputs: list[str | os.PathLike] = []) -> None:
+        """Store a successful run, superseding any previous entry.
+
+        Outputs of the superseded entry that were not written again are
+        removed from disk. Entries of other parameters that listed one of
+        ``outputs`` no longer describe what is on disk and are dropped.
+        """
+        key = self._entry_key(input_fpath)
+        outputs = [os.path.abspath(out) for out in outputs]
+        written = set(outputs)
+        self.entries = {other: entry for other, entry in self.entries.items()
+                        if other == key or not written & set(entry['outputs'])}
+        previous = self.entries.get(key)
+        if previous is not None:
+            in_use = {out for other, entry in self.entries.items() if other != key
+                      for out in entry['outputs']}
+            for stale in set(previous['outputs']) - written - in_use:
+                if os.path.isfile(stale):
+                    os.remove(stale)
+
+        inputs = self._content_hash([input_fpath, *extra_inputs])
+        self.entries[key] = {'inputs': inputs,
+                             'params': self.params,
+                             'version': self.version,
+                             'fingerprint': self._fingerprint(inputs),
+                             'outputs': outputs}
+
+    def save(self: 'ProcessingCache') -> None:
+        """Write the manifest atomically, dropping entries for deleted inputs."""
+        self.entries = {key: entry for key, entry in self.entries.items()
+                        if os.path.exists(entry['inputs'][0]['path'])}
+        self.manifest_fpath.parent.mkdir(parents=True, exist_ok=True)
+        tmp_fpath = self.manifest_fpath.with_suffix('.tmp')
+        with open(tmp_fpath, 'w') as f:
+            json.dump({'entries': self.entries}, f, indent=1, default=str)
+        os.replace(tmp_fpath, self.manifest_fpath)
@@ -0,0 +1,7 @@
+import sys
+from pathlib import Path
+
+# The scripts live at the top of the repository and in IRT_extraction, not in packages
+ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT))
+sys.path.insert(0, str(ROOT / 'IRT_extraction'))
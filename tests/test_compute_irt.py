@@ -0,0 +1,106 @@
+import numpy as np
+import pytest
+
+from compute_irt import adaptive_dtw, banded_dtw, path_irt, sakoe_chiba_band, streaming_dtw_irt
+
+
+def brute_force_dtw(a, b, lo, hi):
+    """Textbook DTW over the full cost matrix, with every cell outside the band at inf."""
+    n, m = len(a), len(b)
+    acc = np.full((n, m), np.inf)
+    step = np.zeros((n, m), dtype=int)
+    for i in range(n):
+        for j in range(lo[i], hi[i] + 1):
+            cost = (a[i] - b[j]) ** 2
+            if i == 0 and j == 0:
+                acc[i, j] = cost
+                continue
+            # Ties prefer the diagonal, then stim (i-1, j), then user (i, j-1)
+            best = np.inf
+            for code, (pi, pj) in enumerate(((i - 1, j - 1), (i - 1, j), (i, j - 1))):
+                if pi >= 0 and pj >= 0 and acc[pi, pj] < best:
+                    best, step[i, j] = acc[pi, pj], code
+            acc[i, j] = cost + best
+
+    path = [(n - 1, m - 1)]
+    i, j = n - 1, m - 1
+    while (i, j) != (0, 0):
+        i, j = ((i - 1, j - 1), (i - 1, j), (i, j - 1))[step[i, j]]
+        path.append((i, j))
+    path_i, path_j = np.array(path[::-1]).T
+    return acc[n - 1, m - 1], path_i, path_j
+
+
+def random_band(rng, n, m):
+    """A connected band of random width that wanders off the diagonal."""
+    lo = np.sort(rng.integers(0, m, n))
+    lo[0] = 0
+    hi = np.minimum(lo + rng.integers(0, max(2, m // 3), n), m - 1)
+    hi = np.maximum.accumulate(hi)
+    hi[-1] = m - 1
+    hi[:-1] = np.maximum(hi[:-1], lo[1:] - 1)
+    return lo, hi
+
+
+def random_series(rng, n, m, ties):
+    if ties:
+        # Few distinct values, so many cells tie and the step preference decides the path
+        return rng.integers(-2, 3, n).astype(float), rng.integers(-2, 3, m).astype(float)
+    return rng.normal(size=n), rng.normal(size=m)
+
+
+def random_case(seed):
+    rng = np.random.default_rng(seed)
+    n, m = rng.integers(1, 40, 2)
+    a, b = random_series(rng, n, m, ties=seed % 2 == 0)
+    if seed % 3 == 0:
+        lo, hi = sakoe_chiba_band(n, m, rng.integers(0, 6, n))
+    else:
+        lo, hi = random_band(rng, n, m)
+    return a, b, lo, hi
+
+
+@pytest.mark.parametrize('seed', range(30))
+def test_banded_dtw_matches_brute_force(seed):
+    a, b, lo, hi = random_case(seed)
+    expected_cost, expected_i, expected_j = brute_force_dtw(a, b, lo, hi)
+    cost, path_i, path_j = banded_dtw(a, b, lo, hi)
+    assert cost == expected_cost
+    np.testing.assert_array_equal(path_i, expected_i)
+    np.testing.assert_array_equal(path_j, expected_j)
+
+
+@pytest.mark.parametrize('checkpoint_every', [None, 1, 3, 1000])
+@pytest.mark.parametrize('seed', range(30))
+def test_streaming_dtw_irt_matches_brute_force(seed, checkpoint_every):
+    a, b, lo, hi = random_case(seed)
+    expected_cost, expected_i, expected_j = brute_force_dtw(a, b, lo, hi)
+    cost, irt = streaming_dtw_irt(a, b, lo, hi, checkpoint_every=checkpoint_every)
+    assert cost == expected_cost
+    np.testing.assert_array_equal(irt, path_irt(expected_i, expected_j, len(a)))
+
+
+@pytest.mark.parametrize('seed', range(30))
+def test_adaptive_dtw_matches_brute_force_on_its_final_band(seed):
+    rng = np.random.default_rng(seed)
+    n, m = rng.integers(20, 80, 2)
+    a, b = random_series(rng, n, m, ties=seed % 2 == 0)
+    region_length = int(rng.integers(5, 30))
+    max_radius = int(rng.integers(2, 40))
+    cost, path_i, path_j, info = adaptive_dtw(a, b, initial_radius=1, max_radius=max_radius,
+                                              region_length=region_length)
+
+    region_radius = np.array(info['region_radius'])
+    lo, hi = sakoe_chiba_band(n, m, np.repeat(region_radius, region_length)[:n])
+    expected_cost, expected_i, expected_j = brute_force_dtw(a, b, lo, hi)
+    assert cost == expected_cost
+    np.testing.assert_array_equal(path_i, expected_i)
+    np.testing.assert_array_equal(path_j, expected_j)
+    np.testing.assert_array_equal(path_irt(path_i, path_j, n), path_irt(expected_i, expected_j, n))
+
+    # Either the path stays off the band's inner edges, or every region it
+    # touches them in is already at max_radius
+    on_edge = (((path_j == lo[path_i]) & (lo[path_i] > 0))
+               | ((path_j == hi[path_i]) & (hi[path_i] < m - 1)))
+    assert info['converged'] == (not on_edge.any())
+    assert (region_radius[path_i[on_edge] // region_length] == max_radius).all()
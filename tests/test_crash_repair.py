@@ -0,0 +1,72 @@
+import numpy as np
+import pandas as pd
+import pytest
+from scipy.interpolate import PchipInterpolator
+from scipy.signal import savgol_filter
+
+from CrashRepair import CrashRepair, restructure_arr
+from tracking_data import make_tracking
+
+
+def reference_transition(cr, pre_data, post_data):
+    """compute_transition as it was before the batched kernels, one segment at a time."""
+    if len(pre_data) < 2 or len(post_data) < 2:
+        return None
+    times = np.linspace(pre_data['flip_time'].iloc[0], post_data['flip_time'].iloc[-1],
+                        len(pre_data) + len(post_data))
+    knots = np.concatenate([pre_data['flip_time'].values, post_data['flip_time'].values])
+    interpolated = []
+    for col in ['stim_pos', 'user_pos']:
+        values = np.concatenate([pre_data[col].values, post_data[col].values])
+        try:
+            pchip = PchipInterpolator(knots, values)
+        except ValueError:
+            pchip = PchipInterpolator(restructure_arr(knots), values)
+        interpolated.append(cr.smooth_dampen(pchip(times), cr.target_max_position))
+    window_length = min(15, len(times) // 2 * 2 - 1)
+    if window_length > 3:
+        interpolated = [savgol_filter(values, window_length, 3) for values in interpolated]
+    return pd.DataFrame({'stim_pos': interpolated[0], 'user_pos': interpolated[1], 'flip_time': times})
+
+
+def reference_repair(df, target_max_position):
+    """The per-segment repair_tracking loop, without the final resampling."""
+    cr = CrashRepair(df, target_max_position=target_max_position)
+    data = cr.data
+    repaired = data.copy()
+    for crash_idx in data[data['crash_count'].diff() != 0].index:
+        pre_window = min(cr.window_frame_count, crash_idx)
+        post_window = min(cr.window_frame_count, len(data) - crash_idx)
+        if pre_window == 0 or post_window == 0:
+            continue
+        pre_crash = data.iloc[crash_idx - pre_window:crash_idx]
+        post_crash = data.iloc[crash_idx:crash_idx + post_window]
+        transition = reference_transition(cr, pre_crash, post_crash)
+        if transition is None:
+            continue
+        start_idx, end_idx = crash_idx - pre_window, crash_idx + post_window
+        rows = pd.RangeIndex(start=start_idx, stop=end_idx)
+        repaired.loc[rows, 'stim_pos'] = transition['stim_pos'].values
+        repaired.loc[rows, 'user_pos'] = transition['user_pos'].values
+        repaired.loc[rows, 'flip_time'] = transition['flip_time'].values
+        repaired.loc[rows, 'did_crash'] = False
+        repaired.loc[rows, 'crash_count'] = repaired.loc[start_idx - 1, 'crash_count'] if start_idx > 0 else 0
+    return repaired
+
+
+@pytest.mark.parametrize('repeated_timestamps', [False, True])
+def test_repair_tracking_matches_per_segment_loop(monkeypatch, repeated_timestamps):
+    df = make_tracking()
+    if repeated_timestamps:
+        # PCHIP rejects the window around the crash at row 700, so it goes through restructure_arr
+        df.loc[650, 'flip_time'] = df.loc[649, 'flip_time']
+    cr = CrashRepair(df)
+    cr.set_target_max_position()
+    expected = reference_repair(df, cr.target_max_position)
+
+    # Bit-identical before resampling...
+    monkeypatch.setattr(CrashRepair, 'resample_data', lambda self, data, **kwargs: data)
+    pd.testing.assert_frame_equal(cr.repair_tracking(), expected, check_exact=True)
+    monkeypatch.undo()
+    # ...and after
+    pd.testing.assert_frame_equal(cr.repair_tracking(), cr.resample_data(expected), check_exact=True)
@@ -0,0 +1,32 @@
+import mne
+import numpy as np
+import pytest
+
+from eeg_file_to_pkl import BandEnvelopeExtractor, bands_dict, extract_envelopes
+
+
+def make_raw(n_channels=3, duration=60.0, sfreq=500.0, seed=0):
+    rng = np.random.default_rng(seed)
+    n_times = int(duration * sfreq)
+    # A random walk under white noise, so the slow bands carry some power
+    data = (np.cumsum(rng.normal(size=(n_channels, n_times)), axis=1) * 1e-7
+            + rng.normal(size=(n_channels, n_times)) * 1e-6)
+    info = mne.create_info([f'EEG{k}' for k in range(n_channels)], sfreq, 'eeg')
+    return mne.io.RawArray(data, info, verbose=False)
+
+
+@pytest.mark.parametrize('sfreq, seed', [(500.0, 0), (250.0, 1)])
+def test_band_envelopes_within_documented_edge_tolerance(sfreq, seed):
+    raw = make_raw(sfreq=sfreq, seed=seed)
+    bands = list(bands_dict)
+    envelopes = BandEnvelopeExtractor(sfreq, bands).transform_raw(raw)
+
+    # Time to the nearer end of the recording, in seconds
+    t = np.minimum(np.arange(raw.n_times), np.arange(raw.n_times)[::-1]) / sfreq
+    away = t >= 0.5
+    for b, band in enumerate(bands):
+        legacy = extract_envelopes(raw, band).get_data()
+        peak = np.abs(legacy).max(axis=1, keepdims=True)
+        rel = np.abs(envelopes[:, :, b] - legacy) / peak
+        # The bound the BandEnvelopeExtractor docstring gives: 0.2 s / t of the peak
+        assert (rel[:, away] <= 0.2 / t[away]).all(), band
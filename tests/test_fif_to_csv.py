@@ -0,0 +1,71 @@
+import json
+import sys
+
+import mne
+import numpy as np
+import pandas as pd
+import pytest
+
+from fif_to_csv import convert_file
+
+
+@pytest.fixture
+def fif_fpath(tmp_path):
+    sfreq = 100.0
+    data = np.random.default_rng(0).normal(size=(3, 1000)) * 1e-5
+    info = mne.create_info(['Fz', 'Cz', 'Pz'], sfreq, 'eeg')
+    raw = mne.io.RawArray(data, info, verbose=False)
+    # Two annotations on sample 250 (the last one wins) and a Sync one that is dropped
+    raw.set_annotations(mne.Annotations(onset=[0.5, 2.5, 2.5, 4.0, 7.25],
+                                        duration=0.0,
+                                        description=['start', 'crash', 'reset', 'Sync 1', 'crash']))
+    fpath = tmp_path / 'sub-X_eeg.fif'
+    raw.save(fpath, verbose=False)
+    return str(fpath)
+
+
+def test_csv(fif_fpath, tmp_path):
+    out_fpath, = convert_file(fif_fpath, str(tmp_path / 'out'), 'csv', block_size=300)
+    df = pd.read_csv(out_fpath, float_precision='round_trip')
+    raw = mne.io.read_raw_fif(fif_fpath, preload=True, verbose=False)
+    np.testing.assert_array_equal(df[raw.ch_names].to_numpy().T, raw.get_data())
+    annotated = df['annot'].dropna()
+    assert annotated.to_dict() == {50: 'start', 250: 'reset', 725: 'crash'}
+
+
+@pytest.mark.parametrize('file_format', ['parquet', 'feather'])
+def test_arrow_matches_csv(fif_fpath, tmp_path, file_format):
+    pytest.importorskip('pyarrow')
+    csv_fpath, = convert_file(fif_fpath, str(tmp_path / 'out'), 'csv', block_size=300)
+    out_fpath, = convert_file(fif_fpath, str(tmp_path / 'out'), file_format, block_size=300)
+    expected = pd.read_csv(csv_fpath, float_precision='round_trip')
+    if file_format == 'parquet':
+        df = pd.read_parquet(out_fpath)
+    else:
+        df = pd.read_feather(out_fpath)
+    assert list(df.columns) == list(expected.columns)
+    np.testing.assert_array_equal(df.drop(columns='annot').to_numpy(),
+                                  expected.drop(columns='annot').to_numpy())
+    assert df['annot'].dropna().astype(str).to_dict() == expected['annot'].dropna().to_dict()
+
+
+def test_npy_matches_csv(fif_fpath, tmp_path):
+    csv_fpath, = convert_file(fif_fpath, str(tmp_path / 'out'), 'csv', block_size=300)
+    npy_fpath, json_fpath = convert_file(fif_fpath, str(tmp_path / 'out'), 'npy', block_size=300)
+    expected = pd.read_csv(csv_fpath, float_precision='round_trip')
+    with open(json_fpath) as f:
+        header = json.load(f)
+    data = np.load(npy_fpath)
+    np.testing.assert_array_equal(data.T, expected[header['ch_names']].to_numpy())
+    annotations = header['annotations']
+    assert {s: annotations['categories'][c] for s, c in zip(annotations['sample'], annotations['code'])} \
+        == expected['annot'].dropna().to_dict()
+
+
+@pytest.mark.parametrize('file_format', ['parquet', 'feather'])
+def test_arrow_without_pyarrow_fails_before_writing(fif_fpath, tmp_path, monkeypatch, file_format):
+    monkeypatch.setitem(sys.modules, 'pyarrow', None)
+    dest = tmp_path / 'out'
+    with pytest.raises(ImportError, match='pip install pyarrow'):
+        convert_file(fif_fpath, str(dest), file_format)
+    assert not dest.exists()
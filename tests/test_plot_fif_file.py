@@ -0,0 +1,34 @@
+import matplotlib
+matplotlib.use('Agg')
+import mne
+import numpy as np
+
+import plot_fif_file
+from plot_fif_file import DecimationPyramid, OverviewViewer
+
+
+def make_raw(n_channels=3, n_times=40_000, sfreq=100.0):
+    data = np.random.default_rng(0).normal(size=(n_channels, n_times))
+    info = mne.create_info([f'EEG{k}' for k in range(n_channels)], sfreq, 'eeg')
+    return mne.io.RawArray(data, info, verbose=False)
+
+
+def test_overview_switches_levels_on_every_zoom(monkeypatch):
+    raw = make_raw()
+    pyramid = DecimationPyramid.build(raw, bin_size=4, factor=4, max_bins=100)
+    viewer = OverviewViewer(raw, pyramid, duration=5.0, max_bins=100)
+
+    levels = []
+    draw_envelopes = plot_fif_file._draw_envelopes
+    def record_level(ax, pyramid, picks, start, stop, max_bins, *args):
+        levels.append(pyramid.level_for(stop - start, max_bins))
+        return draw_envelopes(ax, pyramid, picks, start, stop, max_bins, *args)
+    monkeypatch.setattr(plot_fif_file, '_draw_envelopes', record_level)
+
+    # Full recording, then two toolbar-style zooms
+    viewer.ax_overview.set_xlim(0, 100)
+    viewer.ax_overview.set_xlim(0, 10)
+    assert len(levels) == 2
+    assert levels[0] > levels[1]
+    assert viewer.ax_overview.get_xlim() == (0, 10)
+    plot_fif_file.plt.close(viewer.fig)
@@ -0,0 +1,51 @@
+import numpy as np
+import pandas as pd
+import pytest
+from scipy.signal import detrend
+
+from reproc_cpCST import normalize_columns, zscale
+
+
+def make_features(n=5000, seed=0):
+    rng = np.random.default_rng(seed)
+    trend = np.linspace(0, 3, n)
+    return pd.DataFrame({
+        'flip_time': 100 + np.arange(n) / 30,
+        'stim_pos': np.cumsum(rng.normal(0, 0.01, n)) + trend,
+        'user_pos': rng.normal(0, 0.3, n) - trend,
+        'tracking': rng.normal(5, 2, n),
+        'crash_count': np.repeat(np.arange(5), n // 5).astype(np.int64),
+        'did_crash': rng.random(n) < 0.01,
+    })
+
+
+def reference_normalize(df, detrend_vectors, zscale_vectors):
+    """The per-column loop normalize_columns replaced."""
+    if detrend_vectors:
+        for col in df.columns:
+            if col != 'flip_time':
+                df[col] = detrend(df[col])
+    if zscale_vectors:
+        for col in df.columns:
+            if col != 'flip_time':
+                df[col] = zscale(df[col])
+    return df
+
+
+@pytest.mark.parametrize('detrend_vectors, zscale_vectors', [(True, False), (False, True), (True, True)])
+def test_normalize_columns_matches_per_column_loop(detrend_vectors, zscale_vectors):
+    expected = reference_normalize(make_features(), detrend_vectors, zscale_vectors)
+    result = normalize_columns(make_features(), detrend_vectors, zscale_vectors)
+    # The bool and int columns come back as floats, as the loop leaves them
+    pd.testing.assert_frame_equal(result, expected, check_exact=True)
+
+
+def test_normalize_columns_float32_close_to_loop():
+    expected = reference_normalize(make_features(), True, True)
+    result = normalize_columns(make_features(), True, True, dtype=np.float32)
+    np.testing.assert_allclose(result.to_numpy(dtype=float), expected.to_numpy(), atol=1e-4)
+
+
+def test_normalize_columns_without_flags_leaves_frame_alone():
+    df = make_features()
+    pd.testing.assert_frame_equal(normalize_columns(df.copy(), False, False), df, check_exact=True)
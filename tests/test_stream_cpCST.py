@@ -0,0 +1,39 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from reproc_cpCST import output_filename, process_file
+from tracking_data import make_tracking
+
+
+@pytest.fixture(scope='module')
+def tracking_fpath(tmp_path_factory):
+    fpath = tmp_path_factory.mktemp('tracking') / 'sub-M10900001_cpCST.csv'
+    make_tracking().to_csv(fpath, index=False)
+    return fpath
+
+
+def run(fpath, out_dir, detrend, zscale, chunksize=None):
+    out_dir.mkdir()
+    result = process_file(fpath, out_dir, detrend, zscale, chunksize=chunksize, plots='none')
+    assert result['error'] is None, result['error']
+    return out_dir / output_filename(fpath, detrend, zscale)
+
+
+# 7 and 100 rows are smaller than a repair window on each side of a crash (2 * 90 rows);
+# at 7 rows a chunk boundary falls where the overlapping windows step flip_time back
+@pytest.mark.parametrize('chunksize', [7, 100, 500, 100_000])
+def test_stream_features_matches_in_memory(tracking_fpath, tmp_path, chunksize):
+    expected = run(tracking_fpath, tmp_path / 'memory', False, False)
+    streamed = run(tracking_fpath, tmp_path / 'streamed', False, False, chunksize)
+    assert streamed.read_bytes() == expected.read_bytes()
+
+
+@pytest.mark.parametrize('detrend, zscale', [(True, False), (False, True), (True, True)])
+@pytest.mark.parametrize('chunksize', [7, 500])
+def test_stream_features_normalized_matches_in_memory(tracking_fpath, tmp_path, chunksize, detrend, zscale):
+    expected = pd.read_csv(run(tracking_fpath, tmp_path / 'memory', detrend, zscale))
+    streamed = pd.read_csv(run(tracking_fpath, tmp_path / 'streamed', detrend, zscale, chunksize))
+    assert list(streamed.columns) == list(expected.columns)
+    # The streamed statistics come from running sums: equal up to rounding
+    np.testing.assert_allclose(streamed.to_numpy(), expected.to_numpy(), rtol=0, atol=1e-12)
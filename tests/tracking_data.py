@@ -0,0 +1,21 @@
+"""Synthetic cpCST tracking data shared by the tests."""
+import numpy as np
+import pandas as pd
+
+
+def make_tracking(n=1200, crash_rows=(40, 300, 380, 700, 1170), rate=30.0, seed=0):
+    """Tracking data with crashes near both ends and two overlapping repair windows."""
+    rng = np.random.default_rng(seed)
+    flip_time = np.cumsum(np.full(n, 1 / rate) + rng.normal(0, 1e-4, n)) + 100
+    stim_pos = np.cumsum(rng.normal(0, 0.01, n))
+    user_pos = -(stim_pos + rng.normal(0, 0.02, n))
+    crash_count = np.zeros(n, dtype=np.int64)
+    did_crash = np.zeros(n, dtype=bool)
+    for row in crash_rows:
+        crash_count[row:] += 1
+        did_crash[row] = True
+        flip_time[row:] += 1.0
+        stim_pos[row:] -= stim_pos[row]
+        user_pos[row:] -= user_pos[row]
+    return pd.DataFrame({'flip_time': flip_time, 'stim_pos': stim_pos, 'user_pos': user_pos,
+                         'crash_count': crash_count, 'did_crash': did_crash})